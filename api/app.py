@@ -1,31 +1,39 @@
 from urllib.parse import urljoin
 
-from flask import Flask, url_for
-from libtrustbridge.errors import handlers
+from flask import Flask
 
-from api import loggers
-from api.conf import Config
+from api import loggers, metrics
+from api.conf import HUB_PATH, Config
+from api.http_client import HttpClient
+from api.repos import RepoRegistry
 
 
-def create_app(config_object=None):
+def create_app(config_object=None, with_views=True):
+    """
+    Create the app; processors and other commands which don't serve requests
+    pass with_views=False, so the views and their dependencies (marshmallow, webargs) aren't imported
+    """
     if config_object is None:
         config_object = Config
 
     app = Flask(__name__)
     app.config.from_object(config_object)
     app.logger = loggers.create_logger(app.config)
+    app.repos = RepoRegistry(app.config)
+    app.http_client = HttpClient.from_config(app.config)
+    metrics.init_app(app)
+    if app.config['REPOS_WARM_UP']:
+        app.repos.warm_up()
+    app.config['HUB_URL'] = urljoin(app.config['SERVICE_URL'], HUB_PATH)
 
-    with app.app_context():
-        from api import views
+    if with_views:
+        from libtrustbridge.errors import handlers
 
-        app.register_blueprint(views.blueprint)
+        with app.app_context():
+            from api import views
 
-        handlers.register(app)
+            app.register_blueprint(views.blueprint)
 
-        with app.test_request_context():
-            app.config['HUB_URL'] = urljoin(
-                app.config['SERVICE_URL'],
-                url_for('views.subscriptions_by_jurisdiction', _external=False)
-            )
+            handlers.register(app)
 
     return app
@@ -0,0 +1,487 @@
+"""
+Local backends for the repos, so the channel can run without MinIO and ElasticMQ
+(REPOS_BACKEND=local), e.g. small single node deployments, tests and benchmarks.
+
+FilesystemObjectClient and SqliteQueueClient implement the part of boto3 S3/SQS client API
+used by the repos, LocalObjectRepoMixin and LocalQueueRepoMixin replace connection setup
+of MinioRepo/ElasticMQRepo with them. Use get_local_repo_class to get local version of a repo.
+Objects and queues are kept in LOCAL_BACKEND_DIR, so the API and the processors of the host share them.
+"""
+import contextlib
+import datetime
+import json
+import mmap
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+from botocore.exceptions import ClientError
+from libtrustbridge.repos.elasticmqrepo import ElasticMQRepo
+from libtrustbridge.repos.miniorepo import MinioRepo
+
+
+class NoSuchKey(ClientError):
+    pass
+
+
+class NoSuchBucket(ClientError):
+    pass
+
+
+class LocalClientExceptions:
+    ClientError = ClientError
+    NoSuchKey = NoSuchKey
+    NoSuchBucket = NoSuchBucket
+
+
+class FileBody:
+    """
+    Object body read through mmap, so big objects are not copied until they are read.
+    The body starts at `offset` of the file, after the object head
+    """
+
+    def __init__(self, f, offset=0):
+        file_size = os.fstat(f.fileno()).st_size
+        self.size = file_size - offset
+        self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+        self._position = offset
+        self._end = file_size
+
+    def read(self, amt=None):
+        if self._mmap is None:
+            return b''
+        end = self._end if amt is None else min(self._position + amt, self._end)
+        data = self._mmap[self._position:end]
+        self._position = end
+        return data
+
+    def iter_chunks(self, chunk_size=1024):
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+
+class FilesystemObjectClient:
+    """
+    Object storage in the local directory: {root}/{bucket}/objects/{key}.
+    The object file starts with a line of JSON head (metadata and content type) followed by the body.
+    Objects are written to temporary files and renamed, so readers never see partial objects,
+    nor metadata of another version of the body.
+    """
+
+    exceptions = LocalClientExceptions
+
+    def __init__(self, root):
+        self.root = root
+
+    def head_bucket(self, Bucket):
+        if not os.path.isdir(self._bucket_path(Bucket)):
+            raise NoSuchBucket({'Error': {'Code': 'NoSuchBucket'}}, 'HeadBucket')
+        return {}
+
+    def create_bucket(self, Bucket, **kwargs):
+        for directory in ('objects', 'tmp'):
+            os.makedirs(os.path.join(self._bucket_path(Bucket), directory), exist_ok=True)
+        return {}
+
+    def put_object(self, Bucket, Key, Body=b'', Metadata=None, ContentType=None, IfNoneMatch=None, **kwargs):
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        elif hasattr(Body, 'read'):
+            Body = Body.read()
+        self._write(Bucket, Key, lambda f: f.write(Body), Metadata, ContentType, if_none_match=IfNoneMatch)
+        return {}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, **kwargs):
+        extra_args = ExtraArgs or {}
+        self._write(
+            Bucket, Key, lambda f: shutil.copyfileobj(Fileobj, f),
+            extra_args.get('Metadata'), extra_args.get('ContentType')
+        )
+
+    def get_object(self, Bucket, Key, **kwargs):
+        return self._read_head(Bucket, Key, 'GetObject', with_body=True)
+
+    def head_object(self, Bucket, Key, **kwargs):
+        return self._read_head(Bucket, Key, 'HeadObject')
+
+    def copy_object(self, Bucket, Key, CopySource, CopySourceIfMatch=None, IfNoneMatch=None, **kwargs):
+        source = self.get_object(CopySource['Bucket'], CopySource['Key'])
+        try:
+            if CopySourceIfMatch is not None and source['ETag'] != CopySourceIfMatch:
+                raise self._precondition_failed('CopyObject')
+            self.put_object(
+                Bucket, Key, source['Body'].read(), Metadata=source['Metadata'], ContentType=source['ContentType'],
+                IfNoneMatch=IfNoneMatch,
+            )
+        finally:
+            source['Body'].close()
+        return {}
+
+    def delete_object(self, Bucket, Key, IfMatch=None, **kwargs):
+        if IfMatch is not None:
+            try:
+                if self.head_object(Bucket, Key)['ETag'] != IfMatch:
+                    raise self._precondition_failed('DeleteObject')
+            except NoSuchKey:
+                pass
+        try:
+            os.unlink(self._object_path(Bucket, Key))
+        except FileNotFoundError:
+            pass
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        for obj in Delete['Objects']:
+            self.delete_object(Bucket, obj['Key'])
+        return {'Deleted': [{'Key': obj['Key']} for obj in Delete['Objects']]}
+
+    def list_objects_v2(self, Bucket, Prefix='', StartAfter='', MaxKeys=1000, ContinuationToken=None, **kwargs):
+        start_after = ContinuationToken or StartAfter
+        keys = [key for key in self._iter_keys(Bucket) if key.startswith(Prefix) and key > start_after]
+        keys.sort()
+        page, rest = keys[:MaxKeys], keys[MaxKeys:]
+        contents = []
+        for key in page:
+            try:
+                contents.append({'Key': key, 'Size': self.head_object(Bucket, key)['ContentLength']})
+            except ClientError:
+                # deleted after it was listed
+                continue
+        response = {
+            'Contents': contents,
+            'KeyCount': len(contents),
+            'IsTruncated': bool(rest),
+        }
+        if rest:
+            response['NextContinuationToken'] = page[-1]
+        return response
+
+    def list_objects(self, Bucket, Prefix='', Marker='', MaxKeys=1000, **kwargs):
+        response = self.list_objects_v2(Bucket, Prefix=Prefix, StartAfter=Marker, MaxKeys=MaxKeys)
+        if response['IsTruncated']:
+            response['NextMarker'] = response.pop('NextContinuationToken')
+        return response
+
+    def get_paginator(self, operation_name):
+        return ListObjectsPaginator(self, operation_name)
+
+    def _read_head(self, bucket, key, operation, with_body=False):
+        """Read head of the object and optionally its body, both from the same opened file"""
+        try:
+            f = open(self._object_path(bucket, key), 'rb')
+        except FileNotFoundError:
+            if operation == 'HeadObject':
+                raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, operation)
+            raise NoSuchKey({'Error': {'Code': 'NoSuchKey', 'Message': key}}, operation)
+        with f:
+            head_line = f.readline()
+            head = json.loads(head_line.decode('utf-8'))
+            stat = os.fstat(f.fileno())
+            head['ContentLength'] = stat.st_size - len(head_line)
+            head['LastModified'] = datetime.datetime.fromtimestamp(stat.st_mtime, datetime.timezone.utc)
+            if with_body:
+                head['Body'] = FileBody(f, offset=len(head_line))
+        return head
+
+    def _write(self, bucket, key, write, metadata, content_type, if_none_match=None):
+        """Write the object, with if_none_match='*' only if it doesn't exist yet"""
+        self.create_bucket(bucket)
+        object_path = self._object_path(bucket, key)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+
+        # ETag identifies the version of the object, for the conditional requests
+        head = {
+            'Metadata': metadata or {},
+            'ContentType': content_type or 'binary/octet-stream',
+            'ETag': '"%s"' % uuid.uuid4().hex,
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self._bucket_path(bucket), 'tmp'))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(json.dumps(head).encode('utf-8') + b'\n')
+                write(f)
+            if if_none_match == '*':
+                try:
+                    # unlike rename, link fails if the object exists
+                    os.link(tmp_path, object_path)
+                except FileExistsError:
+                    raise self._precondition_failed('PutObject')
+            else:
+                os.replace(tmp_path, object_path)
+        finally:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _precondition_failed(operation):
+        return ClientError({'Error': {'Code': 'PreconditionFailed', 'Message': 'Precondition Failed'}}, operation)
+
+    def _iter_keys(self, bucket):
+        objects_path = os.path.join(self._bucket_path(bucket), 'objects')
+        for directory, dirnames, filenames in os.walk(objects_path):
+            for filename in filenames:
+                yield os.path.relpath(os.path.join(directory, filename), objects_path).replace(os.sep, '/')
+
+    def _bucket_path(self, bucket):
+        return os.path.join(self.root, bucket)
+
+    def _object_path(self, bucket, key):
+        return os.path.join(self._bucket_path(bucket), 'objects', *key.split('/'))
+
+
+class ListObjectsPaginator:
+    def __init__(self, client, operation_name):
+        self.client = client
+        self.operation_name = operation_name
+
+    def paginate(self, PaginationConfig=None, **kwargs):
+        page_size = (PaginationConfig or {}).get('PageSize', 1000)
+        token = None
+        while True:
+            response = self.client.list_objects_v2(MaxKeys=page_size, ContinuationToken=token, **kwargs)
+            yield response
+            if not response['IsTruncated']:
+                break
+            token = response['NextContinuationToken']
+
+
+class SqliteQueueClient:
+    """
+    Queues in the SQLite database file, with the part of SQS client API used by the repos.
+    The file is shared by all processes using the same LOCAL_BACKEND_DIR (the API and the processors),
+    every thread/process uses its own connection.
+
+    Supports delayed messages (DelaySeconds), visibility timeout of received messages
+    (not deleted messages become visible again) and long polling (WaitTimeSeconds) by polling the database.
+    """
+
+    DEFAULT_VISIBILITY_TIMEOUT = 30
+    POLL_INTERVAL = 0.05
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS queues (name TEXT PRIMARY KEY, visibility_timeout REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS messages (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            queue TEXT NOT NULL,
+            message_id TEXT NOT NULL,
+            body TEXT NOT NULL,
+            visible_at REAL NOT NULL,
+            receipt_handle TEXT
+        );
+        CREATE INDEX IF NOT EXISTS messages_visible ON messages (queue, visible_at, seq);
+        CREATE INDEX IF NOT EXISTS messages_receipt ON messages (receipt_handle);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(self.SCHEMA)
+
+    def create_queue(self, QueueName, Attributes=None, **kwargs):
+        visibility_timeout = float((Attributes or {}).get('VisibilityTimeout', self.DEFAULT_VISIBILITY_TIMEOUT))
+        self._connection().execute(
+            'INSERT OR IGNORE INTO queues (name, visibility_timeout) VALUES (?, ?)', (QueueName, visibility_timeout)
+        )
+        return {'QueueUrl': QueueName}
+
+    def get_queue_url(self, QueueName, **kwargs):
+        return self.create_queue(QueueName)
+
+    def send_message(self, QueueUrl, MessageBody, DelaySeconds=0, **kwargs):
+        response = self.send_message_batch(
+            QueueUrl, [{'Id': '0', 'MessageBody': MessageBody, 'DelaySeconds': DelaySeconds}]
+        )
+        return {'MessageId': response['Successful'][0]['MessageId']}
+
+    def send_message_batch(self, QueueUrl, Entries, **kwargs):
+        """All entries are inserted in one transaction, so a receiver gets the whole batch"""
+        now = time.time()
+        successful = []
+        rows = []
+        for entry in Entries:
+            message_id = str(uuid.uuid4())
+            rows.append((QueueUrl, message_id, entry['MessageBody'], now + entry.get('DelaySeconds', 0)))
+            successful.append({'Id': entry['Id'], 'MessageId': message_id})
+        with self._transaction() as connection:
+            connection.executemany(
+                'INSERT INTO messages (queue, message_id, body, visible_at) VALUES (?, ?, ?, ?)', rows
+            )
+        return {'Successful': successful, 'Failed': []}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, VisibilityTimeout=None, **kwargs):
+        deadline = time.time() + WaitTimeSeconds
+        while True:
+            messages = self._receive(QueueUrl, MaxNumberOfMessages, VisibilityTimeout)
+            now = time.time()
+            if messages or now >= deadline:
+                return {'Messages': messages} if messages else {}
+            time.sleep(min(self.POLL_INTERVAL, deadline - now))
+
+    def delete_message(self, QueueUrl, ReceiptHandle, **kwargs):
+        self._connection().execute(
+            'DELETE FROM messages WHERE queue = ? AND receipt_handle = ?', (QueueUrl, ReceiptHandle)
+        )
+        return {}
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout, **kwargs):
+        self._connection().execute(
+            'UPDATE messages SET visible_at = ? WHERE queue = ? AND receipt_handle = ?',
+            (time.time() + VisibilityTimeout, QueueUrl, ReceiptHandle)
+        )
+        return {}
+
+    def purge_queue(self, QueueUrl, **kwargs):
+        self._connection().execute('DELETE FROM messages WHERE queue = ?', (QueueUrl,))
+        return {}
+
+    def _receive(self, queue_url, max_messages, visibility_timeout):
+        with self._transaction() as connection:
+            now = time.time()
+            if visibility_timeout is None:
+                row = connection.execute(
+                    'SELECT visibility_timeout FROM queues WHERE name = ?', (queue_url,)
+                ).fetchone()
+                visibility_timeout = row[0] if row else self.DEFAULT_VISIBILITY_TIMEOUT
+            rows = connection.execute(
+                'SELECT seq, message_id, body FROM messages WHERE queue = ? AND visible_at <= ? '
+                'ORDER BY visible_at, seq LIMIT ?', (queue_url, now, max_messages)
+            ).fetchall()
+            messages = []
+            for seq, message_id, body in rows:
+                # new receipt handle per receive, as in SQS the previous one can't delete the message anymore
+                receipt_handle = str(uuid.uuid4())
+                connection.execute(
+                    'UPDATE messages SET visible_at = ?, receipt_handle = ? WHERE seq = ?',
+                    (now + visibility_timeout, receipt_handle, seq)
+                )
+                messages.append({'MessageId': message_id, 'ReceiptHandle': receipt_handle, 'Body': body})
+        return messages
+
+    def _connection(self):
+        # connections can't be shared by threads, nor survive fork of the processor workers
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        connection = self._connection()
+        # take the write lock upfront, so concurrent receivers never get the same message
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+
+_queue_clients = {}
+_queue_clients_lock = threading.Lock()
+
+
+def get_queue_client(root):
+    """Queue client of the local backend directory, shared by the repos of the process"""
+    path = os.path.join(root, 'queues.sqlite3')
+    with _queue_clients_lock:
+        if path not in _queue_clients:
+            _queue_clients[path] = SqliteQueueClient(path)
+        return _queue_clients[path]
+
+
+class LocalObjectRepoMixin(MinioRepo):
+    """
+    MinioRepo storing objects in the local directory,
+    connection_data should contain 'local_root' directory
+    """
+
+    def __init__(self, connection_data, use_default_bucket=False):
+        self.connection_data = connection_data
+        self.bucket_name = self.DEFAULT_BUCKET if use_default_bucket else (
+            connection_data.get('bucket') or self.DEFAULT_BUCKET
+        )
+        self.client = FilesystemObjectClient(connection_data['local_root'])
+        self.client.create_bucket(Bucket=self.bucket_name)
+
+    def put_object(self, clean_path=None, chunked_path=None, content_body=None, content_type=None):
+        self.client.put_object(
+            Bucket=self.bucket_name, Key=chunked_path or clean_path, Body=content_body, ContentType=content_type
+        )
+
+    def get_object_content(self, path):
+        obj = self.client.get_object(Bucket=self.bucket_name, Key=path)
+        try:
+            return obj['Body'].read()
+        finally:
+            obj['Body'].close()
+
+    def _unsafe_method__clear(self):
+        shutil.rmtree(self.client._bucket_path(self.bucket_name), ignore_errors=True)
+        self.client.create_bucket(Bucket=self.bucket_name)
+
+
+class LocalQueueRepoMixin(ElasticMQRepo):
+    """
+    ElasticMQRepo keeping jobs in the SQLite queue of the local directory,
+    connection_data should contain 'local_root' directory
+    """
+
+    def __init__(self, connection_data):
+        self.connection_data = connection_data
+        self.queue_name = self._get_queue_name()
+        self.sqs_client = get_queue_client(connection_data['local_root'])
+        self.queue_url = self.sqs_client.create_queue(QueueName=self.queue_name)['QueueUrl']
+
+    def post_job(self, payload, delay_seconds=0):
+        self.sqs_client.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(payload), DelaySeconds=delay_seconds)
+        return True
+
+    def get_job(self):
+        messages = self.sqs_client.receive_message(QueueUrl=self.queue_url).get('Messages')
+        if not messages:
+            return False
+        return messages[0]['ReceiptHandle'], json.loads(messages[0]['Body'])
+
+    def delete(self, msg_id):
+        self.sqs_client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=msg_id)
+        return True
+
+    def _unsafe_method__clear(self):
+        self.sqs_client.purge_queue(QueueUrl=self.queue_url)
+
+
+_local_repo_classes = {}
+
+
+def get_local_repo_class(repo_class):
+    """Return subclass of the repo class using local backend instead of MinIO/ElasticMQ"""
+    if repo_class not in _local_repo_classes:
+        if issubclass(repo_class, MinioRepo):
+            mixin = LocalObjectRepoMixin
+        elif issubclass(repo_class, ElasticMQRepo):
+            mixin = LocalQueueRepoMixin
+        else:
+            raise ValueError('No local backend for %s' % repo_class.__name__)
+        _local_repo_classes[repo_class] = type('Local' + repo_class.__name__, (repo_class, mixin), {})
+    return _local_repo_classes[repo_class]
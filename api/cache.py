@@ -0,0 +1,247 @@
+import contextlib
+import fcntl
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryCache:
+    """
+    Thread-safe LRU cache bounded by total size of the values in bytes,
+    entries older than ttl seconds are treated as missing.
+    Values are stored as UTF-8 encoded bytes, so the bound holds for non-ASCII documents too
+    """
+
+    name = 'memory'
+
+    def __init__(self, max_bytes, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (time.monotonic(), value)
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+
+class DiskCache:
+    """
+    Cache storing values as files in the directory, bounded by total size in bytes.
+    Files are written atomically (temp file + rename), least recently stored
+    files are evicted first. Entries older than ttl seconds are treated as missing.
+    Eviction scans the directory, so it frees space down to LOW_WATER_MARK of max_bytes,
+    and the following writes fit in without scanning it again.
+
+    The directory may be shared by several processes (e.g. forked processor workers):
+    total size is kept in the directory and updated under exclusive file lock,
+    and eviction scans the directory, so it accounts for files of all the processes.
+    """
+
+    name = 'disk'
+
+    LOCK_FILE = '.lock'
+    SIZE_FILE = '.size'
+    LOW_WATER_MARK = 0.9
+    # temp files of other processes may be being written, older ones are left by crashed writers
+    STALE_TMP_SECONDS = 60
+
+    def __init__(self, directory, max_bytes, ttl=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        with self._locked():
+            self._write_size(self._evict())
+
+    @property
+    def size(self):
+        with self._locked():
+            return self._read_size()
+
+    def get(self, key):
+        path = self._get_path(key)
+        try:
+            if self.ttl is not None and time.time() - os.path.getmtime(path) > self.ttl:
+                self.delete(key)
+                return None
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, value):
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        if len(value) > self.max_bytes:
+            return
+        path = self._get_path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(value)
+
+        with self._locked():
+            size = self._read_size() + len(value) - self._get_size(path)
+            os.replace(tmp_path, path)
+            if size > self.max_bytes:
+                size = self._evict()
+            self._write_size(size)
+
+    def delete(self, key):
+        path = self._get_path(key)
+        with self._locked():
+            size = self._get_size(path)
+            self._unlink(path)
+            if size:
+                self._write_size(max(self._read_size() - size, 0))
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # the lock file is opened by every operation, as flock of a descriptor inherited by fork isn't exclusive
+        with self._lock, open(os.path.join(self.directory, self.LOCK_FILE), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _read_size(self):
+        try:
+            with open(os.path.join(self.directory, self.SIZE_FILE)) as f:
+                return int(f.read() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _write_size(self, size):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(str(size))
+        os.replace(tmp_path, os.path.join(self.directory, self.SIZE_FILE))
+
+    def _evict(self):
+        """Evict the oldest files of the directory until they fit the low water mark, returns their total size"""
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or entry.name.startswith('.'):
+                continue
+            stat = entry.stat()
+            if entry.name.endswith('.tmp'):
+                if now - stat.st_mtime > self.STALE_TMP_SECONDS:
+                    self._unlink(entry.path)
+                continue
+            entries.append((stat.st_mtime, entry.path, stat.st_size))
+        entries.sort()
+        size = sum(entry_size for mtime, path, entry_size in entries)
+        max_size = self.max_bytes * self.LOW_WATER_MARK
+        for mtime, path, entry_size in entries:
+            if size <= max_size:
+                break
+            self._unlink(path)
+            size -= entry_size
+        return size
+
+    @staticmethod
+    def _get_size(path):
+        try:
+            return os.path.getsize(path)
+        except FileNotFoundError:
+            return 0
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+class TieredCache:
+    """
+    Read-through cache over several tiers (fastest first),
+    values found in a slower tier are copied to the faster ones.
+    Counts hits per tier and misses.
+    """
+
+    def __init__(self, tiers):
+        self.tiers = tiers
+        self.hits = {tier.name: 0 for tier in tiers}
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        for index, tier in enumerate(self.tiers):
+            value = tier.get(key)
+            if value is None:
+                continue
+            with self._lock:
+                self.hits[tier.name] += 1
+            for faster_tier in self.tiers[:index]:
+                faster_tier.set(key, value)
+            return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, value):
+        for tier in self.tiers:
+            tier.set(key, value)
+
+    def delete(self, key):
+        for tier in self.tiers:
+            tier.delete(key)
+
+    def stats(self):
+        """Hits per tier, misses and size in bytes per tier"""
+        return {
+            'hits': dict(self.hits),
+            'misses': self.misses,
+            'size': {tier.name: tier.size for tier in self.tiers},
+        }
+
+
+def create_message_cache(config):
+    """Create cache for ChannelRepo from config, None if it's disabled"""
+    tiers = []
+    ttl = config['MESSAGE_CACHE_TTL']
+    if config['MESSAGE_CACHE_MAX_BYTES']:
+        tiers.append(MemoryCache(config['MESSAGE_CACHE_MAX_BYTES'], ttl=ttl))
+    if config['MESSAGE_CACHE_DISK_DIR'] and config['MESSAGE_CACHE_DISK_MAX_BYTES']:
+        tiers.append(DiskCache(config['MESSAGE_CACHE_DISK_DIR'], config['MESSAGE_CACHE_DISK_MAX_BYTES'], ttl=ttl))
+    if not tiers:
+        return None
+    return TieredCache(tiers)
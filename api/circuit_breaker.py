@@ -0,0 +1,161 @@
+"""
+Circuit breaker of outbound deliveries, keyed by destination host.
+
+    closed - deliveries are attempted, consecutive failures are counted;
+        failure_threshold failures in a row open the circuit
+    open - deliveries are not attempted for reset_timeout seconds,
+        callers defer their jobs (see CircuitBreaker.get_deferral)
+    half-open - after reset_timeout a single probe delivery is let through,
+        its success closes the circuit, failure opens it again
+
+State is kept in the process memory, or in a file shared by all processor workers
+of the host (CIRCUIT_BREAKER_STATE_FILE), updated under exclusive file lock.
+"""
+import fcntl
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# max delay of SQS message
+MAX_DEFERRAL_SECONDS = 900
+
+
+class MemoryCircuitStore:
+    """Circuits of the process"""
+
+    def __init__(self):
+        self._circuits = {}
+        self._lock = threading.Lock()
+
+    def update(self, key, update):
+        """Call update(circuit dict) for the circuit of the key atomically, returns its result"""
+        with self._lock:
+            circuit = dict(self._circuits.get(key) or {})
+            result = update(circuit)
+            self._circuits[key] = circuit
+            return result
+
+
+class FileCircuitStore:
+    """Circuits shared by processes of the host, stored as JSON in the file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def update(self, key, update):
+        with self._lock, open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            content = f.read()
+            try:
+                circuits = json.loads(content) if content else {}
+            except ValueError:
+                logger.warning('Circuit breaker state file %s is corrupted, reset it', self.path)
+                circuits = {}
+            circuit = dict(circuits.get(key) or {})
+            result = update(circuit)
+            if circuit != circuits.get(key, {}):
+                circuits[key] = circuit
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(circuits))
+                f.flush()
+            return result
+
+
+class CircuitBreaker:
+    def __init__(self, store=None, failure_threshold=5, reset_timeout=30):
+        self.store = store or MemoryCircuitStore()
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+    @staticmethod
+    def get_host(url):
+        return urlparse(url or '').netloc
+
+    def get_deferral(self, host):
+        """
+        Return None if delivery to the host may be attempted now, otherwise seconds to defer it for.
+        Deferral is spread over additional random seconds, so deferred jobs don't all come back at once
+        """
+        retry_after = self.store.update(host, self._allow)
+        if retry_after is None:
+            return None
+        delay = math.ceil(retry_after) + random.randint(0, max(1, self.reset_timeout // 2))
+        return min(delay, MAX_DEFERRAL_SECONDS)
+
+    def record_response(self, host, response=None):
+        """Record delivery result, no response means request failed; server errors and 429 are failures too"""
+        if response is None or response.status_code >= 500 or response.status_code == 429:
+            self.record_failure(host)
+        else:
+            self.record_success(host)
+
+    def record_success(self, host):
+        self.store.update(host, lambda circuit: self._succeeded(host, circuit))
+
+    def record_failure(self, host):
+        self.store.update(host, lambda circuit: self._failed(host, circuit))
+
+    def get_state(self, host):
+        return self.store.update(host, lambda circuit: circuit.get('state', CLOSED))
+
+    def _allow(self, circuit):
+        state = circuit.get('state', CLOSED)
+        if state == CLOSED:
+            return None
+        now = time.time()
+        if state == OPEN:
+            retry_after = circuit['opened_at'] + self.reset_timeout - now
+            if retry_after > 0:
+                return retry_after
+        else:
+            # probe is in flight, let it finish or time out
+            retry_after = circuit['probe_started_at'] + self.reset_timeout - now
+            if retry_after > 0:
+                return retry_after
+        circuit.update(state=HALF_OPEN, probe_started_at=now)
+        return None
+
+    @staticmethod
+    def _succeeded(host, circuit):
+        if circuit.get('state', CLOSED) != CLOSED:
+            logger.info('Circuit of %s is closed', host)
+        circuit.clear()
+
+    def _failed(self, host, circuit):
+        state = circuit.get('state', CLOSED)
+        failures = circuit.get('failures', 0) + 1
+        if state == HALF_OPEN or (state == CLOSED and failures >= self.failure_threshold):
+            logger.warning('Circuit of %s is open after %d failure(s) in a row', host, failures)
+            circuit.clear()
+            circuit.update(state=OPEN, opened_at=time.time(), failures=failures)
+        else:
+            circuit['failures'] = failures
+
+
+def create_circuit_breaker(config):
+    """Create circuit breaker from config, None if it's disabled"""
+    if not config['CIRCUIT_BREAKER_FAILURE_THRESHOLD']:
+        return None
+    state_file = config['CIRCUIT_BREAKER_STATE_FILE']
+    return CircuitBreaker(
+        store=FileCircuitStore(state_file) if state_file else MemoryCircuitStore(),
+        failure_threshold=config['CIRCUIT_BREAKER_FAILURE_THRESHOLD'],
+        reset_timeout=config['CIRCUIT_BREAKER_RESET_TIMEOUT'],
+    )
@@ -1,74 +1,434 @@
 import logging
+import signal
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-from flask_script import Command
-from libtrustbridge.websub import repos
-from libtrustbridge.websub.processors import Processor
+from flask_script import Command, Option
 
-from api import use_cases
-from api.repos import ChannelRepo, ChannelQueueRepo
+from api import metrics, use_cases
+from api.circuit_breaker import create_circuit_breaker
+from api.http_client import HttpClient
+from api.models import MessageStatus
+from api.repos import DeadLetterRepo
+from api.timeline import create_message_timeline
+
+# modules used by a single command (supervisor, delivery engine, subscription index, importtime)
+# are imported by it, so every command loads only what it runs
 
 logger = logging.getLogger(__name__)
 
 
 class RunProcessorCommand(Command):
+    """
+    Run use case over its source queue.
+
+    With --workers N the processor is run in N forked processes by the supervisor,
+    with --threads M each process runs M threads processing the queue.
+    SIGTERM/SIGINT stop the processor after jobs in flight are done.
+
+    If METRICS_PORT is set, every worker process serves its metrics on METRICS_PORT + worker index.
+    """
+
+    option_list = (
+        Option('--workers', dest='workers', type=int, default=None, help='Number of worker processes'),
+        Option('--threads', dest='threads', type=int, default=None, help='Number of threads per worker process'),
+    )
 
     def __call__(self, app=None, *args, **kwargs):
         self.app = app
+        self.stop_event = threading.Event()
         return super().__call__(app, *args, **kwargs)
 
-    def run(self):
-        logger.info('Starting processor %s', self.__class__.__name__)
-        processor = self.get_processor()
-        logger.info('Run processor for use case "%s"', processor.use_case.__class__.__name__)
+    def run(self, workers=None, threads=None):
+        config = self.app.config
+        workers = workers or config['PROCESSOR_WORKERS']
+        threads = threads or config['PROCESSOR_THREADS']
+        logger.info('Starting processor %s, workers: %d, threads: %d', self.__class__.__name__, workers, threads)
+
+        if workers > 1:
+            from api.supervisor import Supervisor
+
+            self.supervisor = Supervisor(
+                target=lambda: self.run_forked_worker(threads),
+                workers=workers,
+                stop=self.stop,
+                graceful_timeout=config['PROCESSOR_GRACEFUL_TIMEOUT'],
+            )
+            self.supervisor.run()
+            return
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: self.stop())
+        self.start_metrics_server()
+        self.run_worker(threads)
 
-        for result in processor:
-            if result is None:
+    def stop(self):
+        logger.info('Stopping processor %s', self.__class__.__name__)
+        self.stop_event.set()
+
+    def run_forked_worker(self, threads):
+        # connections must not be shared with the parent process
+        self.app.repos.reset()
+        self.app.http_client = HttpClient.from_config(self.app.config)
+        self.start_metrics_server(self.supervisor.worker_index)
+        self.run_worker(threads)
+
+    def start_metrics_server(self, worker_index=0):
+        port = self.app.config['METRICS_PORT']
+        if port:
+            metrics.start_http_server(port + worker_index)
+
+    def run_worker(self, threads):
+        use_case = self.get_use_case()
+        logger.info('Run processor for use case "%s"', use_case.__class__.__name__)
+        if threads == 1:
+            self.process_queue(use_case)
+            return
+
+        workers = [threading.Thread(target=self.process_queue, args=(use_case,)) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        # join with timeout, so signals are still handled by the main thread
+        while any(worker.is_alive() for worker in workers):
+            for worker in workers:
+                worker.join(1)
+
+    def process_queue(self, use_case):
+        max_messages = self.app.config['QUEUE_MAX_MESSAGES']
+        wait_seconds = self.app.config['QUEUE_WAIT_SECONDS']
+        job_timeout = self.app.config['QUEUE_JOB_TIMEOUT']
+        use_case_name = use_case.__class__.__name__
+        while not self.stop_event.is_set():
+            try:
+                received = use_case.execute_batch(
+                    max_messages=max_messages, wait_seconds=wait_seconds, job_timeout=job_timeout
+                )
+                metrics.PROCESSOR_RECEIVES.inc(use_case=use_case_name)
+                metrics.PROCESSOR_JOBS.inc(received, use_case=use_case_name)
+                if not received:
+                    metrics.PROCESSOR_EMPTY_RECEIVES.inc(use_case=use_case_name)
+            except Exception as e:
+                logger.exception(e)
                 time.sleep(1)
 
-    def get_processor(self):
+    def get_use_case(self):
         raise NotImplementedError
 
 
 class RunSendMessageProcessorCommand(RunProcessorCommand):
-    def get_processor(self):
-        config = self.app.config
-        channel_repo = ChannelRepo(config['CHANNEL_REPO_CONF'])
-        channel_queue_repo = ChannelQueueRepo(config['CHANNEL_QUEUE_REPO_CONF'])
-        use_case = use_cases.ProcessMessageUseCase(channel_repo, channel_queue_repo, config['FOREIGN_ENDPOINT_URL'])
-        return Processor(use_case=use_case)
+    def get_use_case(self):
+        return use_cases.ProcessMessageUseCase(
+            self.app.repos.channel, self.app.repos.channel_queue, self.app.config['FOREIGN_ENDPOINT_URL'],
+            http_client=self.app.http_client,
+            timeline=create_message_timeline(self.app.config, self.app.repos),
+            circuit_breaker=create_circuit_breaker(self.app.config),
+            dead_letter_repo=self.app.repos.dead_letters,
+        )
 
 
 class RunCallbackSpreaderProcessorCommand(RunProcessorCommand):
     """
     Convert each incoming message to set of messages containing (websub_url, message)
     so they may be sent and fail separately
+
+    Subscriptions are looked up in the in-process index unless SUBSCRIPTIONS_INDEX_TTL is 0
     """
 
-    def get_processor(self):
+    def get_use_case(self):
         config = self.app.config
-        notifications_repo = repos.NotificationsRepo(config['NOTIFICATIONS_REPO_CONF'])
-        delivery_outbox_repo = repos.DeliveryOutboxRepo(config['DELIVERY_OUTBOX_REPO_CONF'])
-        subscriptions_repo = repos.SubscriptionsRepo(config.get('SUBSCRIPTIONS_REPO_CONF'))
-        use_case = use_cases.DispatchMessageToSubscribersUseCase(
-            notifications_repo=notifications_repo,
-            delivery_outbox_repo=delivery_outbox_repo,
-            subscriptions_repo=subscriptions_repo,
+        subscription_index = None
+        if config['SUBSCRIPTIONS_INDEX_TTL']:
+            from api.subscription_index import SubscriptionIndex
+
+            subscription_index = SubscriptionIndex(
+                self.app.repos.subscriptions,
+                ttl=config['SUBSCRIPTIONS_INDEX_TTL'],
+                marker_check_interval=config['SUBSCRIPTIONS_INDEX_MARKER_CHECK_INTERVAL'],
+            )
+        return use_cases.DispatchMessageToSubscribersUseCase(
+            notifications_repo=self.app.repos.notifications,
+            delivery_outbox_repo=self.app.repos.delivery_outbox,
+            subscriptions_repo=self.app.repos.subscriptions,
+            subscription_index=subscription_index,
         )
-        return Processor(use_case=use_case)
 
 
 class RunCallbackDeliveryProcessorCommand(RunProcessorCommand):
     """
     Iterate over the DeliverCallbackUseCase.
+
+    With --concurrency N deliveries are run concurrently by the asyncio delivery engine,
+    which shares them fairly between callback hosts (see AsyncDeliveryEngine)
     """
 
-    def get_processor(self):
+    option_list = RunProcessorCommand.option_list + (
+        Option('--concurrency', dest='concurrency', type=int, default=None,
+               help='Number of deliveries in flight, 0 means one by one'),
+        Option('--per-host-concurrency', dest='per_host_concurrency', type=int, default=None,
+               help='Number of deliveries in flight to a single callback host'),
+        Option('--per-host-rate', dest='per_host_rate', type=float, default=None,
+               help='Deliveries per second to a single callback host, 0 means unlimited'),
+    )
+
+    def run(self, workers=None, threads=None, concurrency=None, per_host_concurrency=None, per_host_rate=None):
         config = self.app.config
-        delivery_outbox_repo = repos.DeliveryOutboxRepo(config['DELIVERY_OUTBOX_REPO_CONF'])
+        self.concurrency = concurrency
+        if self.concurrency is None:
+            self.concurrency = config['CALLBACK_DELIVERY_CONCURRENCY']
+        self.per_host_concurrency = per_host_concurrency
+        if self.per_host_concurrency is None:
+            self.per_host_concurrency = config['CALLBACK_DELIVERY_PER_HOST_CONCURRENCY']
+        self.per_host_rate = per_host_rate
+        if self.per_host_rate is None:
+            self.per_host_rate = config['CALLBACK_DELIVERY_PER_HOST_RATE']
+        self.engine = None
+        return super().run(workers, threads)
+
+    def run_worker(self, threads):
+        if not self.concurrency:
+            return super().run_worker(threads)
+
+        from api.delivery import AsyncDeliveryEngine
+
+        http_client = HttpClient.from_config(self.app.config, pool_maxsize=self.per_host_concurrency)
+        self.engine = AsyncDeliveryEngine(
+            self.get_use_case(http_client),
+            concurrency=self.concurrency,
+            per_host_concurrency=self.per_host_concurrency,
+            wait_seconds=self.app.config['QUEUE_WAIT_SECONDS'],
+            per_host_rate=self.per_host_rate,
+            lane_size=self.app.config['CALLBACK_DELIVERY_LANE_SIZE'],
+            job_timeout=self.app.config['QUEUE_JOB_TIMEOUT'],
+        )
+        if self.stop_event.is_set():
+            return
+        self.engine.run()
+
+    def stop(self):
+        super().stop()
+        if self.engine:
+            self.engine.stop()
+
+    def get_use_case(self, http_client=None):
+        return use_cases.DeliverCallbackUseCase(
+            delivery_outbox_repo=self.app.repos.delivery_outbox,
+            hub_url=self.app.config['HUB_URL'],
+            http_client=http_client or self.app.http_client,
+            timeline=create_message_timeline(self.app.config, self.app.repos),
+            circuit_breaker=create_circuit_breaker(self.app.config),
+            dead_letter_repo=self.app.repos.dead_letters,
+        )
+
+
+class RunSubscriptionVerifierProcessorCommand(RunProcessorCommand):
+    """
+    Verify intent of subscription requests queued by the API (WEBSUB_ASYNC_VERIFICATION)
+    and subscribe/unsubscribe verified ones
+    """
+
+    def get_use_case(self):
+        return use_cases.VerifySubscriptionIntentUseCase(
+            subscriptions_repo=self.app.repos.subscriptions,
+            http_client=self.app.http_client,
+            verification_queue_repo=self.app.repos.subscription_verifications,
+        )
+
+
+class MigrateMessageLayoutCommand(Command):
+    """
+    Move stored messages to the key layout configured by CHANNEL_REPO_KEY_LAYOUT.
 
-        use_case = use_cases.DeliverCallbackUseCase(
-            delivery_outbox_repo=delivery_outbox_repo,
-            hub_url=config['HUB_URL'],
+    Objects are moved in parallel, objects which are already in place are skipped,
+    so the command can be interrupted and run again to resume the migration
+    """
+
+    option_list = (
+        Option('--workers', dest='workers', type=int, default=16, help='Number of objects moved in parallel'),
+    )
+
+    PROGRESS_LOG_INTERVAL = 10000
+
+    def __call__(self, app=None, *args, **kwargs):
+        self.app = app
+        return super().__call__(app, *args, **kwargs)
+
+    def run(self, workers=16):
+        channel_repo = self.app.repos.channel
+        logger.info('Migrating messages to "%s" key layout, workers: %d', channel_repo.key_layout, workers)
+        counters = {'checked': 0, 'moved': 0, 'failed': 0}
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = set()
+            for path in channel_repo.iter_message_paths():
+                futures.add(executor.submit(channel_repo.migrate_message_object, path))
+                if len(futures) >= workers * 10:
+                    done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                    self._count(done, counters)
+            self._count(futures, counters)
+
+        logger.info(
+            'Migration finished, checked: %(checked)d, moved: %(moved)d, failed: %(failed)d', counters
         )
-        return Processor(use_case=use_case)
+        if counters['failed']:
+            logger.error('Some messages were not moved, run the command again to retry them')
+
+    def _count(self, futures, counters):
+        for future in futures:
+            counters['checked'] += 1
+            try:
+                if future.result():
+                    counters['moved'] += 1
+            except Exception as e:
+                logger.exception(e)
+                counters['failed'] += 1
+            if counters['checked'] % self.PROGRESS_LOG_INTERVAL == 0:
+                logger.info('Checked %(checked)d messages, moved %(moved)d', counters)
+
+
+class RedriveDeadLettersCommand(Command):
+    """
+    Re-enqueue jobs from the dead letters (see DeadLetterRepo) as new first attempts:
+    messages to the channel queue (their status is set back to received),
+    callbacks to the delivery outbox.
+
+    Entries are read in parallel and enqueued in batches of up to 10 jobs,
+    at most --rate jobs per second, so the queues and the foreign endpoint
+    are not flooded after a long outage. Entries are deleted once their jobs are enqueued,
+    so the command can be interrupted and run again to resume.
+    """
+
+    option_list = (
+        Option('--kind', dest='kinds', action='append', choices=DeadLetterRepo.KINDS, default=None,
+               help='Kind of dead letters to redrive, all kinds by default'),
+        Option('--rate', dest='rate', type=float, default=100, help='Max jobs enqueued per second, 0 means unlimited'),
+        Option('--workers', dest='workers', type=int, default=16, help='Number of entries read in parallel'),
+        Option('--limit', dest='limit', type=int, default=0, help='Max jobs per kind, 0 means all'),
+        Option('--dry-run', dest='dry_run', action='store_true', default=False,
+               help='Only count dead letters, enqueue nothing'),
+    )
+
+    BATCH_SIZE = 10
+
+    def __call__(self, app=None, *args, **kwargs):
+        self.app = app
+        return super().__call__(app, *args, **kwargs)
+
+    def run(self, kinds=None, rate=100, workers=16, limit=0, dry_run=False):
+        dead_letters = self.app.repos.dead_letters
+        self.rate = rate
+        self._next_batch_at = time.monotonic()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for kind in kinds or DeadLetterRepo.KINDS:
+                counters = {'found': 0, 'enqueued': 0, 'failed': 0}
+                logger.info('Redrive %s dead letters%s', kind, ' (dry run)' if dry_run else '')
+                keys = []
+                for key in dead_letters.iter_keys(kind):
+                    if limit and counters['found'] >= limit:
+                        break
+                    counters['found'] += 1
+                    if dry_run:
+                        continue
+                    keys.append(key)
+                    if len(keys) >= self.BATCH_SIZE * workers:
+                        self._redrive(executor, kind, keys, counters)
+                        keys = []
+                if keys:
+                    self._redrive(executor, kind, keys, counters)
+                logger.info(
+                    'Redrive of %s finished, found: %d, enqueued: %d, failed: %d',
+                    kind, counters['found'], counters['enqueued'], counters['failed']
+                )
+                if counters['failed']:
+                    logger.error('Some %s dead letters were not redriven, run the command again to retry them', kind)
+
+    def _redrive(self, executor, kind, keys, counters):
+        dead_letters = self.app.repos.dead_letters
+        entries = list(executor.map(self._get_entry, keys))
+        for offset in range(0, len(keys), self.BATCH_SIZE):
+            batch = [
+                (key, entry) for key, entry in zip(
+                    keys[offset:offset + self.BATCH_SIZE], entries[offset:offset + self.BATCH_SIZE]
+                )
+                if entry is not None
+            ]
+            counters['failed'] += min(self.BATCH_SIZE, len(keys) - offset) - len(batch)
+            if not batch:
+                continue
+            self._wait_for_rate(len(batch))
+            if kind == 'messages':
+                failed = self._enqueue_messages(executor, [entry['job'] for key, entry in batch])
+            else:
+                failed = self.app.repos.delivery_outbox.post_jobs(
+                    [{'s': entry['job']['s'], 'payload': entry['job']['payload'], 'retry': 1} for key, entry in batch]
+                )
+            enqueued = [key for index, (key, entry) in enumerate(batch) if index not in failed]
+            for index, error in failed.items():
+                logger.error('Enqueueing dead letter %s failed: %s', batch[index][0], error)
+            dead_letters.delete_entries(enqueued)
+            counters['enqueued'] += len(enqueued)
+            counters['failed'] += len(failed)
+
+    def _get_entry(self, key):
+        try:
+            return self.app.repos.dead_letters.get_entry(key)
+        except Exception as e:
+            logger.error('Reading dead letter %s failed: %r', key, e)
+            return None
+
+    def _enqueue_messages(self, executor, jobs):
+        """Returns dict of job index -> error for the jobs which were not enqueued"""
+        message_ids = [job['message_id'] for job in jobs]
+        failed = {
+            index: error for index, error in enumerate(executor.map(self._reset_status, message_ids)) if error
+        }
+        enqueue_failed = self.app.repos.channel_queue.enqueue_many(
+            [message_id for index, message_id in enumerate(message_ids) if index not in failed]
+        )
+        for index, message_id in enumerate(message_ids):
+            if index not in failed and message_id in enqueue_failed:
+                failed[index] = enqueue_failed[message_id]
+        return failed
+
+    def _reset_status(self, message_id):
+        """Set status of the message back to received, returns error if it failed"""
+        try:
+            self.app.repos.channel.update_status(message_id, MessageStatus.RECEIVED)
+        except Exception as e:
+            return repr(e)
+        return None
+
+    def _wait_for_rate(self, jobs):
+        if not self.rate:
+            return
+        delay = self._next_batch_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self._next_batch_at = max(self._next_batch_at, time.monotonic()) + jobs / self.rate
+
+
+class ImportTimeReportCommand(Command):
+    """
+    Report import time of the modules, measured by -X importtime in a fresh interpreter (see api.importtime):
+    total time, the slowest top level packages and modules.
+    By default reports the entry points: the app factory, the views (imported only by the web app),
+    the commands and the Lambda handlers
+    """
+
+    DEFAULT_MODULES = ('api.app', 'api.views', 'api.commands', 'api.lambda_handlers')
+
+    option_list = (
+        Option('--module', dest='modules', action='append', default=None,
+               help='Module to import, may be given several times'),
+        Option('--top', dest='top', type=int, default=15, help='Number of packages and modules listed'),
+        Option('--sort', dest='sort', choices=('cumulative', 'self'), default='cumulative',
+               help='Sort modules by time including their imports or by their own time'),
+    )
+
+    def run(self, modules=None, top=15, sort='cumulative'):
+        from api import importtime
+
+        for module in modules or self.DEFAULT_MODULES:
+            statement = 'import %s' % module
+            print(importtime.format_report(statement, importtime.measure_imports(statement), top=top, sort=sort))
+            print()
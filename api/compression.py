@@ -0,0 +1,71 @@
+"""
+Codecs for stored messages compression.
+
+zstd needs optional `zstandard` package, gzip is always available.
+"""
+import gzip
+import zlib
+
+
+class GzipCodec:
+    name = 'gzip'
+    DEFAULT_LEVEL = 6
+
+    def __init__(self, level=None):
+        self.level = level or self.DEFAULT_LEVEL
+
+    def compress(self, data):
+        return gzip.compress(data, compresslevel=self.level)
+
+    def decompress(self, data):
+        return gzip.decompress(data)
+
+    def compressobj(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def decompressobj(self):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+class ZstdCodec:
+    name = 'zstd'
+    DEFAULT_LEVEL = 3
+
+    def __init__(self, level=None):
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError('zstd compression requires "zstandard" package to be installed') from e
+        self.zstandard = zstandard
+        self.level = level or self.DEFAULT_LEVEL
+
+    def compress(self, data):
+        # compressor/decompressor objects are not thread-safe, so they are not shared
+        return self.zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress(self, data):
+        # streamed frames (see compressobj) don't have content size, so decompressobj reads them
+        return self.zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+    def compressobj(self):
+        return self.zstandard.ZstdCompressor(level=self.level).compressobj()
+
+    def decompressobj(self):
+        return self.zstandard.ZstdDecompressor().decompressobj()
+
+
+CODECS = {
+    GzipCodec.name: GzipCodec,
+    ZstdCodec.name: ZstdCodec,
+}
+
+
+def get_codec(name, level=None):
+    """Return codec by name, None if name is empty (no compression)"""
+    if not name:
+        return None
+    try:
+        codec_class = CODECS[name]
+    except KeyError:
+        raise ValueError('Unknown compression "%s", expected one of: %s' % (name, ', '.join(CODECS)))
+    return codec_class(level)
@@ -1,6 +1,9 @@
 from decouple import config
 from libtrustbridge.utils.conf import env_s3_config, env_queue_config
 
+# subscriptions endpoint, HUB_URL is SERVICE_URL joined with it
+HUB_PATH = '/messages/subscriptions/by_jurisdiction'
+
 
 class Config:
     DEBUG = config('DEBUG', default=True, cast=bool)
@@ -10,13 +13,86 @@ class Config:
     JURISDICTION = config("JURISDICTION", default='AU')
     SERVICE_URL = config("SERVICE_URL", default='http://api-channel')
     FOREIGN_ENDPOINT_URL = config("FOREIGN_ENDPOINT_URL", default='http://foreign-api-channel/incoming/messages')
+    # max messages of POST /messages/batch and max ids of POST /messages/fetch
+    MESSAGES_BATCH_MAX_SIZE = config('MESSAGES_BATCH_MAX_SIZE', default=1000, cast=int)
+    # concurrent repo reads of POST /messages/fetch
+    MESSAGES_FETCH_CONCURRENCY = config('MESSAGES_FETCH_CONCURRENCY', default=10, cast=int)
+    # request bodies from this size are streamed to the repo and GET /messages/<id> streams stored messages,
+    # 0 - disabled; parts of the multipart upload are MESSAGES_STREAMING_PART_SIZE (min 5 MB)
+    MESSAGES_STREAMING_MIN_BYTES = config('MESSAGES_STREAMING_MIN_BYTES', default=0, cast=int)
+    MESSAGES_STREAMING_PART_SIZE = config('MESSAGES_STREAMING_PART_SIZE', default=8 * 1024 * 1024, cast=int)
 
     CHANNEL_REPO_CONF = env_s3_config('CHANNEL_REPO')
+    # gzip, zstd (requires zstandard, see requirements.optional.txt) or empty to store messages uncompressed,
+    # 0 - codec default level
+    CHANNEL_REPO_COMPRESSION = config('CHANNEL_REPO_COMPRESSION', default='')
+    CHANNEL_REPO_COMPRESSION_LEVEL = config('CHANNEL_REPO_COMPRESSION_LEVEL', default=0, cast=int)
+    # flat or hash, see ChannelRepo; existing messages can be moved by migrate_message_layout command
+    CHANNEL_REPO_KEY_LAYOUT = config('CHANNEL_REPO_KEY_LAYOUT', default='flat')
+    # ChannelRepo.get_message cache, disabled when max bytes are 0
+    MESSAGE_CACHE_MAX_BYTES = config('MESSAGE_CACHE_MAX_BYTES', default=0, cast=int)
+    MESSAGE_CACHE_DISK_DIR = config('MESSAGE_CACHE_DISK_DIR', default='')
+    MESSAGE_CACHE_DISK_MAX_BYTES = config('MESSAGE_CACHE_DISK_MAX_BYTES', default=0, cast=int)
+    MESSAGE_CACHE_TTL = config('MESSAGE_CACHE_TTL', default=10, cast=int)
+    # record stage events of every message, see api.timeline
+    MESSAGE_TIMELINE_ENABLED = config('MESSAGE_TIMELINE_ENABLED', default=False, cast=bool)
     CHANNEL_QUEUE_REPO_CONF = env_queue_config('CHANNEL_QUEUE_REPO')
+    # messages with jobs up to this size are put into the channel queue job itself, 0 - disabled
+    CHANNEL_QUEUE_INLINE_MAX_BYTES = config('CHANNEL_QUEUE_INLINE_MAX_BYTES', default=0, cast=int)
 
     SUBSCRIPTIONS_REPO_CONF = env_s3_config('SUBSCRIPTIONS_REPO')
+    # callback spreader subscription index, 0 - read subscriptions from the repo for every notification
+    SUBSCRIPTIONS_INDEX_TTL = config('SUBSCRIPTIONS_INDEX_TTL', default=300, cast=int)
+    SUBSCRIPTIONS_INDEX_MARKER_CHECK_INTERVAL = config('SUBSCRIPTIONS_INDEX_MARKER_CHECK_INTERVAL', default=5, cast=int)
     NOTIFICATIONS_REPO_CONF = env_queue_config('NOTIFICATIONS_REPO')
+    SUBSCRIPTION_VERIFICATION_QUEUE_REPO_CONF = env_queue_config('SUBSCRIPTION_VERIFICATION_QUEUE_REPO')
+    # answer subscription requests with 202 at once and verify intent by run_subscription_verifier processor
+    WEBSUB_ASYNC_VERIFICATION = config('WEBSUB_ASYNC_VERIFICATION', default=False, cast=bool)
     DELIVERY_OUTBOX_REPO_CONF = env_queue_config('DELIVERY_OUTBOX_REPO')
+    REPOS_WARM_UP = config('REPOS_WARM_UP', default=True, cast=bool)
+    # service - MinIO/ElasticMQ, local - objects and SQLite queues in LOCAL_BACKEND_DIR, see api.backends
+    REPOS_BACKEND = config('REPOS_BACKEND', default='service')
+    LOCAL_BACKEND_DIR = config('LOCAL_BACKEND_DIR', default='/tmp/api-channel')
+
+    # processors receive up to QUEUE_MAX_MESSAGES (max 10) jobs per call,
+    # waiting for them up to QUEUE_WAIT_SECONDS (max 20)
+    QUEUE_MAX_MESSAGES = config('QUEUE_MAX_MESSAGES', default=10, cast=int)
+    QUEUE_WAIT_SECONDS = config('QUEUE_WAIT_SECONDS', default=20, cast=int)
+    # max seconds of processing a single job (the HTTP timeouts and the repo calls), received jobs
+    # are processed one by one, so they stay hidden from other workers for QUEUE_MAX_MESSAGES times it
+    # (the delivery engine hides them for the wait in the lane of their host, see AsyncDeliveryEngine);
+    # 0 - the queue default visibility timeout is used
+    QUEUE_JOB_TIMEOUT = config('QUEUE_JOB_TIMEOUT', default=15, cast=int)
+
+    # processor worker processes/threads, see RunProcessorCommand
+    PROCESSOR_WORKERS = config('PROCESSOR_WORKERS', default=1, cast=int)
+    PROCESSOR_THREADS = config('PROCESSOR_THREADS', default=1, cast=int)
+    PROCESSOR_GRACEFUL_TIMEOUT = config('PROCESSOR_GRACEFUL_TIMEOUT', default=60, cast=int)
+
+    # outbound HTTP (foreign endpoint, subscriber callbacks, intent verification)
+    HTTP_CONNECT_TIMEOUT = config('HTTP_CONNECT_TIMEOUT', default=3.05, cast=float)
+    HTTP_READ_TIMEOUT = config('HTTP_READ_TIMEOUT', default=10, cast=float)
+    HTTP_POOL_CONNECTIONS = config('HTTP_POOL_CONNECTIONS', default=10, cast=int)
+    HTTP_POOL_MAXSIZE = config('HTTP_POOL_MAXSIZE', default=10, cast=int)
+    HTTP_POOL_BLOCK = config('HTTP_POOL_BLOCK', default=True, cast=bool)
+
+    # circuit breaker of foreign endpoint and callback hosts, see api.circuit_breaker; 0 failures - disabled,
+    # state file is shared by processor workers, empty - every process keeps its own state
+    CIRCUIT_BREAKER_FAILURE_THRESHOLD = config('CIRCUIT_BREAKER_FAILURE_THRESHOLD', default=0, cast=int)
+    CIRCUIT_BREAKER_RESET_TIMEOUT = config('CIRCUIT_BREAKER_RESET_TIMEOUT', default=30, cast=int)
+    CIRCUIT_BREAKER_STATE_FILE = config('CIRCUIT_BREAKER_STATE_FILE', default='')
+
+    # 0 - deliver callbacks one by one, N - deliver up to N callbacks concurrently
+    CALLBACK_DELIVERY_CONCURRENCY = config('CALLBACK_DELIVERY_CONCURRENCY', default=0, cast=int)
+    CALLBACK_DELIVERY_PER_HOST_CONCURRENCY = config('CALLBACK_DELIVERY_PER_HOST_CONCURRENCY', default=10, cast=int)
+    # deliveries per second to a single callback host, 0 - unlimited
+    CALLBACK_DELIVERY_PER_HOST_RATE = config('CALLBACK_DELIVERY_PER_HOST_RATE', default=0, cast=float)
+    # jobs waiting for a single callback host, the rest are deferred back to the outbox; 0 - unlimited,
+    # keep it well below CALLBACK_DELIVERY_CONCURRENCY, which also limits jobs waiting in all lanes
+    CALLBACK_DELIVERY_LANE_SIZE = config('CALLBACK_DELIVERY_LANE_SIZE', default=20, cast=int)
+
+    # processors serve metrics on METRICS_PORT (+ worker index for forked workers), 0 - disabled
+    METRICS_PORT = config('METRICS_PORT', default=0, cast=int)
 
     LOG_FORMATTER_JSON = False
 
@@ -0,0 +1,249 @@
+import asyncio
+import collections
+import logging
+import math
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from api import metrics
+from api.use_cases import DeliverCallbackUseCase
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncDeliveryEngine:
+    """
+    Runs many DeliverCallbackUseCase deliveries at once in a single process.
+
+    The loop keeps fetching jobs from the delivery outbox (in batches, long polling)
+    while there is spare capacity and schedules each one as a task. The use case itself
+    is blocking (requests, boto), so every job is processed by use_case.process in
+    a thread pool; retry, delete and back off behaviour stays exactly the same as
+    in the sequential processor.
+
+    Fetched jobs wait in lanes per callback host, deliveries are started round-robin
+    over the lanes, one job per host in turn. A host with a big backlog or slow responses
+    gets at most per_host_concurrency deliveries in flight (and per_host_rate deliveries
+    per second), so it doesn't hold jobs of other hosts behind it. Jobs which don't fit
+    into the full lane of their host are deferred back to the outbox (DeliverCallbackUseCase.defer),
+    instead of waiting in memory while their visibility timeout runs out.
+
+    With job_timeout jobs are received hidden long enough to wait behind a full lane of their host
+    (see get_visibility_timeout), and a job is deferred instead of started or queued if its delivery
+    might not finish before it becomes visible again, which would deliver it twice.
+
+    concurrency - max number of deliveries in flight, also max number of jobs waiting in lanes
+    per_host_concurrency - max number of deliveries in flight to a single callback host
+    per_host_rate - max deliveries per second to a single callback host, 0 - unlimited
+    lane_size - max number of jobs waiting for a single callback host, 0 - unlimited
+    job_timeout - max seconds of a single delivery, 0 - the queue default visibility timeout is used
+    """
+
+    MAX_MESSAGES = 10
+    ERROR_SLEEP_SECONDS = 1
+    DEFER_SECONDS = 10
+
+    def __init__(
+            self, use_case: DeliverCallbackUseCase, concurrency=100, per_host_concurrency=10, wait_seconds=20,
+            per_host_rate=0, lane_size=0, job_timeout=0):
+        self.use_case = use_case
+        self.concurrency = concurrency
+        self.per_host_concurrency = per_host_concurrency
+        self.per_host_rate = per_host_rate
+        self.lane_size = lane_size
+        self.wait_seconds = wait_seconds
+        self.job_timeout = job_timeout
+        self.visibility_timeout = self.get_visibility_timeout() if job_timeout else None
+        self._stopped = False
+        self._lanes = {}
+        self._hosts = collections.deque()
+        self._queued = 0
+        self._in_flight = {}
+        self._rate_buckets = {}
+
+    def get_visibility_timeout(self):
+        """
+        Seconds a received job may wait in its lane and be delivered: the jobs ahead of it
+        in the lane are delivered per_host_concurrency at once and at most per_host_rate per second
+        """
+        lane_size = self.lane_size or self.concurrency
+        timeout = (math.ceil(lane_size / self.per_host_concurrency) + 1) * self.job_timeout
+        if self.per_host_rate:
+            timeout += lane_size / self.per_host_rate
+        return timeout
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.run_async())
+        finally:
+            loop.close()
+
+    def stop(self):
+        self._stopped = True
+
+    async def run_async(self):
+        loop = asyncio.get_event_loop()
+        executor = ThreadPoolExecutor(max_workers=self.concurrency + 2)
+        tasks = set()
+        fetch = None
+
+        logger.info(
+            'Start async delivery, concurrency: %d, per host concurrency: %d, per host rate: %s',
+            self.concurrency, self.per_host_concurrency, self.per_host_rate or 'unlimited'
+        )
+        try:
+            while True:
+                if fetch is None and not self._stopped and self._queued < self.concurrency:
+                    max_messages = min(self.concurrency - self._queued, self.MAX_MESSAGES)
+                    fetch = loop.run_in_executor(executor, self._get_jobs, max_messages)
+
+                rate_wait = self._dispatch(loop, executor, tasks)
+                pending = set(tasks)
+                if fetch is not None:
+                    pending.add(fetch)
+                if not pending:
+                    if self._stopped and not self._queued:
+                        break
+                    await asyncio.sleep(rate_wait or self.ERROR_SLEEP_SECONDS)
+                    continue
+
+                await asyncio.wait(pending, timeout=rate_wait, return_when=asyncio.FIRST_COMPLETED)
+                if fetch is not None and fetch.done():
+                    jobs, deadline = fetch.result()
+                    for job in jobs:
+                        self._queue(loop, executor, tasks, job, deadline)
+                    fetch = None
+        finally:
+            if tasks:
+                logger.info('Waiting for %d deliveries in flight', len(tasks))
+                await asyncio.wait(tasks)
+            executor.shutdown(wait=True)
+
+    def _queue(self, loop, executor, tasks, job, deadline):
+        """Put the job to the lane of its host, deadline - monotonic time the job becomes visible again"""
+        host = self._get_host(job)
+        lane = self._lanes.get(host)
+        if self.lane_size and lane and len(lane) >= self.lane_size:
+            self._defer(loop, executor, tasks, job, host, 'lane_full')
+            return
+        if self._is_late(deadline, self._get_expected_wait(lane)):
+            self._defer(loop, executor, tasks, job, host, 'visibility_timeout')
+            return
+        if lane is None:
+            lane = self._lanes[host] = collections.deque()
+            self._hosts.append(host)
+        lane.append((job, deadline))
+        self._queued += 1
+
+    def _defer(self, loop, executor, tasks, job, host, reason):
+        queue_msg_id, payload = job
+        delay = self.DEFER_SECONDS + random.randint(0, self.DEFER_SECONDS)
+        logger.info('[%s] delivery to %s deferred for %ds, %s', queue_msg_id, host, delay, reason)
+        self._start(loop, tasks, executor, self.use_case.defer, queue_msg_id, payload, delay)
+        metrics.DEFERRALS.inc(use_case=self.use_case.__class__.__name__, reason=reason)
+
+    def _get_expected_wait(self, lane):
+        """Seconds a job added to the lane waits for the jobs ahead of it"""
+        ahead = len(lane) if lane else 0
+        wait = ahead // self.per_host_concurrency * self.job_timeout
+        if self.per_host_rate:
+            wait += ahead / self.per_host_rate
+        return wait
+
+    def _is_late(self, deadline, wait=0):
+        """The job might become visible again before its delivery, started after wait, finishes"""
+        return deadline is not None and time.monotonic() + wait + self.job_timeout > deadline
+
+    def _dispatch(self, loop, executor, tasks):
+        """
+        Start deliveries of queued jobs round-robin over the hosts which have free slots,
+        returns seconds until the next delivery allowed by the host rate, None if no lane waits for it
+        """
+        rate_wait = None
+        skipped = 0
+        while self._hosts and len(tasks) < self.concurrency and skipped < len(self._hosts):
+            host = self._hosts[0]
+            self._hosts.rotate(-1)
+            if self._in_flight.get(host, 0) >= self.per_host_concurrency:
+                skipped += 1
+                continue
+            wait = self._take_rate_token(host)
+            if wait:
+                rate_wait = wait if rate_wait is None else min(rate_wait, wait)
+                skipped += 1
+                continue
+
+            lane = self._lanes[host]
+            job, deadline = lane.popleft()
+            self._queued -= 1
+            if not lane:
+                del self._lanes[host]
+                self._hosts.remove(host)
+            if self._is_late(deadline):
+                self._defer(loop, executor, tasks, job, host, 'visibility_timeout')
+                continue
+            queue_msg_id, payload = job
+            self._in_flight[host] = self._in_flight.get(host, 0) + 1
+            task = self._start(loop, tasks, executor, self.use_case.process, queue_msg_id, payload)
+            task.add_done_callback(lambda task, host=host: self._release(host))
+            skipped = 0
+        return rate_wait
+
+    def _start(self, loop, tasks, executor, func, *args):
+        task = loop.create_task(self._run_job(loop, executor, func, *args))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return task
+
+    def _release(self, host):
+        self._in_flight[host] -= 1
+        if not self._in_flight[host]:
+            del self._in_flight[host]
+
+    def _take_rate_token(self, host):
+        """Token bucket of the host, returns 0 if the delivery may start now, otherwise seconds to wait"""
+        if not self.per_host_rate:
+            return 0
+        now = time.monotonic()
+        burst = max(1.0, self.per_host_rate)
+        tokens, updated_at = self._rate_buckets.get(host, (burst, now))
+        tokens = min(burst, tokens + (now - updated_at) * self.per_host_rate)
+        if tokens >= 1:
+            self._rate_buckets[host] = (tokens - 1, now)
+            return 0
+        self._rate_buckets[host] = (tokens, now)
+        return (1 - tokens) / self.per_host_rate
+
+    @staticmethod
+    async def _run_job(loop, executor, func, *args):
+        try:
+            await loop.run_in_executor(executor, func, *args)
+        except Exception as e:
+            logger.exception(e)
+
+    def _get_jobs(self, max_messages):
+        """Returns received jobs and monotonic time they become visible again, None if unknown"""
+        use_case_name = self.use_case.__class__.__name__
+        try:
+            jobs = self.use_case.delivery_outbox.get_jobs(
+                max_messages=max_messages, wait_seconds=self.wait_seconds, visibility_timeout=self.visibility_timeout
+            )
+        except Exception as e:
+            logger.exception(e)
+            time.sleep(self.ERROR_SLEEP_SECONDS)
+            return [], None
+        # the queue started the visibility timeout a moment earlier, when it sent the jobs
+        deadline = time.monotonic() + self.visibility_timeout if self.visibility_timeout else None
+        metrics.PROCESSOR_RECEIVES.inc(use_case=use_case_name)
+        metrics.PROCESSOR_JOBS.inc(len(jobs), use_case=use_case_name)
+        if not jobs:
+            metrics.PROCESSOR_EMPTY_RECEIVES.inc(use_case=use_case_name)
+        return jobs, deadline
+
+    @staticmethod
+    def _get_host(job):
+        queue_msg_id, payload = job
+        return urlparse(payload.get('s') or '').netloc
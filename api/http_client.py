@@ -0,0 +1,73 @@
+import logging
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class HttpClient:
+    """
+    Outbound HTTP client shared by use cases and views.
+
+    Wraps a single requests session, so connections (and TLS sessions) to the same host
+    are kept alive and reused. The per-host pool is bounded, with pool_block=True
+    callers wait for a free connection instead of opening new ones.
+    Every request gets (connect, read) timeouts unless given explicitly.
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, pool_block=True, connect_timeout=3.05, read_timeout=10):
+        self.timeout = (connect_timeout, read_timeout)
+        self.adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block)
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        options = dict(
+            pool_connections=config['HTTP_POOL_CONNECTIONS'],
+            pool_maxsize=config['HTTP_POOL_MAXSIZE'],
+            pool_block=config['HTTP_POOL_BLOCK'],
+            connect_timeout=config['HTTP_CONNECT_TIMEOUT'],
+            read_timeout=config['HTTP_READ_TIMEOUT'],
+        )
+        options.update(kwargs)
+        return cls(**options)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, params=None, **kwargs):
+        return self.request('GET', url, params=params, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        return self.request('POST', url, data=data, json=json, **kwargs)
+
+    def stats(self):
+        """
+        Pool usage per host:
+            connections - connections opened so far
+            requests - requests made through the pool
+            in_use - connections currently checked out
+            maxsize - pool size
+        """
+        pools = self.adapter.poolmanager.pools
+        stats = {}
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            maxsize = pool.pool.maxsize if pool.pool else 0
+            idle = pool.pool.qsize() if pool.pool else 0
+            stats[f'{key.key_scheme}://{key.key_host}:{key.key_port}'] = {
+                'connections': pool.num_connections,
+                'requests': pool.num_requests,
+                'in_use': maxsize - idle,
+                'maxsize': maxsize,
+            }
+        return stats
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,68 @@
+"""
+Import time of modules, measured by the interpreter's -X importtime in a fresh process,
+so nothing is imported in advance. Lines of its output look like:
+
+    import time: self [us] | cumulative | imported package
+    import time:       466 |       1348 | encodings
+    import time:        38 |         38 |     _codecs
+
+the indentation of the name shows nesting of imports.
+"""
+import collections
+import re
+import subprocess
+import sys
+
+IMPORT_TIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)\s*$')
+
+ModuleImport = collections.namedtuple('ModuleImport', 'name self_us cumulative_us depth')
+
+
+def measure_imports(statement, python=None, env=None):
+    """
+    Run the import statement (e.g. "import api.app") in a new interpreter,
+    returns list of ModuleImport in the order imports finished
+    """
+    result = subprocess.run(
+        [python or sys.executable, '-X', 'importtime', '-c', statement],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, env=env,
+    )
+    imports = []
+    errors = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_RE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            imports.append(ModuleImport(name, int(self_us), int(cumulative_us), len(indent) // 2))
+        elif not line.startswith('import time:'):
+            errors.append(line)
+    if result.returncode:
+        raise RuntimeError('"%s" failed:\n%s' % (statement, '\n'.join(errors[-20:])))
+    return imports
+
+
+def get_packages(imports):
+    """Self time of the imports summed by top level package, returns list of (package, us, modules count)"""
+    packages = collections.OrderedDict()
+    for module in imports:
+        package = module.name.split('.')[0]
+        total, count = packages.get(package, (0, 0))
+        packages[package] = (total + module.self_us, count + 1)
+    return sorted(
+        ((package, total, count) for package, (total, count) in packages.items()),
+        key=lambda item: item[1], reverse=True
+    )
+
+
+def format_report(statement, imports, top=15, sort='cumulative'):
+    """Text report: total time and module count, the slowest top level packages and modules"""
+    total_us = sum(module.self_us for module in imports)
+    lines = ['%s: %.1f ms, %d modules' % (statement, total_us / 1000, len(imports)), '', 'packages (self ms, modules):']
+    for package, package_us, count in get_packages(imports)[:top]:
+        lines.append('  %-40s %9.1f %6d' % (package, package_us / 1000, count))
+
+    key = (lambda module: module.self_us) if sort == 'self' else (lambda module: module.cumulative_us)
+    lines.extend(['', 'modules (self ms, cumulative ms):'])
+    for module in sorted(imports, key=key, reverse=True)[:top]:
+        lines.append('  %-60s %9.1f %9.1f' % (module.name, module.self_us / 1000, module.cumulative_us / 1000))
+    return '\n'.join(lines)
@@ -0,0 +1,155 @@
+"""
+AWS Lambda handlers of the processors, for SQS event source mappings
+with ReportBatchItemFailures enabled:
+
+    api.lambda_handlers.send_message - channel queue, ProcessMessageUseCase
+    api.lambda_handlers.spread_callbacks - notifications queue, DispatchMessageToSubscribersUseCase
+    api.lambda_handlers.deliver_callbacks - delivery outbox, DeliverCallbackUseCase
+
+Records of the event are processed by the use case one by one, the same way the processor
+commands process received jobs (the use case deletes the job and enqueues its retry itself).
+Records which raised are reported as batch item failures, so only they return to the queue.
+Records which wouldn't finish before the invocation times out are reported without being started,
+as timed out invocation returns the whole batch, including already processed records.
+
+Cold start: the module imports only the standard library and no Flask app is created.
+Config, repos, HTTP client and use cases are created by the first invocation
+and reused by the following invocations of the same execution environment.
+"""
+import json
+import logging
+from urllib.parse import urljoin
+
+logger = logging.getLogger(__name__)
+
+
+class Processors:
+    """Config, repos and use cases of the execution environment, created on first use"""
+
+    def __init__(self, config=None):
+        self._config = config
+        self._repos = None
+        self._http_client = None
+        self._use_cases = {}
+
+    @property
+    def config(self):
+        if self._config is None:
+            from api import loggers
+            from api.conf import HUB_PATH, Config
+
+            config = {name: getattr(Config, name) for name in dir(Config) if name.isupper()}
+            config.setdefault('HUB_URL', urljoin(config['SERVICE_URL'], HUB_PATH))
+            loggers.init_sentry(config.get('SENTRY_DSN'))
+            self._config = config
+        return self._config
+
+    @property
+    def repos(self):
+        if self._repos is None:
+            from api.repos import RepoRegistry
+
+            self._repos = RepoRegistry(self.config)
+        return self._repos
+
+    @property
+    def http_client(self):
+        if self._http_client is None:
+            from api.http_client import HttpClient
+
+            self._http_client = HttpClient.from_config(self.config)
+        return self._http_client
+
+    def get_use_case(self, name):
+        use_case = self._use_cases.get(name)
+        if use_case is None:
+            logger.debug('create use case %s', name)
+            use_case = self._use_cases[name] = getattr(self, '_create_%s' % name)()
+        return use_case
+
+    def _create_send_message(self):
+        from api import use_cases
+        from api.circuit_breaker import create_circuit_breaker
+        from api.timeline import create_message_timeline
+
+        return use_cases.ProcessMessageUseCase(
+            self.repos.channel, self.repos.channel_queue, self.config['FOREIGN_ENDPOINT_URL'],
+            http_client=self.http_client,
+            timeline=create_message_timeline(self.config, self.repos),
+            circuit_breaker=create_circuit_breaker(self.config),
+            dead_letter_repo=self.repos.dead_letters,
+        )
+
+    def _create_spread_callbacks(self):
+        from api import use_cases
+        from api.subscription_index import SubscriptionIndex
+
+        subscription_index = None
+        if self.config['SUBSCRIPTIONS_INDEX_TTL']:
+            subscription_index = SubscriptionIndex(
+                self.repos.subscriptions,
+                ttl=self.config['SUBSCRIPTIONS_INDEX_TTL'],
+                marker_check_interval=self.config['SUBSCRIPTIONS_INDEX_MARKER_CHECK_INTERVAL'],
+            )
+        return use_cases.DispatchMessageToSubscribersUseCase(
+            notifications_repo=self.repos.notifications,
+            delivery_outbox_repo=self.repos.delivery_outbox,
+            subscriptions_repo=self.repos.subscriptions,
+            subscription_index=subscription_index,
+        )
+
+    def _create_deliver_callbacks(self):
+        from api import use_cases
+        from api.circuit_breaker import create_circuit_breaker
+        from api.timeline import create_message_timeline
+
+        return use_cases.DeliverCallbackUseCase(
+            delivery_outbox_repo=self.repos.delivery_outbox,
+            hub_url=self.config['HUB_URL'],
+            http_client=self.http_client,
+            timeline=create_message_timeline(self.config, self.repos),
+            circuit_breaker=create_circuit_breaker(self.config),
+            dead_letter_repo=self.repos.dead_letters,
+        )
+
+    def get_time_reserve_ms(self):
+        """Time a record may take, it's not started with less time remaining"""
+        return (self.config['HTTP_CONNECT_TIMEOUT'] + self.config['HTTP_READ_TIMEOUT']) * 1000
+
+
+processors = Processors()
+
+
+def process_records(use_case, event, context=None, time_reserve_ms=0):
+    """Process SQS records of the event by the use case, returns the partial batch response"""
+    failures = []
+    records = event.get('Records', [])
+    for index, record in enumerate(records):
+        if context is not None and context.get_remaining_time_in_millis() < time_reserve_ms:
+            logger.warning('Not enough time left for %d record(s), return them to the queue', len(records) - index)
+            failures.extend({'itemIdentifier': skipped['messageId']} for skipped in records[index:])
+            break
+        try:
+            use_case.process(record['receiptHandle'], json.loads(record['body']))
+        except Exception as e:
+            logger.exception(e)
+            failures.append({'itemIdentifier': record['messageId']})
+    return {'batchItemFailures': failures}
+
+
+def _handle(name, event, context):
+    return process_records(
+        processors.get_use_case(name), event, context, time_reserve_ms=processors.get_time_reserve_ms()
+    )
+
+
+def send_message(event, context):
+    return _handle('send_message', event, context)
+
+
+def spread_callbacks(event, context):
+    return _handle('spread_callbacks', event, context)
+
+
+def deliver_callbacks(event, context):
+    return _handle('deliver_callbacks', event, context)
@@ -2,9 +2,6 @@ import logging
 import sys
 from logging.config import dictConfig
 
-import sentry_sdk
-from sentry_sdk.integrations.logging import LoggingIntegration
-
 
 def create_logger(config):
     SENTRY_DSN = config.get('SENTRY_DSN')
@@ -58,15 +55,23 @@ def create_logger(config):
 
     dictConfig(LOGGING)
 
-    if SENTRY_DSN:  # pragma: no cover
+    init_sentry(SENTRY_DSN)
+
+    default_logger = logging.getLogger('api-channel')
+    return default_logger
+
+
+def init_sentry(dsn):
+    """Send warnings and errors to Sentry if DSN is set, sentry_sdk is imported only then"""
+    if dsn:  # pragma: no cover
+        import sentry_sdk
+        from sentry_sdk.integrations.logging import LoggingIntegration
+
         sentry_logging = LoggingIntegration(
             level=logging.WARNING,  # Capture info and above as breadcrumbs
             event_level=logging.WARNING  # Send errors as events
         )
         sentry_sdk.init(
-            dsn=SENTRY_DSN,
+            dsn=dsn,
             integrations=[sentry_logging]
         )
-
-    default_logger = logging.getLogger('api-channel')
-    return default_logger
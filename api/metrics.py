@@ -0,0 +1,315 @@
+"""
+Prometheus-style metrics, rendered in the text exposition format by /metrics view
+and by the processors metrics HTTP server (METRICS_PORT).
+
+Metrics are process-local: forked processor workers serve their own metrics
+on METRICS_PORT + worker index.
+"""
+import functools
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('%s expects labels %s, got %s' % (self.name, self.labelnames, tuple(labels)))
+        return tuple(labels[name] for name in self.labelnames)
+
+    def render(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.documentation),
+            '# TYPE %s %s' % (self.name, self.type),
+        ]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.extend(self._render_value(list(zip(self.labelnames, key)), value))
+        return lines
+
+    def _render_value(self, labels, value):
+        return ['%s%s %s' % (self.name, _format_labels(labels), _format_value(value))]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), 0)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def get(self, **labels):
+        """Return (bucket counts, not cumulative; sum), None if nothing was observed"""
+        return self._values.get(self._key(labels))
+
+    def _render_value(self, labels, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (
+                self.name, _format_labels(labels + [('le', _format_value(float(bound)))]), cumulative
+            ))
+        lines.append('%s_sum%s %s' % (self.name, _format_labels(labels), repr(float(total))))
+        lines.append('%s_count%s %d' % (self.name, _format_labels(labels), cumulative))
+        return lines
+
+
+class Registry:
+    """
+    Metrics of the process. Collectors are callables returning metrics computed on render,
+    as list of (name, type, documentation, [(labels dict, value), ...]);
+    a collector registered with the key of another one replaces it
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def register_collector(self, collector, key=None):
+        with self._lock:
+            self.collectors[key or collector] = collector
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        for collector in list(self.collectors.values()):
+            try:
+                collected = collector()
+            except Exception as e:
+                logger.exception(e)
+                continue
+            for name, metric_type, documentation, samples in collected:
+                lines.append('# HELP %s %s' % (name, documentation))
+                lines.append('# TYPE %s %s' % (name, metric_type))
+                for labels, value in samples:
+                    lines.append('%s%s %s' % (name, _format_labels(sorted(labels.items())), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self.metrics:
+                raise ValueError('Metric %s is already registered' % metric.name)
+            self.metrics[metric.name] = metric
+        return metric
+
+
+registry = Registry()
+
+HTTP_REQUEST_DURATION = registry.histogram(
+    'api_channel_http_request_duration_seconds', 'Duration of API requests', ('view', 'method', 'status')
+)
+USE_CASE_PROCESS_DURATION = registry.histogram(
+    'api_channel_use_case_process_duration_seconds', 'Duration of processing a single job', ('use_case', 'outcome')
+)
+REPO_CALL_DURATION = registry.histogram(
+    'api_channel_repo_call_duration_seconds', 'Duration of MinIO/SQS API calls', ('service', 'operation', 'outcome')
+)
+PROCESSOR_RECEIVES = registry.counter(
+    'api_channel_processor_receives_total', 'Source queue receive calls', ('use_case',)
+)
+PROCESSOR_EMPTY_RECEIVES = registry.counter(
+    'api_channel_processor_empty_receives_total', 'Source queue receive calls which returned no jobs', ('use_case',)
+)
+PROCESSOR_JOBS = registry.counter(
+    'api_channel_processor_jobs_total', 'Jobs received from the source queue', ('use_case',)
+)
+MESSAGE_STAGE_DURATION = registry.histogram(
+    'api_channel_message_stage_seconds', 'Time from the previous stage of the message, see api.timeline',
+    ('stage',), buckets=DEFAULT_BUCKETS + (30, 60, 300, 900)
+)
+RETRIES = registry.counter(
+    'api_channel_retries_total', 'Failed attempts re-scheduled for retry', ('use_case',)
+)
+DROPS = registry.counter(
+    'api_channel_drops_total', 'Jobs given up after the last attempt, see DeadLetterRepo', ('use_case',)
+)
+DEFERRALS = registry.counter(
+    'api_channel_deferrals_total',
+    'Jobs put back to the queue without attempt: circuit_open, lane_full, visibility_timeout',
+    ('use_case', 'reason')
+)
+
+
+def observe_process(process):
+    """Decorator of use case process method, observes its duration labelled by use case class name"""
+
+    @functools.wraps(process)
+    def wrapper(self, *args, **kwargs):
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            result = process(self, *args, **kwargs)
+            outcome = 'ok'
+            return result
+        finally:
+            USE_CASE_PROCESS_DURATION.observe(
+                time.perf_counter() - started, use_case=self.__class__.__name__, outcome=outcome
+            )
+
+    return wrapper
+
+
+def instrument_boto_client(client):
+    """Observe duration of every API call of the boto client, clients without event system are skipped"""
+    events = getattr(getattr(client, 'meta', None), 'events', None)
+    if events is None:
+        return
+
+    # timer is started by before-parameter-build, as before-call handlers may short-circuit each other;
+    # it also keeps the operation names in the context, after-call-error isn't given the model
+    def before_call(model, context, **kwargs):
+        context['metrics_call'] = (model.service_model.service_name, model.name, time.perf_counter())
+
+    def after_call(context, http_response=None, parsed=None, exception=None, **kwargs):
+        call = context.pop('metrics_call', None)
+        if call is None:
+            return
+        service, operation, started = call
+        failed = (
+            exception is not None
+            or (http_response is not None and http_response.status_code >= 400)
+            or (parsed or {}).get('Error')
+        )
+        REPO_CALL_DURATION.observe(
+            time.perf_counter() - started, service=service, operation=operation, outcome='error' if failed else 'ok'
+        )
+
+    events.register('before-parameter-build', before_call, unique_id='api-channel-metrics-before-call')
+    events.register('after-call', after_call, unique_id='api-channel-metrics-after-call')
+    events.register('after-call-error', after_call, unique_id='api-channel-metrics-after-call-error')
+
+
+def init_app(app):
+    """Observe duration of the app views and export HTTP client and message cache stats"""
+    # not imported at module level, so processors and Lambda handlers don't load Flask
+    from flask import g, request
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started_at = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        started = g.pop('metrics_started_at', None)
+        if started is not None:
+            HTTP_REQUEST_DURATION.observe(
+                time.perf_counter() - started,
+                view=request.endpoint or 'unknown', method=request.method, status=response.status_code
+            )
+        return response
+
+    # replaces the collector of the previous app, so apps created by tests and benchmarks aren't kept alive
+    registry.register_collector(functools.partial(collect_app_stats, app), key='app')
+
+
+def collect_app_stats(app):
+    collected = []
+    http_stats = app.http_client.stats()
+    for key, name, metric_type, documentation in (
+            ('connections', 'connections_total', 'counter', 'Connections opened by the outbound HTTP client pool'),
+            ('requests', 'requests_total', 'counter', 'Requests made through the outbound HTTP client pool'),
+            ('in_use', 'in_use', 'gauge', 'Outbound HTTP client pool connections in use')):
+        collected.append((
+            'api_channel_http_client_pool_%s' % name, metric_type, documentation,
+            [({'host': host}, stats[key]) for host, stats in http_stats.items()]
+        ))
+
+    channel_repo = app.repos.get_created('channel')
+    cache = channel_repo.cache if channel_repo else None
+    if cache:
+        cache_stats = cache.stats()
+        collected.extend([
+            ('api_channel_message_cache_hits_total', 'counter', 'Message cache hits per tier',
+             [({'tier': tier}, hits) for tier, hits in cache_stats['hits'].items()]),
+            ('api_channel_message_cache_misses_total', 'counter', 'Message cache misses',
+             [({}, cache_stats['misses'])]),
+            ('api_channel_message_cache_size_bytes', 'gauge', 'Message cache size per tier',
+             [({'tier': tier}, size) for tier, size in cache_stats['size'].items()]),
+        ])
+    return collected
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, host='0.0.0.0'):
+    """Serve metrics in a daemon thread, returns the server"""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logger.info('Serving metrics on %s:%d', host, server.server_address[1])
+    return server
@@ -1,6 +1,5 @@
 import enum
-from dataclasses import dataclass
-from dataclasses_json import dataclass_json
+import json
 
 
 class MessageStatus(str, enum.Enum):
@@ -11,9 +10,45 @@ class MessageStatus(str, enum.Enum):
     UNDELIVERABLE = 'undeliverable'
 
 
-@dataclass_json
-@dataclass
 class Message:
-    message: dict
-    id: str = None
-    status: MessageStatus = MessageStatus.RECEIVED
+    """
+    Channel message: the message document itself, its id and status.
+
+    Serialized by hand instead of dataclass schema machinery, JSON is byte-compatible
+    with messages stored before: {"message": ..., "id": ..., "status": ...}
+    written by json.dumps with default options.
+    """
+
+    __slots__ = ('message', 'id', 'status')
+
+    def __init__(self, message, id=None, status=MessageStatus.RECEIVED):
+        self.message = message
+        self.id = id
+        self.status = status
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return (self.message, self.id, self.status) == (other.message, other.id, other.status)
+
+    def __repr__(self):
+        return 'Message(message=%r, id=%r, status=%r)' % (self.message, self.id, self.status)
+
+    def to_dict(self):
+        return {'message': self.message, 'id': self.id, 'status': self.status}
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    @classmethod
+    def from_dict(cls, data):
+        status = data.get('status')
+        return cls(
+            message=data['message'],
+            id=data.get('id'),
+            status=MessageStatus.RECEIVED if status is None else MessageStatus(status),
+        )
+
+    @classmethod
+    def from_json(cls, data):
+        return cls.from_dict(json.loads(data))
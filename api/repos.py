@@ -1,45 +1,692 @@
+import hashlib
+import json
 import logging
+import math
+import re
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
+from boto3.s3.transfer import TransferConfig
 from libtrustbridge.repos.elasticmqrepo import ElasticMQRepo
 from libtrustbridge.repos.miniorepo import MinioRepo
 from libtrustbridge.utils import get_retry_time
+from libtrustbridge.websub import repos as websub_repos
 
-from api.models import Message
+from api.backends import get_local_repo_class
+from api.cache import create_message_cache
+from api.compression import get_codec
+from api.metrics import instrument_boto_client
+from api.models import Message, MessageStatus
+from api.streaming import MessageUploadReader
 
 logger = logging.getLogger(__name__)
 
+STATUS_TAIL_RE = re.compile(rb'"status": "[a-z_]*"\}\s*$')
+
 
 class ChannelRepo(MinioRepo):
+    """
+    Messages storage, optionally with read-through cache (see api.cache.TieredCache)
+    which is written through on save.
+
+    If compression codec is given (see api.compression), messages are stored compressed
+    and marked with object metadata, so both compressed and plain objects can be read.
+
+    Message object keys follow the key layout:
+        flat - messages/{id}
+        hash - messages/{aa}/{bb}/{id}, where aabb... is sha1 of the id
+    Messages are written using the configured layout and read using it first,
+    then using the other layouts, so messages stored before layout change (and not migrated yet)
+    can still be read.
+
+    Status of the saved message is also kept in the object metadata. Status transitions
+    (update_status) write just a small status record statuses/{id} instead of rewriting the message,
+    the record overrides status of the stored document when it's read. So get_message_status
+    reads the record or object metadata and never downloads the message itself.
+
+    The object can't tell whether the record exists, so reads cost one request more:
+    get_message (not cached) also reads the record, which is missing until the first status change,
+    get_message_status reads the record and, for messages without one, the object head.
+    """
     DEFAULT_BUCKET = 'channel'
+    COMPRESSION_METADATA_KEY = 'compression'
+    STATUS_METADATA_KEY = 'status'
+    MESSAGES_PREFIX = 'messages/'
+    STATUSES_PREFIX = 'statuses/'
+    # max length of the document end: , "status": "undeliverable"}
+    STATUS_TAIL_BYTES = 64
+    KEY_LAYOUTS = ('flat', 'hash')
+
+    def __init__(self, connection_data, cache=None, compression=None, key_layout='flat'):
+        super().__init__(connection_data)
+        if key_layout not in self.KEY_LAYOUTS:
+            raise ValueError('Unknown key layout "%s", expected one of: %s' % (key_layout, ', '.join(self.KEY_LAYOUTS)))
+        self.cache = cache
+        self.compression = compression
+        self.key_layout = key_layout
+        self._codecs = {}
 
     def get_message(self, message_id):
-        path = self._get_message_path(message_id)
-        try:
-            message_json = self.get_object_content(path)
-        except self.client.exceptions.NoSuchKey:
-            logger.warning("Message not found, path: %s", path)
+        """Message with its current status, read by two requests if not cached: the object and the status record"""
+        if self.cache:
+            message_json = self.cache.get(message_id)
+            if message_json is not None:
+                return Message.from_json(message_json)
+
+        for path in self._get_message_paths(message_id):
+            try:
+                message_json = self._get_message_content(path)
+                break
+            except self.client.exceptions.NoSuchKey:
+                continue
+        else:
+            logger.warning("Message not found, id: %s", message_id)
+            return
+        message = Message.from_json(message_json)
+        status = self._get_status_record(message_id)
+        if status and status != message.status:
+            message.status = status
+            message_json = message.to_json()
+        if self.cache:
+            self.cache.set(message_id, message_json)
+        return message
+
+    def get_message_status(self, message_id):
+        """
+        Return status of the message without reading the message itself, None if it doesn't exist.
+        Reads the status record, and the object head if the status was never changed (two requests)
+        """
+        status = self._get_status_record(message_id)
+        if status:
+            return status
+        for path in self._get_message_paths(message_id):
+            try:
+                head = self.client.head_object(Bucket=self.bucket_name, Key=path)
+            except self.client.exceptions.ClientError as e:
+                if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                    raise
+                continue
+            status = head.get('Metadata', {}).get(self.STATUS_METADATA_KEY)
+            if status:
+                return MessageStatus(status)
+            # stored before status metadata was added
+            message = self.get_message(message_id)
+            return message.status if message else None
+        logger.warning("Message not found, id: %s", message_id)
+        return None
+
+    def update_status(self, message_id, status):
+        """Change status of the stored message, the message itself is not rewritten"""
+        self.client.put_object(
+            Bucket=self.bucket_name,
+            Key=self._get_status_path(message_id),
+            Body=json.dumps({'status': status}).encode('utf-8'),
+            ContentType='application/json',
+        )
+        if self.cache:
+            self.cache.delete(message_id)
+
+    def get_messages(self, message_ids, max_workers=10, status_only=False):
+        """
+        Read messages concurrently, yields (message id, message, error) in the order of given ids
+        as soon as the next one is read. Message is None if it's not found or reading failed with error.
+        If status_only, messages are not read, just their statuses (see get_message_status)
+        and message documents are None.
+        """
+        if not message_ids:
             return
-        return Message.from_json(message_json)
+        read = self._get_status_only_message if status_only else self.get_message
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(message_ids))) as executor:
+            futures = [executor.submit(read, message_id) for message_id in message_ids]
+            try:
+                for message_id, future in zip(message_ids, futures):
+                    error = future.exception()
+                    if error:
+                        logger.error("Reading message %s failed: %r", message_id, error)
+                    yield message_id, None if error else future.result(), error
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def _get_status_only_message(self, message_id):
+        status = self.get_message_status(message_id)
+        return Message(message=None, id=message_id, status=status) if status else None
 
     def save_message(self, message):
+        is_new = not message.id
         message.id = message.id or str(uuid.uuid4())
         body = message.to_json()
         path = self._get_message_path(message.id)
-        self.put_object(chunked_path=path, content_body=body)
+        self._put_message_content(path, body, message.status)
+        if not is_new:
+            # status of the saved document is the current one
+            self.client.delete_object(Bucket=self.bucket_name, Key=self._get_status_path(message.id))
+        if self.cache:
+            self.cache.set(message.id, body)
+        return message
+
+    def save_message_stream(self, stream, part_size=8 * 1024 * 1024):
+        """
+        Save new message with the document read from the stream, without loading it to memory:
+        the document is validated on the fly and uploaded in parts of part_size (multipart upload).
+        Raises api.streaming.JSONStructureError if the document is not a valid JSON object.
+        Returns the message with its id and status only, the document itself is not loaded.
+        """
+        message = Message(message=None, id=str(uuid.uuid4()), status=MessageStatus.RECEIVED)
+        extra_args = {'ContentType': 'application/json', 'Metadata': self._get_metadata(message.status)}
+        compressor = None
+        if self.compression:
+            compressor = self.compression.compressobj()
+        reader = MessageUploadReader(stream, message.id, message.status.value, compressor)
+        config = TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size, max_concurrency=2)
+        try:
+            self.client.upload_fileobj(
+                reader, self.bucket_name, self._get_message_path(message.id), ExtraArgs=extra_args, Config=config
+            )
+        except Exception:
+            if reader.error:
+                raise reader.error
+            raise
         return message
 
-    def _get_message_path(self, message_id):
-        return f'messages/{message_id}'
+    def get_message_stream(self, message_id, chunk_size=64 * 1024):
+        """
+        Return iterator over chunks of the stored message JSON, None if message doesn't exist.
+        The object is read and decompressed chunk by chunk. If the status was updated
+        after the message was saved, status at the end of the document is replaced on the fly.
+        """
+        if self.cache:
+            message_json = self.cache.get(message_id)
+            if message_json is not None:
+                return iter([message_json.encode('utf-8') if isinstance(message_json, str) else message_json])
+
+        for path in self._get_message_paths(message_id):
+            try:
+                obj = self.client.get_object(Bucket=self.bucket_name, Key=path)
+                break
+            except self.client.exceptions.NoSuchKey:
+                continue
+        else:
+            logger.warning("Message not found, id: %s", message_id)
+            return None
+        compression = obj.get('Metadata', {}).get(self.COMPRESSION_METADATA_KEY)
+        decompressor = self._get_codec(compression).decompressobj() if compression else None
+        chunks = self._iter_body(obj['Body'], chunk_size, decompressor)
+        status = self._get_status_record(message_id)
+        if status:
+            chunks = self._replace_status(chunks, status)
+        return chunks
+
+    @classmethod
+    def _replace_status(cls, chunks, status):
+        """Replace status at the end of the document, as written by Message.to_json/MessageUploadReader"""
+        tail = b''
+        for chunk in chunks:
+            tail += chunk
+            if len(tail) > cls.STATUS_TAIL_BYTES:
+                yield tail[:-cls.STATUS_TAIL_BYTES]
+                tail = tail[-cls.STATUS_TAIL_BYTES:]
+        replaced, count = STATUS_TAIL_RE.subn(
+            b'"status": ' + json.dumps(status).encode('utf-8') + b'}', tail
+        )
+        if not count:
+            logger.warning("Status not found at the end of the stored message, it's not replaced")
+        yield replaced
+
+    @staticmethod
+    def _iter_body(body, chunk_size, decompressor):
+        try:
+            for chunk in body.iter_chunks(chunk_size):
+                if decompressor:
+                    chunk = decompressor.decompress(chunk)
+                if chunk:
+                    yield chunk
+            if decompressor and hasattr(decompressor, 'flush'):
+                tail = decompressor.flush()
+                if tail:
+                    yield tail
+        finally:
+            body.close()
+
+    def _get_message_content(self, path):
+        obj = self.client.get_object(Bucket=self.bucket_name, Key=path)
+        content = obj['Body'].read()
+        compression = obj.get('Metadata', {}).get(self.COMPRESSION_METADATA_KEY)
+        if compression:
+            content = self._get_codec(compression).decompress(content)
+        return content
+
+    def _put_message_content(self, path, body, status):
+        content = body.encode('utf-8')
+        if self.compression:
+            content = self.compression.compress(content)
+        self.client.put_object(
+            Bucket=self.bucket_name,
+            Key=path,
+            Body=content,
+            ContentLength=len(content),
+            ContentType='application/json',
+            Metadata=self._get_metadata(status),
+        )
+
+    def _get_metadata(self, status):
+        metadata = {self.STATUS_METADATA_KEY: status.value}
+        if self.compression:
+            metadata[self.COMPRESSION_METADATA_KEY] = self.compression.name
+        return metadata
+
+    def _get_status_record(self, message_id):
+        try:
+            content = self.get_object_content(self._get_status_path(message_id))
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return MessageStatus(json.loads(content)['status'])
+
+    def _get_status_path(self, message_id):
+        return f'{self.STATUSES_PREFIX}{message_id}'
+
+    def _get_codec(self, name):
+        if self.compression and self.compression.name == name:
+            return self.compression
+        if name not in self._codecs:
+            self._codecs[name] = get_codec(name)
+        return self._codecs[name]
+
+    def iter_message_paths(self, page_size=1000):
+        """Iterate over keys of all stored message objects, whatever layout they are stored in"""
+        paginator = self.client.get_paginator('list_objects_v2')
+        pages = paginator.paginate(
+            Bucket=self.bucket_name, Prefix=self.MESSAGES_PREFIX, PaginationConfig={'PageSize': page_size}
+        )
+        for page in pages:
+            for obj in page.get('Contents', []):
+                yield obj['Key']
+
+    # failed If-Match/If-None-Match of the object store
+    PRECONDITION_ERRORS = ('PreconditionFailed', '412', 'ConditionalRequestConflict', '409')
+
+    def migrate_message_object(self, path):
+        """
+        Move message object to the path of the configured key layout,
+        returns False if it's not moved (already there, or left for the next run).
+
+        The message may be written to the target path by save_message at any time, that copy is newer:
+        the object is copied only if the target doesn't exist (If-None-Match) and only if it's still
+        the version seen before (its ETag), and deleted only if it still has that ETag.
+        ETag is also re-checked before the delete, for stores which ignore the conditional headers
+        """
+        message_id = path.rsplit('/', 1)[-1]
+        target_path = self._get_message_path(message_id)
+        if path == target_path:
+            return False
+
+        source = self._head_object(path)
+        if source is None:
+            # moved by a concurrent run
+            return False
+        if self._head_object(target_path) is None:
+            try:
+                self.client.copy_object(
+                    Bucket=self.bucket_name, Key=target_path, CopySource={'Bucket': self.bucket_name, 'Key': path},
+                    CopySourceIfMatch=source['ETag'], IfNoneMatch='*',
+                )
+            except self.client.exceptions.ClientError as e:
+                if e.response['Error']['Code'] not in self.PRECONDITION_ERRORS:
+                    raise
+                logger.info('Message object %s or its target was written while migrating it', path)
+
+        current = self._head_object(path)
+        if current is None or current['ETag'] != source['ETag'] or self._head_object(target_path) is None:
+            logger.warning('Message object %s changed while migrating it, left for the next run', path)
+            return False
+        try:
+            self.client.delete_object(Bucket=self.bucket_name, Key=path, IfMatch=source['ETag'])
+        except self.client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in self.PRECONDITION_ERRORS:
+                raise
+            logger.warning('Message object %s changed while migrating it, left for the next run', path)
+            return False
+        return True
+
+    def _head_object(self, path):
+        """Object head, None if it doesn't exist"""
+        try:
+            return self.client.head_object(Bucket=self.bucket_name, Key=path)
+        except self.client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                raise
+            return None
+
+    def _get_message_path(self, message_id, key_layout=None):
+        key_layout = key_layout or self.key_layout
+        if key_layout == 'hash':
+            digest = hashlib.sha1(message_id.encode('utf-8')).hexdigest()
+            return f'{self.MESSAGES_PREFIX}{digest[:2]}/{digest[2:4]}/{message_id}'
+        return f'{self.MESSAGES_PREFIX}{message_id}'
+
+    def _get_message_paths(self, message_id):
+        """Paths to look the message up, configured layout first"""
+        layouts = [self.key_layout] + [layout for layout in self.KEY_LAYOUTS if layout != self.key_layout]
+        return [self._get_message_path(message_id, layout) for layout in layouts]
+
+
+class MessageTimelineRepo(MinioRepo):
+    """
+    Stage events of messages, see api.timeline.MessageTimeline.
+
+    Every event is a separate object timelines/{message_id}/{timestamp}-{stage}-{random},
+    so processes recording events of the same message never overwrite each other
+    """
+    DEFAULT_BUCKET = 'channel'
+    TIMELINES_PREFIX = 'timelines/'
+
+    def add_event(self, message_id, event):
+        key = '%s%s/%017.6f-%s-%s' % (
+            self.TIMELINES_PREFIX, message_id, event['at'], event['stage'], uuid.uuid4().hex[:8]
+        )
+        self.put_object(chunked_path=key, content_body=json.dumps(event))
+
+    def get_events(self, message_id):
+        """Return events of the message ordered by time"""
+        paginator = self.client.get_paginator('list_objects_v2')
+        pages = paginator.paginate(Bucket=self.bucket_name, Prefix='%s%s/' % (self.TIMELINES_PREFIX, message_id))
+        events = []
+        for page in pages:
+            for obj in page.get('Contents', []):
+                events.append(json.loads(self.get_object_content(obj['Key'])))
+        return sorted(events, key=lambda event: event['at'])
+
 
+class DeadLetterRepo(MinioRepo):
+    """
+    Jobs given up after the last attempt, to be re-enqueued later (redrive_dead_letters command).
+
+    Every entry is a separate object dead-letters/{kind}/{timestamp}-{random}, kinds are
+    messages (channel queue jobs) and callbacks (delivery outbox jobs), entries are listed oldest first
+    """
+    DEFAULT_BUCKET = 'channel'
+    DEAD_LETTERS_PREFIX = 'dead-letters/'
+    KINDS = ('messages', 'callbacks')
+    MAX_DELETE_KEYS = 1000
+
+    def add(self, kind, job, reason=None):
+        if kind not in self.KINDS:
+            raise ValueError('Unknown dead letter kind "%s", expected one of: %s' % (kind, ', '.join(self.KINDS)))
+        failed_at = time.time()
+        key = '%s%s/%017.6f-%s' % (self.DEAD_LETTERS_PREFIX, kind, failed_at, uuid.uuid4().hex[:8])
+        entry = {'kind': kind, 'job': job, 'reason': reason, 'failed_at': failed_at}
+        self.put_object(chunked_path=key, content_body=json.dumps(entry))
+        return key
+
+    def iter_keys(self, kind, page_size=1000):
+        paginator = self.client.get_paginator('list_objects_v2')
+        pages = paginator.paginate(
+            Bucket=self.bucket_name, Prefix='%s%s/' % (self.DEAD_LETTERS_PREFIX, kind),
+            PaginationConfig={'PageSize': page_size}
+        )
+        for page in pages:
+            for obj in page.get('Contents', []):
+                yield obj['Key']
+
+    def get_entry(self, key):
+        return json.loads(self.get_object_content(key))
+
+    def delete_entries(self, keys):
+        for offset in range(0, len(keys), self.MAX_DELETE_KEYS):
+            chunk = keys[offset:offset + self.MAX_DELETE_KEYS]
+            self.client.delete_objects(
+                Bucket=self.bucket_name, Delete={'Objects': [{'Key': key} for key in chunk], 'Quiet': True}
+            )
+
+
+class BatchReceiveMixin:
+    """
+    Receive several jobs per call, waiting for them up to wait_seconds (SQS long polling),
+    so idle workers block on the queue instead of polling it
+    """
+    MAX_RECEIVE_MESSAGES = 10
+    MAX_VISIBILITY_TIMEOUT = 12 * 60 * 60
+
+    def get_jobs(self, max_messages=MAX_RECEIVE_MESSAGES, wait_seconds=0, visibility_timeout=None):
+        """Visibility timeout (seconds) of the received jobs overrides the queue default if given"""
+        kwargs = {}
+        if visibility_timeout:
+            kwargs['VisibilityTimeout'] = min(int(math.ceil(visibility_timeout)), self.MAX_VISIBILITY_TIMEOUT)
+        response = self.sqs_client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=min(max_messages, self.MAX_RECEIVE_MESSAGES),
+            WaitTimeSeconds=wait_seconds,
+            **kwargs
+        )
+        return [(msg['ReceiptHandle'], json.loads(msg['Body'])) for msg in response.get('Messages', [])]
+
+
+class SubscriptionsRepo(websub_repos.SubscriptionsRepo):
+    CHANGE_MARKER_PATH = '.index/changed'
+
+    def mark_changed(self):
+        """Write new change marker, so in-process subscription indexes know they should reload"""
+        self.put_object(chunked_path=self.CHANGE_MARKER_PATH, content_body=str(uuid.uuid4()))
+
+    def get_change_marker(self):
+        try:
+            return self.get_object_content(self.CHANGE_MARKER_PATH)
+        except self.client.exceptions.NoSuchKey:
+            return None
+
+
+class NotificationsRepo(BatchReceiveMixin, websub_repos.NotificationsRepo):
+    pass
+
+
+class DeliveryOutboxRepo(BatchReceiveMixin, websub_repos.DeliveryOutboxRepo):
+    MAX_BATCH_SIZE = 10
+
+    def post_jobs(self, jobs, delay_seconds=0):
+        """
+        Post jobs using SQS batch sends (up to 10 entries per call),
+        returns dict of job index -> error for the jobs which were not posted
+        """
+        failed = {}
+        for offset in range(0, len(jobs), self.MAX_BATCH_SIZE):
+            chunk = jobs[offset:offset + self.MAX_BATCH_SIZE]
+            entries = [
+                {'Id': str(index), 'MessageBody': json.dumps(job), 'DelaySeconds': delay_seconds}
+                for index, job in enumerate(chunk)
+            ]
+            try:
+                response = self.sqs_client.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            except Exception as e:
+                logger.exception(e)
+                failed.update({offset + index: str(e) for index in range(len(chunk))})
+                continue
+            for failure in response.get('Failed', []):
+                failed[offset + int(failure['Id'])] = failure.get('Message') or failure.get('Code')
+        return failed
+
+
+class SubscriptionVerificationQueueRepo(BatchReceiveMixin, ElasticMQRepo):
+    """Subscribe/unsubscribe requests waiting for asynchronous intent verification"""
+
+    def _get_queue_name(self):
+        return 'subscription-verifications'
+
+
+class ChannelQueueRepo(BatchReceiveMixin, ElasticMQRepo):
+    """
+    Queue of messages to send.
+
+    When message is given to enqueue and its job is not bigger than inline_max_bytes,
+    the message itself is put into the job, so the processor doesn't have to read it from the repo
+    """
+    MAX_BATCH_SIZE = 10
+
+    def __init__(self, connection_data, inline_max_bytes=0):
+        super().__init__(connection_data)
+        self.inline_max_bytes = inline_max_bytes
 
-class ChannelQueueRepo(ElasticMQRepo):
     def _get_queue_name(self):
         return 'channel-messages'
 
-    def enqueue(self, message_id, attempt=1):
+    def enqueue(self, message_id, attempt=1, message=None, delay_seconds=None):
         logger.debug('enqueue message, message_id: %s', message_id)
-        self.post_job({
+        if delay_seconds is None:
+            delay_seconds = get_retry_time(attempt)
+        self.post_job(self._get_job(message_id, attempt, message), delay_seconds=delay_seconds)
+
+    def enqueue_many(self, message_ids, attempt=1, messages=None):
+        """
+        Enqueue messages using SQS batch sends (up to 10 entries per call),
+        returns dict of message_id -> error for the messages which were not enqueued
+        """
+        messages = messages or [None] * len(message_ids)
+        failed = {}
+        for offset in range(0, len(message_ids), self.MAX_BATCH_SIZE):
+            chunk = message_ids[offset:offset + self.MAX_BATCH_SIZE]
+            chunk_messages = messages[offset:offset + self.MAX_BATCH_SIZE]
+            logger.debug('enqueue messages batch, message_ids: %s', chunk)
+            entries = [
+                {
+                    'Id': str(index),
+                    'MessageBody': json.dumps(self._get_job(message_id, attempt, message)),
+                    'DelaySeconds': get_retry_time(attempt),
+                }
+                for index, (message_id, message) in enumerate(zip(chunk, chunk_messages))
+            ]
+            try:
+                response = self.sqs_client.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            except Exception as e:
+                logger.exception(e)
+                failed.update({message_id: str(e) for message_id in chunk})
+                continue
+            for failure in response.get('Failed', []):
+                failed[chunk[int(failure['Id'])]] = failure.get('Message') or failure.get('Code')
+        return failed
+
+    def _get_job(self, message_id, attempt, message=None):
+        job = {
             'message_id': message_id,
             'retry': attempt,
-        }, delay_seconds=get_retry_time(attempt))
+            'enqueued_at': time.time(),
+        }
+        if message is not None and self.inline_max_bytes:
+            inline_job = dict(job, message=message.to_dict())
+            if len(json.dumps(inline_job).encode('utf-8')) <= self.inline_max_bytes:
+                return inline_job
+        return job
+
+
+class RepoRegistry:
+    """
+    Repos created once per application and shared between threads.
+
+    Repo construction creates boto clients and checks that bucket/queue exist,
+    so it must stay out of the request/job hot path. Boto clients are thread-safe,
+    only the construction itself is guarded by the lock.
+    """
+
+    BACKENDS = ('service', 'local')
+
+    def __init__(self, config):
+        self.config = config
+        self.backend = config.get('REPOS_BACKEND') or 'service'
+        if self.backend not in self.BACKENDS:
+            raise ValueError('Unknown repos backend "%s", expected one of: %s' % (self.backend, ', '.join(self.BACKENDS)))
+        self._repos = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, name, factory):
+        repo = self._repos.get(name)
+        if repo is None:
+            with self._lock:
+                repo = self._repos.get(name)
+                if repo is None:
+                    logger.debug('create repo %s', name)
+                    repo = self._repos[name] = factory()
+        return repo
+
+    def _create(self, repo_class, conf_name, **kwargs):
+        connection_data = self.config.get(conf_name)
+        if self.backend == 'local':
+            repo_class = get_local_repo_class(repo_class)
+            connection_data = dict(connection_data or {}, local_root=self.config['LOCAL_BACKEND_DIR'])
+        repo = repo_class(connection_data, **kwargs)
+        instrument_boto_client(getattr(repo, 'client', None))
+        instrument_boto_client(getattr(repo, 'sqs_client', None))
+        return repo
+
+    def get_created(self, name):
+        """Return the repo if it's created already, None otherwise"""
+        return self._repos.get(name)
+
+    @property
+    def channel(self) -> ChannelRepo:
+        return self._get_or_create(
+            'channel',
+            lambda: self._create(
+                ChannelRepo,
+                'CHANNEL_REPO_CONF',
+                cache=create_message_cache(self.config),
+                compression=get_codec(
+                    self.config['CHANNEL_REPO_COMPRESSION'], self.config['CHANNEL_REPO_COMPRESSION_LEVEL']
+                ),
+                key_layout=self.config['CHANNEL_REPO_KEY_LAYOUT'],
+            )
+        )
+
+    @property
+    def channel_queue(self) -> ChannelQueueRepo:
+        return self._get_or_create(
+            'channel_queue',
+            lambda: self._create(
+                ChannelQueueRepo, 'CHANNEL_QUEUE_REPO_CONF', inline_max_bytes=self.config['CHANNEL_QUEUE_INLINE_MAX_BYTES']
+            )
+        )
+
+    @property
+    def subscriptions(self) -> SubscriptionsRepo:
+        return self._get_or_create(
+            'subscriptions', lambda: self._create(SubscriptionsRepo, 'SUBSCRIPTIONS_REPO_CONF')
+        )
+
+    @property
+    def notifications(self) -> NotificationsRepo:
+        return self._get_or_create('notifications', lambda: self._create(NotificationsRepo, 'NOTIFICATIONS_REPO_CONF'))
+
+    @property
+    def delivery_outbox(self) -> DeliveryOutboxRepo:
+        return self._get_or_create(
+            'delivery_outbox', lambda: self._create(DeliveryOutboxRepo, 'DELIVERY_OUTBOX_REPO_CONF')
+        )
+
+    @property
+    def subscription_verifications(self) -> SubscriptionVerificationQueueRepo:
+        return self._get_or_create(
+            'subscription_verifications',
+            lambda: self._create(SubscriptionVerificationQueueRepo, 'SUBSCRIPTION_VERIFICATION_QUEUE_REPO_CONF')
+        )
+
+    @property
+    def timeline(self) -> MessageTimelineRepo:
+        return self._get_or_create('timeline', lambda: self._create(MessageTimelineRepo, 'CHANNEL_REPO_CONF'))
+
+    @property
+    def dead_letters(self) -> DeadLetterRepo:
+        return self._get_or_create('dead_letters', lambda: self._create(DeadLetterRepo, 'CHANNEL_REPO_CONF'))
+
+    def warm_up(self):
+        """Create all repos, so connections are opened and buckets/queues are checked at startup"""
+        names = ['channel', 'channel_queue', 'subscriptions', 'notifications', 'delivery_outbox']
+        if self.config['WEBSUB_ASYNC_VERIFICATION']:
+            names.append('subscription_verifications')
+        if self.config['MESSAGE_TIMELINE_ENABLED']:
+            names.append('timeline')
+        for name in names:
+            getattr(self, name)
+
+    def reset(self):
+        """Drop created repos, e.g. in forked process which must not share connections with parent"""
+        with self._lock:
+            self._repos = {}
@@ -0,0 +1,229 @@
+"""
+Streaming of big messages from request body to the object storage,
+so the whole document is never held in memory (see ChannelRepo.save_message_stream).
+"""
+import codecs
+import json
+import re
+
+
+class JSONStructureError(ValueError):
+    pass
+
+
+class JsonObjectValidator:
+    """
+    Incremental validator of JSON document which must be an object.
+
+    Checks UTF-8 encoding and JSON syntax of the chunks given to feed(),
+    close() checks the document is complete. Only the nesting stack and partial tokens
+    are kept between chunks, so memory used doesn't depend on the document size.
+    Like strict JSON it doesn't accept NaN/Infinity.
+    """
+
+    MAX_SCALAR_LENGTH = 1024
+
+    # expected next token
+    OBJECT = 'object'
+    VALUE = 'value'
+    VALUE_OR_END = 'value or ]'
+    KEY = 'key'
+    KEY_OR_END = 'key or }'
+    COLON = ':'
+    COMMA_OR_END = ', or end of container'
+    DONE = 'end of document'
+
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+    STRING_CONTENT = re.compile(r'[^"\\\x00-\x1f]*')
+    SCALAR = re.compile(r'[0-9a-zA-Z+\-.]*')
+    NUMBER = re.compile(r'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?')
+    LITERALS = ('true', 'false', 'null')
+    SIMPLE_ESCAPES = '"\\/bfnrt'
+    HEX_DIGITS = re.compile(r'[0-9a-fA-F]{4}')
+
+    def __init__(self):
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._stack = []
+        self._expect = self.OBJECT
+        self._in_string = False
+        self._string_is_key = False
+        self._carry = ''
+        self._position = 0
+
+    def feed(self, chunk):
+        try:
+            text = self._decoder.decode(chunk)
+        except UnicodeDecodeError as e:
+            raise JSONStructureError('Invalid UTF-8: %s' % e) from e
+        self._process(text, final=False)
+
+    def close(self):
+        try:
+            text = self._decoder.decode(b'', final=True)
+        except UnicodeDecodeError as e:
+            raise JSONStructureError('Invalid UTF-8: %s' % e) from e
+        self._process(text, final=True)
+        if self._expect != self.DONE:
+            raise JSONStructureError('Unexpected end of document, expected %s' % self._expect)
+
+    def _process(self, text, final):
+        if self._carry:
+            text = self._carry + text
+            self._carry = ''
+        length = len(text)
+        i = 0
+        while i < length:
+            if self._in_string:
+                i = self._scan_string(text, i, final)
+                if i is None:
+                    break
+                continue
+
+            char = text[i]
+            if char in ' \t\n\r':
+                i = self.WHITESPACE.match(text, i).end()
+            elif char == '"':
+                if self._expect in (self.KEY, self.KEY_OR_END):
+                    self._string_is_key = True
+                else:
+                    self._expect_value(char, i)
+                    self._string_is_key = False
+                self._in_string = True
+                i += 1
+            elif char in '{[':
+                if not (self._expect == self.OBJECT and char == '{'):
+                    self._expect_value(char, i)
+                self._stack.append(char)
+                self._expect = self.KEY_OR_END if char == '{' else self.VALUE_OR_END
+                i += 1
+            elif char in '}]':
+                opening = '{' if char == '}' else '['
+                allowed = (self.KEY_OR_END if char == '}' else self.VALUE_OR_END, self.COMMA_OR_END)
+                if self._expect not in allowed or not self._stack or self._stack[-1] != opening:
+                    self._error(char, i)
+                self._stack.pop()
+                self._after_value()
+                i += 1
+            elif char == ':':
+                if self._expect != self.COLON:
+                    self._error(char, i)
+                self._expect = self.VALUE
+                i += 1
+            elif char == ',':
+                if self._expect != self.COMMA_OR_END:
+                    self._error(char, i)
+                self._expect = self.KEY if self._stack[-1] == '{' else self.VALUE
+                i += 1
+            elif char in '-0123456789tfn':
+                self._expect_value(char, i)
+                end = self.SCALAR.match(text, i).end()
+                if end == length and not final:
+                    self._keep(text, i)
+                    break
+                token = text[i:end]
+                if token not in self.LITERALS and not self.NUMBER.fullmatch(token):
+                    self._error(token, i)
+                self._after_value()
+                i = end
+            else:
+                self._error(char, i)
+        self._position += length - len(self._carry)
+
+    def _scan_string(self, text, i, final):
+        """Skip string content, returns index after it or None if the rest of text is kept for the next chunk"""
+        i = self.STRING_CONTENT.match(text, i).end()
+        if i == len(text):
+            return i
+        char = text[i]
+        if char == '"':
+            self._in_string = False
+            if self._string_is_key:
+                self._expect = self.COLON
+            else:
+                self._after_value()
+            return i + 1
+        if char == '\\':
+            escape = text[i + 1:i + 2]
+            if escape and escape in self.SIMPLE_ESCAPES:
+                return i + 2
+            if escape == 'u' and self.HEX_DIGITS.fullmatch(text, i + 2, i + 6):
+                return i + 6
+            if not final and len(text) - i < 6 and (not escape or escape == 'u'):
+                self._keep(text, i)
+                return None
+            self._error(text[i:i + 6], i)
+        self._error('control character %r in string' % char, i)
+
+    def _expect_value(self, char, index):
+        if self._expect not in (self.VALUE, self.VALUE_OR_END):
+            self._error(char, index)
+
+    def _after_value(self):
+        self._expect = self.COMMA_OR_END if self._stack else self.DONE
+
+    def _keep(self, text, index):
+        if len(text) - index > self.MAX_SCALAR_LENGTH:
+            self._error(text[index:index + 20] + '...', index)
+        self._carry = text[index:]
+
+    def _error(self, token, index):
+        raise JSONStructureError('Unexpected %s at position %d, expected %s' % (
+            token, self._position + index, self._expect
+        ))
+
+
+class MessageUploadReader:
+    """
+    File-like object for upload of the message stored by ChannelRepo:
+        {"message": <request body>, "id": "...", "status": "received"}
+    The body is passed through as is, validated on the fly, and optionally compressed.
+    read(size) returns `size` bytes unless the end is reached, as parts of multipart upload
+    must be of the full size. Validation error is kept in `error`, as upload may wrap it.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, stream, message_id, status, compressor=None):
+        self.stream = stream
+        self.compressor = compressor
+        self.validator = JsonObjectValidator()
+        self.error = None
+        self._buffer = bytearray()
+        self._prefix = b'{"message": '
+        self._suffix = (', "id": %s, "status": %s}' % (json.dumps(message_id), json.dumps(status))).encode('utf-8')
+        self._eof = False
+
+    def read(self, size=-1):
+        while not self._eof and (size is None or size < 0 or len(self._buffer) < size):
+            self._fill()
+        if size is None or size < 0 or size >= len(self._buffer):
+            data = bytes(self._buffer)
+            self._buffer.clear()
+        else:
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+        return data
+
+    def _fill(self):
+        data = self._prefix
+        self._prefix = b''
+        chunk = self.stream.read(self.CHUNK_SIZE)
+        try:
+            if chunk:
+                self.validator.feed(chunk)
+            else:
+                self.validator.close()
+        except JSONStructureError as e:
+            self.error = e
+            raise
+        if chunk:
+            data += chunk
+        else:
+            data += self._suffix
+            self._eof = True
+
+        if self.compressor:
+            data = self.compressor.compress(data)
+            if self._eof:
+                data += self.compressor.flush()
+        self._buffer += data
@@ -0,0 +1,60 @@
+import logging
+import threading
+import time
+
+from libtrustbridge.websub.domain import Pattern
+
+from api.repos import SubscriptionsRepo
+
+logger = logging.getLogger(__name__)
+
+
+class SubscriptionIndex:
+    """
+    In-process index of subscriptions by topic, used by the callback spreader
+    instead of reading subscriptions from the repo for every notification.
+
+    Topic entries are loaded on first lookup and reloaded when older than `ttl` seconds.
+    All entries are dropped when the change marker written by subscription
+    register/deregister use cases changes; the marker is checked at most once
+    per `marker_check_interval` seconds.
+    """
+
+    def __init__(self, subscriptions_repo: SubscriptionsRepo, ttl=300, marker_check_interval=5):
+        self.subscriptions_repo = subscriptions_repo
+        self.ttl = ttl
+        self.marker_check_interval = marker_check_interval
+        self._entries = {}
+        self._marker = None
+        self._marker_checked_at = None
+        self._lock = threading.Lock()
+
+    def get_subscriptions(self, topic):
+        self._check_marker()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(topic)
+        if entry and now - entry[0] < self.ttl:
+            return entry[1]
+
+        logger.debug('load subscriptions for the topic %s', topic)
+        subscriptions = self.subscriptions_repo.get_subscriptions_by_pattern(Pattern(topic))
+        with self._lock:
+            self._entries[topic] = (now, subscriptions)
+        return subscriptions
+
+    def invalidate(self):
+        with self._lock:
+            self._entries = {}
+
+    def _check_marker(self):
+        now = time.monotonic()
+        if self._marker_checked_at is not None and now - self._marker_checked_at < self.marker_check_interval:
+            return
+        self._marker_checked_at = now
+
+        marker = self.subscriptions_repo.get_change_marker()
+        if marker != self._marker:
+            logger.info('Subscriptions changed, reload subscription index')
+            self._marker = marker
+            self.invalidate()
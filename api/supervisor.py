@@ -0,0 +1,88 @@
+import logging
+import multiprocessing
+import signal
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Supervisor:
+    """
+    Prefork supervisor for processors.
+
+    Forks `workers` child processes running `target`, so config is loaded once
+    in the parent and shared by children. Children which exit (crash) are restarted.
+    On SIGTERM/SIGINT children receive SIGTERM, which calls `stop` in the child,
+    so it can finish jobs in flight; children still alive after `graceful_timeout`
+    seconds are killed. In the child `worker_index` is the index of the worker (0..workers-1).
+    """
+
+    CHECK_INTERVAL_SECONDS = 0.5
+
+    def __init__(self, target, workers, stop=None, graceful_timeout=60, restart_delay=1):
+        self.target = target
+        self.workers = workers
+        self.stop_child = stop
+        self.graceful_timeout = graceful_timeout
+        self.restart_delay = restart_delay
+        self.context = multiprocessing.get_context('fork')
+        self.children = {}
+        self.worker_index = None
+        self._stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._handle_stop_signal)
+        signal.signal(signal.SIGINT, self._handle_stop_signal)
+        self.supervise()
+
+    def supervise(self):
+        for index in range(self.workers):
+            self._spawn(index)
+
+        while not self._stopping:
+            time.sleep(self.CHECK_INTERVAL_SECONDS)
+            for index, process in list(self.children.items()):
+                if process.is_alive() or self._stopping:
+                    continue
+                logger.error('Worker %d (pid %s) exited with code %s, restarting', index, process.pid, process.exitcode)
+                time.sleep(self.restart_delay)
+                self._spawn(index)
+
+        self._shutdown()
+
+    def stop(self):
+        self._stopping = True
+
+    def _handle_stop_signal(self, signum, frame):
+        logger.info('Received signal %d, stopping workers', signum)
+        self.stop()
+
+    def _spawn(self, index):
+        process = self.context.Process(target=self._run_child, args=(index,), daemon=False)
+        process.start()
+        logger.info('Started worker %d (pid %s)', index, process.pid)
+        self.children[index] = process
+
+    def _run_child(self, index):
+        self.worker_index = index
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, self._handle_child_stop_signal)
+        self.target()
+
+    def _handle_child_stop_signal(self, signum, frame):
+        if self.stop_child:
+            self.stop_child()
+
+    def _shutdown(self):
+        for process in self.children.values():
+            if process.is_alive():
+                process.terminate()
+
+        deadline = time.time() + self.graceful_timeout
+        for index, process in self.children.items():
+            process.join(max(deadline - time.time(), 0))
+            if process.is_alive():
+                logger.warning('Worker %d (pid %s) did not stop in time, killing it', index, process.pid)
+                process.kill()
+                process.join()
+        logger.info('All workers stopped')
@@ -0,0 +1,178 @@
+import io
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from api.backends import FilesystemObjectClient, SqliteQueueClient, get_local_repo_class
+from api.models import Message
+from api.repos import ChannelRepo, RepoRegistry
+
+
+class TestFilesystemObjectClient:
+    @pytest.fixture(autouse=True)
+    def setup(self, tmpdir):
+        self.client = FilesystemObjectClient(str(tmpdir))
+
+    def test_put_object__should_store_body_and_metadata(self):
+        self.client.put_object(Bucket='channel', Key='messages/a', Body=b'body', Metadata={'compression': 'gzip'})
+        obj = self.client.get_object(Bucket='channel', Key='messages/a')
+        assert obj['Body'].read() == b'body'
+        assert obj['Metadata'] == {'compression': 'gzip'}
+        assert obj['ContentLength'] == 4
+
+    def test_get_object__when_overwritten__should_keep_reading_metadata_and_body_of_the_same_version(self):
+        self.client.put_object(Bucket='channel', Key='messages/a', Body=b'old', Metadata={'compression': 'gzip'})
+        obj = self.client.get_object(Bucket='channel', Key='messages/a')
+        self.client.put_object(Bucket='channel', Key='messages/a', Body=b'new body', Metadata={})
+
+        assert (obj['Metadata'], obj['ContentLength'], obj['Body'].read()) == ({'compression': 'gzip'}, 3, b'old')
+        obj = self.client.get_object(Bucket='channel', Key='messages/a')
+        assert (obj['Metadata'], obj['ContentLength'], obj['Body'].read()) == ({}, 8, b'new body')
+
+    def test_upload_fileobj__should_store_body(self):
+        self.client.upload_fileobj(io.BytesIO(b'body'), 'channel', 'messages/a')
+        assert b''.join(self.client.get_object(Bucket='channel', Key='messages/a')['Body'].iter_chunks(2)) == b'body'
+
+    def test_get_object__when_missing__should_raise_no_such_key(self):
+        with pytest.raises(self.client.exceptions.NoSuchKey):
+            self.client.get_object(Bucket='channel', Key='messages/a')
+        with pytest.raises(self.client.exceptions.ClientError) as e:
+            self.client.head_object(Bucket='channel', Key='messages/a')
+        assert e.value.response['Error']['Code'] == '404'
+
+    def test_list_objects_v2__should_page_through_keys(self):
+        for key in ('messages/a', 'messages/b/c', 'messages/d', 'other/e'):
+            self.client.put_object(Bucket='channel', Key=key, Body=b'')
+        pages = self.client.get_paginator('list_objects_v2').paginate(
+            Bucket='channel', Prefix='messages/', PaginationConfig={'PageSize': 2}
+        )
+        assert [[obj['Key'] for obj in page['Contents']] for page in pages] == [
+            ['messages/a', 'messages/b/c'], ['messages/d']
+        ]
+
+    def test_copy_object__should_copy_body_and_metadata(self):
+        self.client.put_object(Bucket='channel', Key='a', Body=b'body', Metadata={'k': 'v'})
+        self.client.copy_object(Bucket='channel', Key='b', CopySource={'Bucket': 'channel', 'Key': 'a'})
+        self.client.delete_object(Bucket='channel', Key='a')
+        obj = self.client.get_object(Bucket='channel', Key='b')
+        assert (obj['Body'].read(), obj['Metadata']) == (b'body', {'k': 'v'})
+        with pytest.raises(self.client.exceptions.NoSuchKey):
+            self.client.get_object(Bucket='channel', Key='a')
+
+    def test_copy_object__when_target_exists_and_if_none_match__should_not_overwrite_it(self):
+        self.client.put_object(Bucket='channel', Key='a', Body=b'old')
+        self.client.put_object(Bucket='channel', Key='b', Body=b'new')
+        with pytest.raises(self.client.exceptions.ClientError) as e:
+            self.client.copy_object(
+                Bucket='channel', Key='b', CopySource={'Bucket': 'channel', 'Key': 'a'}, IfNoneMatch='*'
+            )
+        assert e.value.response['Error']['Code'] == 'PreconditionFailed'
+        assert self.client.get_object(Bucket='channel', Key='b')['Body'].read() == b'new'
+
+    def test_delete_object__when_etag_does_not_match__should_keep_object(self):
+        self.client.put_object(Bucket='channel', Key='a', Body=b'old')
+        etag = self.client.head_object(Bucket='channel', Key='a')['ETag']
+        self.client.put_object(Bucket='channel', Key='a', Body=b'new')
+        with pytest.raises(self.client.exceptions.ClientError):
+            self.client.delete_object(Bucket='channel', Key='a', IfMatch=etag)
+        etag = self.client.head_object(Bucket='channel', Key='a')['ETag']
+        self.client.delete_object(Bucket='channel', Key='a', IfMatch=etag)
+        assert self.client.list_objects_v2(Bucket='channel')['Contents'] == []
+
+
+class TestSqliteQueueClient:
+    @pytest.fixture(autouse=True)
+    def setup(self, tmpdir):
+        self.path = str(tmpdir.join('queues.sqlite3'))
+        self.client = SqliteQueueClient(self.path)
+        self.queue_url = self.client.create_queue(QueueName='queue', Attributes={'VisibilityTimeout': '1'})['QueueUrl']
+
+    def receive(self, **kwargs):
+        return self.client.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=10, **kwargs).get('Messages', [])
+
+    def test_receive_message__when_deleted__should_not_return_message_again(self):
+        self.client.send_message(QueueUrl=self.queue_url, MessageBody='a')
+        messages = self.receive()
+        assert [m['Body'] for m in messages] == ['a']
+        self.client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=messages[0]['ReceiptHandle'])
+        assert self.receive(VisibilityTimeout=0) == []
+
+    def test_receive_message__when_visibility_timeout_expired__should_return_message_again(self):
+        self.client.send_message(QueueUrl=self.queue_url, MessageBody='a')
+        assert len(self.receive(VisibilityTimeout=0)) == 1
+        assert [m['Body'] for m in self.receive()] == ['a']
+        assert self.receive() == []
+
+    def test_receive_message__when_delayed__should_return_message_after_delay(self):
+        self.client.send_message(QueueUrl=self.queue_url, MessageBody='a', DelaySeconds=1)
+        assert self.receive() == []
+        assert [m['Body'] for m in self.receive(WaitTimeSeconds=2)] == ['a']
+
+    def test_receive_message__when_waiting__should_return_message_sent_by_other_thread(self):
+        timer = threading.Timer(0.1, self.client.send_message_batch, kwargs={
+            'QueueUrl': self.queue_url, 'Entries': [{'Id': '0', 'MessageBody': 'a'}, {'Id': '1', 'MessageBody': 'b'}]
+        })
+        timer.start()
+        started_at = time.monotonic()
+        messages = self.receive(WaitTimeSeconds=5)
+        assert time.monotonic() - started_at < 5
+        assert sorted(m['Body'] for m in messages) == ['a', 'b']
+
+    def test_receive_message__should_share_queue_between_clients_of_the_file(self):
+        other_client = SqliteQueueClient(self.path)
+        other_client.send_message(QueueUrl=self.queue_url, MessageBody='a')
+        messages = self.receive()
+        assert [m['Body'] for m in messages] == ['a']
+        assert other_client.receive_message(QueueUrl=self.queue_url, VisibilityTimeout=0) == {}
+        other_client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=messages[0]['ReceiptHandle'])
+        self.client.change_message_visibility(
+            QueueUrl=self.queue_url, ReceiptHandle=messages[0]['ReceiptHandle'], VisibilityTimeout=0
+        )
+        assert self.receive() == []
+
+
+class TestLocalBackendRepos:
+    def test_repos__should_store_messages_and_jobs_locally(self, app, tmpdir):
+        config = dict(app.config, REPOS_BACKEND='local', LOCAL_BACKEND_DIR=str(tmpdir))
+        registry = RepoRegistry(config)
+
+        message = registry.channel.save_message(Message.from_dict({
+            'message': {'sender': 'AU', 'receiver': 'CN', 'subject': 's', 'obj': 'o', 'predicate': 'p'}
+        }))
+        assert registry.channel.get_message(message.id).to_dict() == message.to_dict()
+
+        registry.channel_queue._unsafe_method__clear()
+        registry.channel_queue.post_job({'message_id': message.id})
+        queue_msg_id, payload = registry.channel_queue.get_job()
+        assert payload == {'message_id': message.id}
+        registry.channel_queue.delete(queue_msg_id)
+        assert registry.channel_queue.get_jobs() == []
+
+    def test_init__when_unknown_backend__should_raise_error(self, app):
+        with pytest.raises(ValueError):
+            RepoRegistry(dict(app.config, REPOS_BACKEND='unknown'))
+
+
+class TestLocalChannelRepoMigration:
+    @pytest.fixture(autouse=True)
+    def setup(self, tmpdir):
+        repo_class = get_local_repo_class(ChannelRepo)
+        self.flat_repo = repo_class({'local_root': str(tmpdir)})
+        self.repo = repo_class({'local_root': str(tmpdir)}, key_layout='hash')
+
+    def test_migrate_message_object__when_target_written_while_migrating__should_keep_newer_target(self):
+        self.flat_repo.save_message(Message(id='1234', message={'obj': 'old'}))
+        newer = Message(id='1234', message={'obj': 'new'})
+        copy_object = self.repo.client.copy_object
+
+        def save_then_copy(**kwargs):
+            self.repo.save_message(newer)
+            return copy_object(**kwargs)
+
+        with mock.patch.object(self.repo.client, 'copy_object', side_effect=save_then_copy):
+            assert self.repo.migrate_message_object('messages/1234')
+
+        assert list(self.repo.iter_message_paths()) == ['messages/71/10/1234']
+        assert self.repo.get_message('1234').message == {'obj': 'new'}
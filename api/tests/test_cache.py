@@ -0,0 +1,94 @@
+from unittest import mock
+
+import pytest
+
+from api.cache import MemoryCache, DiskCache, TieredCache
+
+
+class TestMemoryCache:
+    def test_set__when_over_max_bytes__should_evict_least_recently_used(self):
+        cache = MemoryCache(max_bytes=10)
+        cache.set('a', b'12345')
+        cache.set('b', b'12345')
+        assert cache.get('a') == b'12345'
+
+        cache.set('c', b'12345')
+        assert cache.get('b') is None
+        assert cache.get('a') == b'12345'
+        assert cache.get('c') == b'12345'
+        assert cache.size == 10
+
+    def test_get__when_expired__should_return_none(self):
+        cache = MemoryCache(max_bytes=10, ttl=-1)
+        cache.set('a', b'12345')
+        assert cache.get('a') is None
+        assert cache.size == 0
+
+    def test_set__when_value_is_not_ascii__should_bound_it_by_encoded_size(self):
+        cache = MemoryCache(max_bytes=10)
+        cache.set('a', '\u00e9\u00e9\u00e9')
+        assert cache.size == 6
+        cache.set('b', '\u00e9\u00e9\u00e9')
+        assert cache.get('a') is None
+        assert cache.get('b') == '\u00e9\u00e9\u00e9'.encode('utf-8')
+
+
+class TestDiskCache:
+    @pytest.fixture(autouse=True)
+    def setup(self, tmpdir):
+        self.directory = str(tmpdir)
+
+    def test_set__should_store_value_in_file(self):
+        DiskCache(self.directory, max_bytes=100).set('a', '{"id": "a"}')
+        assert DiskCache(self.directory, max_bytes=100).get('a') == b'{"id": "a"}'
+
+    def test_set__when_over_max_bytes__should_evict_oldest(self):
+        cache = DiskCache(self.directory, max_bytes=100)
+        cache.set('a', b'1' * 40)
+        cache.set('b', b'1' * 40)
+        cache.set('c', b'1' * 40)
+        assert cache.get('a') is None
+        assert cache.get('b') == b'1' * 40
+        assert cache.size == 80
+
+    def test_set__when_over_max_bytes__should_evict_below_low_water_mark(self):
+        cache = DiskCache(self.directory, max_bytes=100)
+        for i in range(11):
+            cache.set(str(i), b'1' * 10)
+        assert cache.size == 90
+
+        with mock.patch.object(cache, '_evict', wraps=cache._evict) as evict:
+            cache.set('11', b'1' * 10)
+        assert not evict.called
+        assert cache.size == 100
+
+    def test_set__when_directory_shared_by_processes__should_bound_their_total_size(self):
+        cache = DiskCache(self.directory, max_bytes=100)
+        other_process_cache = DiskCache(self.directory, max_bytes=100)
+        cache.set('a', b'1' * 40)
+        other_process_cache.set('b', b'1' * 40)
+        cache.set('c', b'1' * 40)
+        assert other_process_cache.get('a') is None
+        assert cache.get('b') == b'1' * 40
+        assert cache.size == other_process_cache.size == 80
+
+        other_process_cache.delete('b')
+        assert cache.size == 40
+
+
+class TestTieredCache:
+    def test_get__should_promote_values_and_count_hits(self, tmpdir):
+        memory = MemoryCache(max_bytes=100)
+        disk = DiskCache(str(tmpdir), max_bytes=100)
+        cache = TieredCache([memory, disk])
+        disk.set('a', b'value')
+
+        assert cache.get('a') == b'value'
+        assert memory.get('a') == b'value'
+        assert cache.get('a') == b'value'
+        assert cache.get('b') is None
+        assert cache.stats() == {
+            'hits': {'memory': 1, 'disk': 1},
+            'misses': 1,
+            'size': {'memory': 5, 'disk': 5},
+        }
@@ -0,0 +1,73 @@
+import time
+from unittest import mock
+
+import pytest
+
+from api.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, FileCircuitStore, MemoryCircuitStore
+
+
+@pytest.fixture(params=['memory', 'file'])
+def store(request, tmp_path):
+    if request.param == 'file':
+        return FileCircuitStore(str(tmp_path / 'circuits.json'))
+    return MemoryCircuitStore()
+
+
+class TestCircuitBreaker:
+    @pytest.fixture(autouse=True)
+    def setup(self, store):
+        self.store = store
+        self.breaker = CircuitBreaker(store, failure_threshold=2, reset_timeout=30)
+
+    def test_record_failure__when_threshold_reached__should_open_circuit(self):
+        self.breaker.record_failure('a.com')
+        assert self.breaker.get_deferral('a.com') is None
+        self.breaker.record_failure('a.com')
+
+        assert self.breaker.get_state('a.com') == OPEN
+        assert 30 <= self.breaker.get_deferral('a.com') <= 45
+        assert self.breaker.get_deferral('b.com') is None
+
+    def test_record_success__should_reset_failures(self):
+        self.breaker.record_failure('a.com')
+        self.breaker.record_success('a.com')
+        self.breaker.record_failure('a.com')
+        assert self.breaker.get_state('a.com') == CLOSED
+
+    def test_get_deferral__when_reset_timeout_passed__should_let_single_probe_through(self):
+        self.breaker.record_failure('a.com')
+        self.breaker.record_failure('a.com')
+
+        with mock.patch('api.circuit_breaker.time.time', return_value=time.time() + 31):
+            assert self.breaker.get_deferral('a.com') is None
+            assert self.breaker.get_state('a.com') == HALF_OPEN
+            assert self.breaker.get_deferral('a.com') is not None
+
+    def test_record_failure__when_half_open__should_open_circuit_again(self):
+        self.breaker.record_failure('a.com')
+        self.breaker.record_failure('a.com')
+        with mock.patch('api.circuit_breaker.time.time', return_value=time.time() + 31):
+            self.breaker.get_deferral('a.com')
+            self.breaker.record_failure('a.com')
+            assert self.breaker.get_state('a.com') == OPEN
+
+    def test_record_success__when_half_open__should_close_circuit(self):
+        self.breaker.record_failure('a.com')
+        self.breaker.record_failure('a.com')
+        with mock.patch('api.circuit_breaker.time.time', return_value=time.time() + 31):
+            self.breaker.get_deferral('a.com')
+            self.breaker.record_success('a.com')
+        assert self.breaker.get_state('a.com') == CLOSED
+        assert self.breaker.get_deferral('a.com') is None
+
+    def test_record_response__when_client_error__should_count_as_success(self):
+        self.breaker.record_response('a.com', mock.Mock(status_code=404))
+        self.breaker.record_response('a.com', mock.Mock(status_code=503))
+        self.breaker.record_response('a.com', None)
+        assert self.breaker.get_state('a.com') == OPEN
+
+
+def test_file_store__should_share_circuits_between_instances(tmp_path):
+    path = str(tmp_path / 'circuits.json')
+    CircuitBreaker(FileCircuitStore(path), failure_threshold=1).record_failure('a.com')
+    assert CircuitBreaker(FileCircuitStore(path), failure_threshold=1).get_state('a.com') == OPEN
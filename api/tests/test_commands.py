@@ -0,0 +1,144 @@
+import logging
+from unittest import mock
+
+import pytest
+
+from api.commands import RedriveDeadLettersCommand
+from api.models import MessageStatus
+from api.repos import ChannelQueueRepo, ChannelRepo, DeadLetterRepo, DeliveryOutboxRepo
+
+
+def _callback_entry(index):
+    return {'kind': 'callbacks', 'job': {'s': 'http://subscriber.com/%d' % index, 'payload': {'id': index}}}
+
+
+def _message_entry(index):
+    return {'kind': 'messages', 'job': {'message_id': 'message-%d' % index}}
+
+
+class TestRedriveDeadLettersCommand:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.entries = {'messages': {}, 'callbacks': {}}
+        self.dead_letters = mock.create_autospec(DeadLetterRepo).return_value
+        self.dead_letters.iter_keys.side_effect = lambda kind: iter(sorted(self.entries[kind]))
+        self.dead_letters.get_entry.side_effect = self._get_entry
+        self.channel_repo = mock.create_autospec(ChannelRepo).return_value
+        self.channel_queue = mock.create_autospec(ChannelQueueRepo).return_value
+        self.channel_queue.enqueue_many.return_value = {}
+        self.delivery_outbox = mock.create_autospec(DeliveryOutboxRepo).return_value
+        self.delivery_outbox.post_jobs.return_value = {}
+        self.command = RedriveDeadLettersCommand()
+        self.command.app = mock.Mock()
+        self.command.app.repos = mock.Mock(
+            dead_letters=self.dead_letters, channel=self.channel_repo,
+            channel_queue=self.channel_queue, delivery_outbox=self.delivery_outbox,
+        )
+
+    def _get_entry(self, key):
+        entry = self.entries['messages'].get(key) or self.entries['callbacks'].get(key)
+        if entry is None:
+            raise ValueError('unreadable %s' % key)
+        return entry
+
+    def _add(self, kind, count):
+        create_entry = _message_entry if kind == 'messages' else _callback_entry
+        for index in range(count):
+            self.entries[kind]['dead-letters/%s/%02d' % (kind, index)] = create_entry(index)
+
+    def _deleted(self):
+        return [key for call in self.dead_letters.delete_entries.call_args_list for key in call[0][0]]
+
+    def test_run__when_callback_enqueue_failed__should_keep_its_dead_letter(self):
+        self._add('callbacks', 3)
+        self.delivery_outbox.post_jobs.return_value = {1: 'throttled'}
+
+        self.command.run(kinds=['callbacks'], rate=0)
+
+        self.delivery_outbox.post_jobs.assert_called_once_with([
+            {'s': 'http://subscriber.com/%d' % index, 'payload': {'id': index}, 'retry': 1} for index in range(3)
+        ])
+        assert self._deleted() == ['dead-letters/callbacks/00', 'dead-letters/callbacks/02']
+
+    def test_run__when_message_enqueue_failed__should_keep_its_dead_letter(self):
+        self._add('messages', 3)
+        self.channel_queue.enqueue_many.return_value = {'message-2': 'throttled'}
+
+        self.command.run(kinds=['messages'], rate=0)
+
+        self.channel_repo.update_status.assert_has_calls(
+            [mock.call('message-%d' % index, MessageStatus.RECEIVED) for index in range(3)], any_order=True
+        )
+        self.channel_queue.enqueue_many.assert_called_once_with(['message-0', 'message-1', 'message-2'])
+        assert self._deleted() == ['dead-letters/messages/00', 'dead-letters/messages/01']
+
+    def test_run__when_status_reset_failed__should_not_enqueue_message(self):
+        self._add('messages', 2)
+
+        def update_status(message_id, status):
+            if message_id == 'message-0':
+                raise Exception('boom')
+
+        self.channel_repo.update_status.side_effect = update_status
+
+        self.command.run(kinds=['messages'], rate=0)
+
+        self.channel_queue.enqueue_many.assert_called_once_with(['message-1'])
+        assert self._deleted() == ['dead-letters/messages/01']
+
+    def test_run__when_entry_is_unreadable__should_count_it_failed_and_keep_it(self, caplog):
+        self._add('callbacks', 2)
+        self.entries['callbacks']['dead-letters/callbacks/00'] = None
+
+        with caplog.at_level(logging.INFO):
+            self.command.run(kinds=['callbacks'], rate=0)
+
+        self.delivery_outbox.post_jobs.assert_called_once_with(
+            [{'s': 'http://subscriber.com/1', 'payload': {'id': 1}, 'retry': 1}]
+        )
+        assert self._deleted() == ['dead-letters/callbacks/01']
+        assert 'found: 2, enqueued: 1, failed: 1' in caplog.text
+
+    def test_run__should_enqueue_in_batches(self):
+        self._add('callbacks', 25)
+
+        self.command.run(kinds=['callbacks'], rate=0, workers=1)
+
+        assert [len(call[0][0]) for call in self.delivery_outbox.post_jobs.call_args_list] == [10, 10, 5]
+        assert len(self._deleted()) == 25
+
+    def test_run__when_limited__should_redrive_only_limit_per_kind(self):
+        self._add('messages', 5)
+        self._add('callbacks', 5)
+
+        self.command.run(rate=0, limit=3)
+
+        self.channel_queue.enqueue_many.assert_called_once_with(['message-0', 'message-1', 'message-2'])
+        assert len(self.delivery_outbox.post_jobs.call_args[0][0]) == 3
+        assert len(self._deleted()) == 6
+
+    def test_run__when_dry_run__should_enqueue_and_delete_nothing(self, caplog):
+        self._add('callbacks', 3)
+
+        with caplog.at_level(logging.INFO):
+            self.command.run(kinds=['callbacks'], dry_run=True)
+
+        assert not self.delivery_outbox.post_jobs.called
+        assert not self.dead_letters.delete_entries.called
+        assert 'found: 3, enqueued: 0, failed: 0' in caplog.text
+
+    def test_run__should_pace_batches_by_rate(self):
+        self._add('callbacks', 25)
+        clock = [100.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            clock[0] += seconds
+
+        with mock.patch('api.commands.time.monotonic', side_effect=lambda: clock[0]), \
+                mock.patch('api.commands.time.sleep', side_effect=sleep):
+            self.command.run(kinds=['callbacks'], rate=10, workers=1)
+
+        # the first batch is sent at once, the next ones after 10 and 10 jobs at 10 per second
+        assert sleeps == [1, 1]
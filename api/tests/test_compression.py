@@ -0,0 +1,17 @@
+import pytest
+
+from api.compression import get_codec, GzipCodec
+
+
+class TestGetCodec:
+    def test_get_codec__when_name_empty__should_return_none(self):
+        assert get_codec('') is None
+
+    def test_get_codec__when_name_unknown__should_raise_error(self):
+        with pytest.raises(ValueError):
+            get_codec('lzma')
+
+    def test_gzip_codec__should_decompress_compressed_data(self):
+        codec = get_codec('gzip', 1)
+        assert isinstance(codec, GzipCodec)
+        assert codec.decompress(codec.compress(b'{"obj": "test"}' * 100)) == b'{"obj": "test"}' * 100
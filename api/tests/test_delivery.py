@@ -0,0 +1,173 @@
+import threading
+import time
+from unittest import mock
+
+from api.delivery import AsyncDeliveryEngine
+from api.repos import DeliveryOutboxRepo
+from api.use_cases import DeliverCallbackUseCase
+
+
+class TestAsyncDeliveryEngine:
+    def setup_method(self):
+        self.jobs = [
+            ('job-%d' % i, {'s': 'http://subscriber-%d.com/callback' % (i % 2), 'payload': {'id': i}})
+            for i in range(20)
+        ]
+        self.use_case = mock.create_autospec(DeliverCallbackUseCase).return_value
+        self.use_case.delivery_outbox = mock.create_autospec(DeliveryOutboxRepo).return_value
+        self.use_case.delivery_outbox.get_jobs.side_effect = self._get_jobs
+        self.use_case.process.side_effect = self._process
+        self.engine = AsyncDeliveryEngine(self.use_case, concurrency=8, per_host_concurrency=2, wait_seconds=0)
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.max_in_flight = {}
+        self.processed = []
+
+    def _get_jobs(self, max_messages, wait_seconds, visibility_timeout=None):
+        with self.lock:
+            jobs, self.jobs = self.jobs[:max_messages], self.jobs[max_messages:]
+        if not jobs:
+            time.sleep(0.01)
+        if len(self.processed) == 20:
+            self.engine.stop()
+        return jobs
+
+    def _process(self, queue_msg_id, payload):
+        host = payload['s']
+        with self.lock:
+            self.in_flight[host] = self.in_flight.get(host, 0) + 1
+            self.max_in_flight[host] = max(self.max_in_flight.get(host, 0), self.in_flight[host])
+        time.sleep(0.01)
+        with self.lock:
+            self.in_flight[host] -= 1
+            self.processed.append(queue_msg_id)
+
+    def test_run__should_process_all_jobs(self):
+        self.engine.run()
+        assert sorted(self.processed) == sorted('job-%d' % i for i in range(20))
+
+    def test_run__should_respect_per_host_concurrency(self):
+        self.engine.run()
+        assert max(self.max_in_flight.values()) <= 2
+
+
+class TestAsyncDeliveryEngineFairness:
+    def setup_method(self):
+        self.jobs = [('slow-%d' % i, {'s': 'http://slow.com/callback', 'payload': {'id': i}}) for i in range(10)]
+        self.jobs += [('fast-%d' % i, {'s': 'http://fast.com/callback', 'payload': {'id': i}}) for i in range(4)]
+        self.use_case = mock.create_autospec(DeliverCallbackUseCase).return_value
+        self.use_case.delivery_outbox = mock.create_autospec(DeliveryOutboxRepo).return_value
+        self.use_case.delivery_outbox.get_jobs.side_effect = self._get_jobs
+        self.use_case.process.side_effect = self._process
+        self.use_case.defer.side_effect = self._defer
+        self.total = len(self.jobs)
+        self.lock = threading.Lock()
+        self.processed = []
+        self.deferred = []
+        self.started_at = []
+
+    def _get_jobs(self, max_messages, wait_seconds, visibility_timeout=None):
+        with self.lock:
+            jobs, self.jobs = self.jobs[:max_messages], self.jobs[max_messages:]
+            if len(self.processed) + len(self.deferred) == self.total:
+                self.engine.stop()
+        if not jobs:
+            time.sleep(0.01)
+        return jobs
+
+    def _process(self, queue_msg_id, payload):
+        with self.lock:
+            self.started_at.append(time.monotonic())
+        if payload['s'] == 'http://slow.com/callback':
+            time.sleep(0.1)
+        with self.lock:
+            self.processed.append(queue_msg_id)
+
+    def _defer(self, queue_msg_id, payload, delay_seconds):
+        with self.lock:
+            self.deferred.append(queue_msg_id)
+
+    def test_run__when_host_is_slow__should_not_hold_jobs_of_other_hosts(self):
+        self.engine = AsyncDeliveryEngine(
+            self.use_case, concurrency=4, per_host_concurrency=2, wait_seconds=0, lane_size=2
+        )
+        self.engine.run()
+
+        assert sorted(self.processed + self.deferred) == sorted(
+            ['slow-%d' % i for i in range(10)] + ['fast-%d' % i for i in range(4)]
+        )
+        assert all(queue_msg_id.startswith('slow') for queue_msg_id in self.deferred)
+        last_fast = max(self.processed.index('fast-%d' % i) for i in range(4))
+        assert last_fast < len(self.processed) - 1
+
+    def test_run__when_rate_limited__should_spread_deliveries_to_host(self):
+        self.jobs = [('fast-%d' % i, {'s': 'http://fast.com/callback', 'payload': {'id': i}}) for i in range(15)]
+        self.total = 15
+        self.engine = AsyncDeliveryEngine(
+            self.use_case, concurrency=20, per_host_concurrency=20, wait_seconds=0, per_host_rate=10
+        )
+        self.engine.run()
+
+        assert len(self.processed) == 15
+        # the first 10 take the whole bucket, the other 5 wait for new tokens at 10 per second
+        assert max(self.started_at) - min(self.started_at) >= 0.4
+
+
+class TestAsyncDeliveryEngineVisibilityTimeout:
+    def setup_method(self):
+        self.use_case = mock.create_autospec(DeliverCallbackUseCase).return_value
+        self.use_case.delivery_outbox = mock.create_autospec(DeliveryOutboxRepo).return_value
+
+    def test_get_visibility_timeout__should_cover_wait_behind_full_lane(self):
+        engine = AsyncDeliveryEngine(
+            self.use_case, concurrency=100, per_host_concurrency=10, lane_size=20, per_host_rate=4, job_timeout=15
+        )
+        # 2 lane rounds ahead and its own delivery, 20 jobs at 4 per second
+        assert engine.get_visibility_timeout() == 3 * 15 + 5
+
+    def test_run__should_receive_jobs_with_visibility_timeout(self):
+        engine = AsyncDeliveryEngine(
+            self.use_case, concurrency=4, per_host_concurrency=2, wait_seconds=0, lane_size=2, job_timeout=15
+        )
+
+        def get_jobs(max_messages, wait_seconds, visibility_timeout=None):
+            engine.stop()
+            return [('job-1', {'s': 'http://a.com/callback', 'payload': {}})]
+
+        self.use_case.delivery_outbox.get_jobs.side_effect = get_jobs
+        engine.run()
+
+        self.use_case.delivery_outbox.get_jobs.assert_called_once_with(
+            max_messages=4, wait_seconds=0, visibility_timeout=30
+        )
+        self.use_case.process.assert_called_once_with('job-1', {'s': 'http://a.com/callback', 'payload': {}})
+
+    def test_run__when_job_would_outlive_visibility_timeout__should_defer_it(self):
+        engine = AsyncDeliveryEngine(
+            self.use_case, concurrency=4, per_host_concurrency=1, wait_seconds=0, lane_size=3, job_timeout=0.1
+        )
+        jobs = [('job-%d' % i, {'s': 'http://slow.com/callback', 'payload': {'id': i}}) for i in range(3)]
+        processed = []
+        deferred = []
+
+        def get_jobs(max_messages, wait_seconds, visibility_timeout=None):
+            batch = list(jobs)
+            del jobs[:]
+            if len(processed) + len(deferred) == 3:
+                engine.stop()
+            time.sleep(0.01)
+            return batch
+
+        def process(queue_msg_id, payload):
+            # slower than job_timeout, so the last job runs out of its visibility timeout
+            time.sleep(0.2)
+            processed.append(queue_msg_id)
+
+        self.use_case.delivery_outbox.get_jobs.side_effect = get_jobs
+        self.use_case.process.side_effect = process
+        self.use_case.defer.side_effect = lambda queue_msg_id, payload, delay_seconds: deferred.append(queue_msg_id)
+        engine.run()
+
+        # visibility timeout 0.4s: the second job starts at 0.2s, the third at 0.4s - too late to finish in time
+        assert processed == ['job-0', 'job-1']
+        assert deferred == ['job-2']
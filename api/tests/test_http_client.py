@@ -0,0 +1,26 @@
+import pytest
+from responses import Response
+
+from api.http_client import HttpClient
+
+
+class TestHttpClient:
+    @pytest.fixture(autouse=True)
+    def setup(self, mocked_responses):
+        self.mocked_responses = mocked_responses
+        self.url = 'http://subscriber.com/callback'
+        self.client = HttpClient(pool_maxsize=2, connect_timeout=1, read_timeout=2)
+
+    def test_post__should_use_default_timeouts(self):
+        self.mocked_responses.add(Response(method='POST', url=self.url))
+        response = self.client.post(self.url, json={'id': 1})
+
+        assert response.status_code == 200
+        assert self.mocked_responses.calls[0].request.body == b'{"id": 1}'
+
+    def test_stats__should_report_pool_usage_per_host(self):
+        self.client.session.get_adapter(self.url).poolmanager.connection_from_url(self.url)
+        stats = self.client.stats()
+        assert stats == {
+            'http://subscriber.com:80': {'connections': 0, 'requests': 0, 'in_use': 0, 'maxsize': 2}
+        }
@@ -0,0 +1,57 @@
+import subprocess
+from unittest import mock
+
+import pytest
+
+from api.importtime import ModuleImport, format_report, get_packages, measure_imports
+
+IMPORTTIME_OUTPUT = """import time: self [us] | cumulative | imported package
+import time:       244 |        244 |   _io
+import time:       274 |        518 | _frozen_importlib_external
+import time:        38 |         38 |     flask.json
+import time:       246 |        283 |   flask.app
+import time:       466 |       1348 | flask
+"""
+
+
+def _completed(returncode=0, stderr=IMPORTTIME_OUTPUT):
+    return subprocess.CompletedProcess([], returncode, stderr=stderr)
+
+
+@mock.patch('api.importtime.subprocess.run', return_value=_completed())
+def test_measure_imports__should_parse_importtime_output(run):
+    imports = measure_imports('import flask')
+
+    assert run.call_args[0][0][1:] == ['-X', 'importtime', '-c', 'import flask']
+    assert imports == [
+        ModuleImport('_io', 244, 244, 1),
+        ModuleImport('_frozen_importlib_external', 274, 518, 0),
+        ModuleImport('flask.json', 38, 38, 2),
+        ModuleImport('flask.app', 246, 283, 1),
+        ModuleImport('flask', 466, 1348, 0),
+    ]
+
+
+@mock.patch('api.importtime.subprocess.run', return_value=_completed(1, IMPORTTIME_OUTPUT + 'ImportError: boom\n'))
+def test_measure_imports__when_import_failed__should_raise_with_error(run):
+    with pytest.raises(RuntimeError, match='ImportError: boom'):
+        measure_imports('import flask')
+
+
+def test_get_packages__should_sum_self_time_by_top_level_package():
+    imports = [
+        ModuleImport('flask.json', 38, 38, 2),
+        ModuleImport('_io', 244, 244, 1),
+        ModuleImport('flask', 466, 1348, 0),
+    ]
+    assert get_packages(imports) == [('flask', 504, 2), ('_io', 244, 1)]
+
+
+def test_format_report__should_list_slowest_modules():
+    imports = [ModuleImport('a', 1000, 5000, 0), ModuleImport('b', 3000, 3000, 1)]
+
+    report = format_report('import a', imports, top=1, sort='self')
+
+    assert report.startswith('import a: 4.0 ms, 2 modules')
+    modules = report.split('modules (self ms, cumulative ms):')[1]
+    assert 'b' in modules and ' a ' not in modules
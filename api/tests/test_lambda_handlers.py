@@ -0,0 +1,66 @@
+import json
+from unittest import mock
+
+import pytest
+
+from api import lambda_handlers
+from api.lambda_handlers import Processors, process_records
+from api.use_cases import DeliverCallbackUseCase
+
+
+def _event(*payloads):
+    return {'Records': [
+        {'messageId': 'm%d' % i, 'receiptHandle': 'r%d' % i, 'body': json.dumps(payload)}
+        for i, payload in enumerate(payloads)
+    ]}
+
+
+class TestProcessRecords:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.use_case = mock.create_autospec(DeliverCallbackUseCase).return_value
+
+    def test_process_records__should_process_every_record(self):
+        result = process_records(self.use_case, _event({'a': 1}, {'a': 2}))
+
+        assert result == {'batchItemFailures': []}
+        self.use_case.process.assert_has_calls([mock.call('r0', {'a': 1}), mock.call('r1', {'a': 2})])
+
+    def test_process_records__when_record_raised__should_report_only_it(self):
+        self.use_case.process.side_effect = [None, Exception('boom'), None]
+
+        result = process_records(self.use_case, _event({'a': 1}, {'a': 2}, {'a': 3}))
+
+        assert result == {'batchItemFailures': [{'itemIdentifier': 'm1'}]}
+        assert self.use_case.process.call_count == 3
+
+    def test_process_records__when_body_is_not_json__should_report_it(self):
+        event = _event({'a': 1})
+        event['Records'][0]['body'] = 'not json'
+
+        result = process_records(self.use_case, event)
+
+        assert result == {'batchItemFailures': [{'itemIdentifier': 'm0'}]}
+        assert not self.use_case.process.called
+
+    def test_process_records__when_time_is_running_out__should_return_rest_unprocessed(self):
+        context = mock.Mock()
+        context.get_remaining_time_in_millis.side_effect = [20000, 5000]
+
+        result = process_records(self.use_case, _event({'a': 1}, {'a': 2}, {'a': 3}), context, time_reserve_ms=10000)
+
+        assert result == {'batchItemFailures': [{'itemIdentifier': 'm1'}, {'itemIdentifier': 'm2'}]}
+        self.use_case.process.assert_called_once_with('r0', {'a': 1})
+
+
+def test_handler__should_create_use_case_once():
+    processors = Processors(config={'HTTP_CONNECT_TIMEOUT': 3, 'HTTP_READ_TIMEOUT': 10})
+    use_case = mock.create_autospec(DeliverCallbackUseCase).return_value
+    with mock.patch.object(lambda_handlers, 'processors', processors), \
+            mock.patch.object(Processors, '_create_deliver_callbacks', return_value=use_case) as create:
+        lambda_handlers.deliver_callbacks(_event({'a': 1}), None)
+        result = lambda_handlers.deliver_callbacks(_event({'a': 2}), None)
+
+    assert result == {'batchItemFailures': []}
+    assert create.call_count == 1
+    assert use_case.process.call_count == 2
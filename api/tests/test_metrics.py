@@ -0,0 +1,113 @@
+import boto3
+import pytest
+from botocore.config import Config
+from botocore.exceptions import ClientError, EndpointConnectionError
+from botocore.stub import Stubber
+
+from api import metrics
+
+
+class TestRegistry:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.registry = metrics.Registry()
+
+    def test_render__should_render_counters_and_histograms(self):
+        counter = self.registry.counter('jobs_total', 'Jobs', ('queue',))
+        histogram = self.registry.histogram('duration_seconds', 'Duration', ('queue',), buckets=(0.1, 1))
+        counter.inc(queue='a')
+        counter.inc(2, queue='a')
+        histogram.observe(0.05, queue='a')
+        histogram.observe(0.5, queue='a')
+
+        assert self.registry.render().splitlines() == [
+            '# HELP jobs_total Jobs',
+            '# TYPE jobs_total counter',
+            'jobs_total{queue="a"} 3',
+            '# HELP duration_seconds Duration',
+            '# TYPE duration_seconds histogram',
+            'duration_seconds_bucket{queue="a",le="0.1"} 1',
+            'duration_seconds_bucket{queue="a",le="1.0"} 2',
+            'duration_seconds_bucket{queue="a",le="+Inf"} 2',
+            'duration_seconds_sum{queue="a"} 0.55',
+            'duration_seconds_count{queue="a"} 2',
+        ]
+
+    def test_render__should_render_collected_metrics(self):
+        self.registry.register_collector(lambda: [('pool_in_use', 'gauge', 'In use', [({'host': 'h'}, 2)])])
+        assert self.registry.render().splitlines()[-1] == 'pool_in_use{host="h"} 2'
+
+    def test_register_collector__when_key_is_registered__should_replace_collector(self):
+        self.registry.register_collector(lambda: [('pool_in_use', 'gauge', 'In use', [({}, 1)])], key='app')
+        self.registry.register_collector(lambda: [('pool_in_use', 'gauge', 'In use', [({}, 2)])], key='app')
+
+        assert self.registry.render().splitlines() == [
+            '# HELP pool_in_use In use', '# TYPE pool_in_use gauge', 'pool_in_use 2'
+        ]
+
+    def test_inc__when_labels_differ__should_raise_error(self):
+        counter = self.registry.counter('jobs_total', 'Jobs', ('queue',))
+        with pytest.raises(ValueError):
+            counter.inc(host='a')
+
+
+class TestObserveProcess:
+    def test_process__should_observe_duration_and_outcome(self):
+        class ExampleUseCase:
+            @metrics.observe_process
+            def process(self, fail):
+                if fail:
+                    raise ValueError()
+
+        ExampleUseCase().process(False)
+        with pytest.raises(ValueError):
+            ExampleUseCase().process(True)
+
+        assert sum(metrics.USE_CASE_PROCESS_DURATION.get(use_case='ExampleUseCase', outcome='ok')[0]) == 1
+        assert sum(metrics.USE_CASE_PROCESS_DURATION.get(use_case='ExampleUseCase', outcome='error')[0]) == 1
+
+
+def _count_calls(service, operation, outcome):
+    observed = metrics.REPO_CALL_DURATION.get(service=service, operation=operation, outcome=outcome)
+    return sum(observed[0]) if observed else 0
+
+
+class TestInstrumentBotoClient:
+    def _client(self, service='sqs', **kwargs):
+        client = boto3.client(
+            service, region_name='us-east-1', aws_access_key_id='x', aws_secret_access_key='x', **kwargs
+        )
+        metrics.instrument_boto_client(client)
+        metrics.instrument_boto_client(client)
+        return client
+
+    def test_call__should_observe_duration_by_operation(self):
+        client = self._client()
+        calls = _count_calls('sqs', 'ReceiveMessage', 'ok')
+        with Stubber(client) as stubber:
+            stubber.add_response('receive_message', {'Messages': []})
+            client.receive_message(QueueUrl='http://localhost/queue/test')
+
+        assert _count_calls('sqs', 'ReceiveMessage', 'ok') == calls + 1
+
+    def test_call__when_error_response__should_observe_error_outcome(self):
+        client = self._client('s3')
+        calls = _count_calls('s3', 'GetObject', 'error')
+        with Stubber(client) as stubber:
+            stubber.add_client_error('get_object', 'NoSuchKey', http_status_code=404)
+            with pytest.raises(ClientError):
+                client.get_object(Bucket='bucket', Key='key')
+
+        assert _count_calls('s3', 'GetObject', 'error') == calls + 1
+
+    def test_call__when_endpoint_is_unreachable__should_raise_its_error_and_observe_it(self):
+        client = self._client(
+            endpoint_url='http://127.0.0.1:1',
+            config=Config(connect_timeout=1, retries={'total_max_attempts': 1}),
+        )
+        calls = _count_calls('sqs', 'SendMessage', 'error')
+
+        with pytest.raises(EndpointConnectionError):
+            client.send_message(QueueUrl='http://127.0.0.1:1/queue/test', MessageBody='{}')
+
+        assert _count_calls('sqs', 'SendMessage', 'error') == calls + 1
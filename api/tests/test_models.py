@@ -0,0 +1,16 @@
+from api.models import Message, MessageStatus
+
+
+class TestMessage:
+    def test_to_json__should_keep_stored_format(self):
+        message = Message(message={'receiver': 'AU', 'ü': 'ß'}, id='1', status=MessageStatus.DELIVERED)
+        assert message.to_json() == '{"message": {"receiver": "AU", "\\u00fc": "\\u00df"}, "id": "1", "status": "delivered"}'
+
+    def test_from_json__should_restore_message(self):
+        message = Message(message={'receiver': 'AU'}, id='1', status=MessageStatus.CONFIRMED)
+        assert Message.from_json(message.to_json()) == message
+
+    def test_from_dict__when_id_and_status_missing__should_use_defaults(self):
+        message = Message.from_dict({'message': {'receiver': 'AU'}})
+        assert message.id is None
+        assert message.status == MessageStatus.RECEIVED
@@ -1,6 +1,11 @@
+from unittest import mock
+
 import pytest
 
-from api.models import Message
+from api.cache import MemoryCache, TieredCache
+from api.compression import get_codec
+from api.models import Message, MessageStatus
+from api.repos import ChannelRepo, ChannelQueueRepo, DeadLetterRepo, RepoRegistry
 
 
 class TestChannelRepo:
@@ -27,6 +32,112 @@ class TestChannelRepo:
         message = self.repo.get_message(message_id='id')
         assert not message
 
+    def test_get_messages__should_yield_messages_in_given_order(self):
+        first = self.repo.save_message(Message(message={"receiver": "AU"}))
+        second = self.repo.save_message(Message(message={"receiver": "SG"}))
+        results = list(self.repo.get_messages([second.id, 'missing', first.id], max_workers=2))
+        assert results == [(second.id, second, None), ('missing', None, None), (first.id, first, None)]
+
+    def test_update_status__should_change_status_of_read_message(self):
+        message = self.repo.save_message(self.message)
+        self.repo.update_status(message.id, MessageStatus.DELIVERED)
+        assert self.repo.get_message(message.id).status == MessageStatus.DELIVERED
+        assert self.repo.get_message_status(message.id) == MessageStatus.DELIVERED
+        assert b''.join(self.repo.get_message_stream(message.id)).endswith(b'"status": "delivered"}')
+
+    def test_get_message_status__should_not_read_message(self):
+        message = self.repo.save_message(self.message)
+        with mock.patch.object(self.repo, '_get_message_content') as get_message_content:
+            assert self.repo.get_message_status(message.id) == MessageStatus.RECEIVED
+        get_message_content.assert_not_called()
+
+    def test_save_message__when_status_updated_before__should_save_new_status(self):
+        message = self.repo.save_message(self.message)
+        self.repo.update_status(message.id, MessageStatus.DELIVERED)
+        message.status = MessageStatus.REVOKED
+        self.repo.save_message(message)
+        assert self.repo.get_message(message.id).status == MessageStatus.REVOKED
+
+
+class TestDeadLetterRepo:
+    @pytest.fixture(autouse=True)
+    def setup(self, app, clean_channel_repo):
+        self.repo = DeadLetterRepo(app.config['CHANNEL_REPO_CONF'])
+
+    def test_add__should_store_entries_listed_oldest_first(self):
+        self.repo.add('messages', {'message_id': '1'}, reason='Foreign endpoint responded 500')
+        self.repo.add('messages', {'message_id': '2'})
+        self.repo.add('callbacks', {'s': 'http://subscriber.com/callback', 'payload': {'id': '1'}})
+
+        keys = list(self.repo.iter_keys('messages'))
+        assert [self.repo.get_entry(key)['job'] for key in keys] == [{'message_id': '1'}, {'message_id': '2'}]
+        assert self.repo.get_entry(keys[0])['reason'] == 'Foreign endpoint responded 500'
+
+        self.repo.delete_entries(keys)
+        assert list(self.repo.iter_keys('messages')) == []
+        assert len(list(self.repo.iter_keys('callbacks'))) == 1
+
+
+class TestChannelRepoCache:
+    @pytest.fixture(autouse=True)
+    def setup(self, app, clean_channel_repo):
+        self.cache = TieredCache([MemoryCache(max_bytes=1024)])
+        self.repo = ChannelRepo(app.config['CHANNEL_REPO_CONF'], cache=self.cache)
+
+    def test_save_message__should_write_message_to_cache(self):
+        message = self.repo.save_message(Message(message={"receiver": "AU"}))
+        assert self.repo.get_message(message.id) == message
+        assert self.cache.stats()['hits'] == {'memory': 1}
+
+    def test_get_message__should_read_through_cache(self, clean_channel_repo):
+        message = clean_channel_repo.save_message(Message(message={"receiver": "AU"}))
+        assert self.repo.get_message(message.id) == message
+        assert self.repo.get_message(message.id) == message
+        assert self.cache.stats()['hits'] == {'memory': 1}
+        assert self.cache.stats()['misses'] == 1
+
+
+class TestChannelRepoCompression:
+    @pytest.fixture(autouse=True)
+    def setup(self, app, clean_channel_repo):
+        self.plain_repo = clean_channel_repo
+        self.repo = ChannelRepo(app.config['CHANNEL_REPO_CONF'], compression=get_codec('gzip'))
+
+    def test_save_message__should_store_compressed_message(self):
+        message = self.repo.save_message(Message(message={"receiver": "AU"}))
+        obj = self.repo.client.get_object(Bucket=self.repo.bucket_name, Key=f'messages/{message.id}')
+        assert obj['Metadata'] == {'compression': 'gzip'}
+        assert self.repo.get_message(message.id) == message
+        assert self.plain_repo.get_message(message.id) == message
+
+    def test_get_message__when_stored_uncompressed__should_read_it(self):
+        message = self.plain_repo.save_message(Message(message={"receiver": "AU"}))
+        assert self.repo.get_message(message.id) == message
+
+
+class TestChannelRepoKeyLayout:
+    @pytest.fixture(autouse=True)
+    def setup(self, app, clean_channel_repo):
+        self.flat_repo = clean_channel_repo
+        self.repo = ChannelRepo(app.config['CHANNEL_REPO_CONF'], key_layout='hash')
+
+    def test_save_message__should_use_hash_layout(self):
+        message = self.repo.save_message(Message(id='1234', message={"receiver": "AU"}))
+        assert list(self.repo.iter_message_paths()) == ['messages/71/10/1234']
+        assert self.repo.get_message(message.id) == message
+
+    def test_get_message__when_stored_in_flat_layout__should_read_it(self):
+        message = self.flat_repo.save_message(Message(message={"receiver": "AU"}))
+        assert self.repo.get_message(message.id) == message
+
+    def test_migrate_message_object__should_move_it_to_configured_layout(self):
+        message = self.flat_repo.save_message(Message(id='1234', message={"receiver": "AU"}))
+
+        assert self.repo.migrate_message_object('messages/1234')
+        assert list(self.repo.iter_message_paths()) == ['messages/71/10/1234']
+        assert not self.repo.migrate_message_object('messages/71/10/1234')
+        assert self.repo.get_message('1234') == message
+
 
 class TestChannelQueueRepo:
     @pytest.fixture(autouse=True)
@@ -40,3 +151,51 @@ class TestChannelQueueRepo:
         job_id, payload = job
         assert payload['message_id'] == 'message-id'
         assert payload['retry'] == 1
+
+    def test_repo_enqueue__when_inline_enabled_and_message_small__should_put_message_into_job(self, app):
+        repo = ChannelQueueRepo(app.config['CHANNEL_QUEUE_REPO_CONF'], inline_max_bytes=1024)
+        repo.enqueue('small', 1, message=Message(id='small', message={'obj': 'test'}))
+        repo.enqueue('big', 1, message=Message(id='big', message={'obj': 'x' * 1024}))
+
+        payloads = {}
+        for job_id, payload in repo.get_jobs(max_messages=10, wait_seconds=1):
+            payloads[payload['message_id']] = payload
+        assert payloads['small']['message'] == {'id': 'small', 'message': {'obj': 'test'}, 'status': 'received'}
+        assert 'message' not in payloads['big']
+
+    def test_get_jobs__should_return_several_jobs_per_call(self):
+        for i in range(3):
+            self.repo.enqueue('message-%d' % i, 1)
+        jobs = self.repo.get_jobs(max_messages=10, wait_seconds=20)
+        assert jobs
+        assert all(payload['message_id'].startswith('message-') for job_id, payload in jobs)
+
+    def test_get_jobs__when_queue_empty__should_return_empty_list(self):
+        assert self.repo.get_jobs(max_messages=10, wait_seconds=1) == []
+
+    def test_repo_enqueue_many__should_post_jobs_in_batches(self):
+        message_ids = ['message-%d' % i for i in range(12)]
+        failed = self.repo.enqueue_many(message_ids)
+        assert failed == {}
+
+        received = set()
+        job = self.repo.get_job()
+        while job:
+            job_id, payload = job
+            received.add(payload['message_id'])
+            self.repo.delete(job_id)
+            job = self.repo.get_job()
+        assert received == set(message_ids)
+
+
+class TestRepoRegistry:
+    def test_repos__should_be_created_once_and_shared(self, app):
+        registry = RepoRegistry(app.config)
+        assert registry.channel is registry.channel
+        assert registry.channel_queue is registry.channel_queue
+
+    def test_reset__should_drop_created_repos(self, app):
+        registry = RepoRegistry(app.config)
+        channel_repo = registry.channel
+        registry.reset()
+        assert registry.channel is not channel_repo
@@ -0,0 +1,57 @@
+import io
+import json
+
+import pytest
+
+from api.compression import get_codec
+from api.streaming import JsonObjectValidator, JSONStructureError, MessageUploadReader
+
+
+def validate(data, chunk_size):
+    validator = JsonObjectValidator()
+    for offset in range(0, len(data), chunk_size):
+        validator.feed(data[offset:offset + chunk_size])
+    validator.close()
+
+
+class TestJsonObjectValidator:
+    @pytest.mark.parametrize('chunk_size', [1, 3, 1000])
+    def test_feed__when_valid_object__should_pass(self, chunk_size):
+        document = {'a': [1, -2.5e3, True, False, None, {}], 'ü€': 'q\\"\nሴ', 'b': {'c': []}}
+        validate(json.dumps(document).encode('utf-8'), chunk_size)
+        validate(json.dumps(document, ensure_ascii=False, indent=2).encode('utf-8'), chunk_size)
+
+    @pytest.mark.parametrize('data', [
+        b'', b'[]', b'"a"', b'{"a": 1', b'{"a": 1}}', b'{"a": 1,}', b'{"a" 1}', b'{"a": 01}',
+        b'{"a": tru}', b'{"a": NaN}', b'{"a": "\\x"}', b'{"a": "\\u12"}', b'{"a": "\x01"}', b'{"a": "\xff"}',
+    ])
+    def test_feed__when_invalid__should_raise_error(self, data):
+        with pytest.raises(JSONStructureError):
+            validate(data, 2)
+
+
+class TestMessageUploadReader:
+    def test_read__should_return_stored_message_in_full_size_parts(self):
+        body = json.dumps({'obj': 'x' * 1000}).encode('utf-8')
+        reader = MessageUploadReader(io.BytesIO(body), 'id-1', 'received')
+        reader.CHUNK_SIZE = 100
+
+        parts = iter(lambda: reader.read(300), b'')
+        sizes = []
+        content = b''
+        for part in parts:
+            sizes.append(len(part))
+            content += part
+        assert all(size == 300 for size in sizes[:-1])
+        assert json.loads(content) == {'message': {'obj': 'x' * 1000}, 'id': 'id-1', 'status': 'received'}
+
+    def test_read__when_compressor_given__should_compress_content(self):
+        codec = get_codec('gzip')
+        reader = MessageUploadReader(io.BytesIO(b'{"obj": "test"}'), 'id-1', 'received', codec.compressobj())
+        assert codec.decompress(reader.read()) == b'{"message": {"obj": "test"}, "id": "id-1", "status": "received"}'
+
+    def test_read__when_body_invalid__should_keep_error(self):
+        reader = MessageUploadReader(io.BytesIO(b'{"obj": '), 'id-1', 'received')
+        with pytest.raises(JSONStructureError):
+            reader.read()
+        assert isinstance(reader.error, JSONStructureError)
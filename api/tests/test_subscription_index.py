@@ -0,0 +1,41 @@
+from unittest import mock
+
+import pytest
+
+from api.repos import SubscriptionsRepo
+from api.subscription_index import SubscriptionIndex
+
+
+class TestSubscriptionIndex:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.repo = mock.create_autospec(SubscriptionsRepo).return_value
+        self.repo.get_subscriptions_by_pattern.return_value = {'subscription'}
+        self.repo.get_change_marker.return_value = 'marker-1'
+
+    def test_get_subscriptions__should_read_repo_once_per_topic(self):
+        index = SubscriptionIndex(self.repo, ttl=300, marker_check_interval=300)
+
+        assert index.get_subscriptions('jurisdiction.AU') == {'subscription'}
+        assert index.get_subscriptions('jurisdiction.AU') == {'subscription'}
+        assert index.get_subscriptions('jurisdiction.SG') == {'subscription'}
+        assert self.repo.get_subscriptions_by_pattern.call_count == 2
+        self.repo.get_change_marker.assert_called_once_with()
+
+    def test_get_subscriptions__when_entry_expired__should_reload_it(self):
+        index = SubscriptionIndex(self.repo, ttl=0, marker_check_interval=300)
+
+        index.get_subscriptions('jurisdiction.AU')
+        index.get_subscriptions('jurisdiction.AU')
+        assert self.repo.get_subscriptions_by_pattern.call_count == 2
+
+    def test_get_subscriptions__when_change_marker_changed__should_reload(self):
+        index = SubscriptionIndex(self.repo, ttl=300, marker_check_interval=0)
+
+        index.get_subscriptions('jurisdiction.AU')
+        index.get_subscriptions('jurisdiction.AU')
+        assert self.repo.get_subscriptions_by_pattern.call_count == 1
+
+        self.repo.get_change_marker.return_value = 'marker-2'
+        index.get_subscriptions('jurisdiction.AU')
+        assert self.repo.get_subscriptions_by_pattern.call_count == 2
@@ -0,0 +1,41 @@
+import multiprocessing
+import sys
+import threading
+import time
+
+from api.supervisor import Supervisor
+
+
+class TestSupervisor:
+    def setup_method(self):
+        self.starts = multiprocessing.Value('i', 0)
+        self.stopped = multiprocessing.Value('i', 0)
+        self.stop_event = threading.Event()
+
+    def _target(self):
+        with self.starts.get_lock():
+            self.starts.value += 1
+            crash = self.starts.value <= 2
+        if crash:
+            sys.exit(1)
+        while not self.stop_event.is_set():
+            time.sleep(0.01)
+        with self.stopped.get_lock():
+            self.stopped.value += 1
+
+    def test_supervise__should_restart_crashed_workers_and_stop_them_gracefully(self):
+        supervisor = Supervisor(self._target, workers=2, stop=self.stop_event.set, graceful_timeout=5, restart_delay=0)
+        supervisor.CHECK_INTERVAL_SECONDS = 0.05
+        # signal handlers can be installed only in the main thread, so supervise directly
+        thread = threading.Thread(target=supervisor.supervise)
+        thread.start()
+
+        deadline = time.time() + 10
+        while self.starts.value < 4 and time.time() < deadline:
+            time.sleep(0.05)
+        supervisor.stop()
+        thread.join(10)
+
+        assert self.starts.value == 4
+        assert self.stopped.value == 2
+        assert not any(process.is_alive() for process in supervisor.children.values())
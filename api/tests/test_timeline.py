@@ -0,0 +1,45 @@
+from unittest import mock
+
+import pytest
+
+from api import metrics
+from api.repos import MessageTimelineRepo
+from api.timeline import MessageTimeline
+
+
+class TestMessageTimeline:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.repo = mock.create_autospec(MessageTimelineRepo).return_value
+        self.timeline = MessageTimeline(self.repo)
+
+    def test_record__should_store_event_and_observe_stage_duration(self):
+        at = self.timeline.record('1', 'enqueued_test', at=1005.5, since=1000.0, attempt=1)
+
+        assert at == 1005.5
+        self.repo.add_event.assert_called_once_with('1', {'stage': 'enqueued_test', 'at': 1005.5, 'attempt': 1})
+        counts, total = metrics.MESSAGE_STAGE_DURATION.get(stage='enqueued_test')
+        assert (sum(counts), total) == (1, 5.5)
+
+    def test_record__when_repo_failed__should_not_raise_error(self):
+        self.repo.add_event.side_effect = Exception('Storage error')
+        self.timeline.record('1', 'received')
+
+    def test_get__should_return_events_and_durations(self):
+        self.repo.get_events.return_value = [
+            {'stage': 'received', 'at': 1000.0},
+            {'stage': 'enqueued', 'at': 1000.25},
+            {'stage': 'send_attempt', 'at': 1010.0, 'attempt': 1},
+        ]
+        assert self.timeline.get('1') == {
+            'id': '1',
+            'events': self.repo.get_events.return_value,
+            'durations': [
+                {'from': 'received', 'to': 'enqueued', 'seconds': 0.25},
+                {'from': 'enqueued', 'to': 'send_attempt', 'seconds': 9.75},
+            ],
+        }
+
+    def test_get__when_no_events__should_return_none(self):
+        self.repo.get_events.return_value = []
+        assert self.timeline.get('1') is None
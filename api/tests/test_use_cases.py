@@ -1,12 +1,55 @@
 from unittest import mock
 
 import pytest
+import requests
 from flask import url_for
 from libtrustbridge.websub.repos import NotificationsRepo
 from responses import Response
 
+from api.circuit_breaker import CircuitBreaker
 from api.models import Message, MessageStatus
-from api.use_cases import SendMessageToForeignUseCase, SendMessageFailure, ProcessMessageUseCase, PublishNewMessageUseCase
+from api.repos import (
+    ChannelRepo, ChannelQueueRepo, DeadLetterRepo, DeliveryOutboxRepo, SubscriptionsRepo,
+    SubscriptionVerificationQueueRepo
+)
+from api.use_cases import (
+    SendMessageToForeignUseCase, SendMessageFailure, ProcessMessageUseCase, PublishNewMessageUseCase,
+    ReceiveMessageUseCase, EnqueueMessageFailure, DeliverCallbackUseCase, VerifySubscriptionIntentUseCase
+)
+from api.timeline import MessageTimeline
+
+
+class TestReceiveMessageUseCase:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.channel_repo = mock.create_autospec(ChannelRepo).return_value
+        self.channel_repo.save_message.side_effect = self._save_message
+        self.queue_repo = mock.create_autospec(ChannelQueueRepo).return_value
+        self.queue_repo.enqueue_many.return_value = {}
+
+    @staticmethod
+    def _save_message(message):
+        if message.message.get('broken'):
+            raise Exception('Storage error')
+        message.id = message.message['n']
+        return message
+
+    def test_receive_many__should_save_messages_and_enqueue_them_in_batch(self):
+        messages = [Message(message={'n': str(i)}) for i in range(3)]
+        results = ReceiveMessageUseCase(self.channel_repo, self.queue_repo).receive_many(messages)
+
+        assert [(message.id, error) for message, error in results] == [('0', None), ('1', None), ('2', None)]
+        self.queue_repo.enqueue_many.assert_called_once_with(['0', '1', '2'], messages=messages)
+
+    def test_receive_many__when_some_messages_failed__should_report_errors_per_message(self):
+        self.queue_repo.enqueue_many.return_value = {'2': 'Queue error'}
+        messages = [Message(message={'n': '0'}), Message(message={'broken': True}), Message(message={'n': '2'})]
+        results = ReceiveMessageUseCase(self.channel_repo, self.queue_repo).receive_many(messages)
+
+        assert results[0][1] is None
+        assert str(results[1][1]) == 'Storage error'
+        assert isinstance(results[2][1], EnqueueMessageFailure)
+        self.queue_repo.enqueue_many.assert_called_once_with(['0', '2'], messages=[messages[0], messages[2]])
 
 
 class TestSendMessageToForeignUseCase:
@@ -35,6 +78,24 @@ class TestSendMessageToForeignUseCase:
         with pytest.raises(SendMessageFailure):
             use_case.send(self.message)
 
+    def test_send__when_request_timed_out__should_raise_exception(self):
+        self.mocked_responses.add(
+            Response(method='POST', url=self.endpoint, body=requests.Timeout())
+        )
+        use_case = SendMessageToForeignUseCase(self.endpoint)
+        with pytest.raises(SendMessageFailure):
+            use_case.send(self.message)
+
+    def test_send__when_circuit_breaker_given__should_record_failure_of_endpoint_host(self):
+        self.mocked_responses.add(
+            Response(method='POST', url=self.endpoint, body=requests.ConnectionError())
+        )
+        circuit_breaker = mock.create_autospec(CircuitBreaker).return_value
+        use_case = SendMessageToForeignUseCase(self.endpoint, circuit_breaker=circuit_breaker)
+        with pytest.raises(SendMessageFailure):
+            use_case.send(self.message)
+        circuit_breaker.record_response.assert_called_once_with('foreign_endpoint.com', None)
+
 
 @pytest.mark.usefixtures("client_class", "clean_channel_repo", "clean_channel_queue_repo", "mocked_responses")
 class TestProcessMessageUseCase:
@@ -59,6 +120,102 @@ class TestProcessMessageUseCase:
         assert self.mocked_responses.calls[0].request.body == b'{"obj": "QmQtYtUS7K1AdKjbuMsmPmPGDLaKL38M5HYwqxW9RKW49n", "predicate": "UN.CEFACT.Trade.CertificateOfOrigin.created", "receiver": "CN", "sender": "AU", "subject": "AU.abn0000000000.XXXX-XXXXX-XXXXX-XXXXXX"}'
 
 
+class TestProcessInlineMessage:
+    endpoint = 'http://foreign_endpoint.com'
+
+    @pytest.fixture(autouse=True)
+    def setup(self, mocked_responses):
+        self.mocked_responses = mocked_responses
+        self.channel_repo = mock.create_autospec(ChannelRepo).return_value
+        self.queue_repo = mock.create_autospec(ChannelQueueRepo).return_value
+
+    def test_process__when_message_inline__should_not_read_it_from_repo(self):
+        self.mocked_responses.add(Response(method='POST', url=self.endpoint))
+        payload = {
+            'message_id': '1',
+            'retry': 1,
+            'message': {'id': '1', 'message': {'receiver': 'CN'}, 'status': 'received'},
+        }
+        use_case = ProcessMessageUseCase(self.channel_repo, self.queue_repo, self.endpoint)
+        use_case.process('job-id', payload)
+
+        self.channel_repo.get_message.assert_not_called()
+        self.channel_repo.update_status.assert_called_once_with('1', MessageStatus.DELIVERED)
+        self.channel_repo.save_message.assert_not_called()
+        self.queue_repo.delete.assert_called_once_with('job-id')
+
+    def test_process__when_inline_message_already_delivered__should_delete_job_without_sending(self):
+        self.channel_repo.get_message_status.return_value = MessageStatus.DELIVERED
+        payload = {
+            'message_id': '1',
+            'retry': 1,
+            'message': {'id': '1', 'message': {'receiver': 'CN'}, 'status': 'received'},
+        }
+        use_case = ProcessMessageUseCase(self.channel_repo, self.queue_repo, self.endpoint)
+        use_case.process('job-id', payload)
+
+        assert len(self.mocked_responses.calls) == 0
+        self.channel_repo.get_message.assert_not_called()
+        self.channel_repo.update_status.assert_not_called()
+        self.queue_repo.delete.assert_called_once_with('job-id')
+
+    def test_process__when_timeline_given__should_record_send_attempt_and_delivery(self):
+        self.mocked_responses.add(Response(method='POST', url=self.endpoint))
+        payload = {
+            'message_id': '1',
+            'retry': 1,
+            'enqueued_at': 1000.0,
+            'message': {'id': '1', 'message': {'receiver': 'CN'}, 'status': 'received'},
+        }
+        timeline = mock.create_autospec(MessageTimeline).return_value
+        timeline.record.return_value = 1001.0
+        use_case = ProcessMessageUseCase(self.channel_repo, self.queue_repo, self.endpoint, timeline=timeline)
+        use_case.process('job-id', payload)
+
+        assert timeline.record.call_args_list == [
+            mock.call('1', 'send_attempt', since=1000.0, attempt=1),
+            mock.call('1', 'delivered', since=1001.0, attempt=1),
+        ]
+
+    def test_process__when_last_attempt_failed__should_mark_message_undeliverable_and_dead_letter_it(self):
+        self.mocked_responses.add(Response(method='POST', url=self.endpoint, status=500))
+        payload = {
+            'message_id': '1',
+            'retry': ProcessMessageUseCase.MAX_ATTEMPTS,
+            'message': {'id': '1', 'message': {'receiver': 'CN'}, 'status': 'received'},
+        }
+        dead_letter_repo = mock.create_autospec(DeadLetterRepo).return_value
+        use_case = ProcessMessageUseCase(
+            self.channel_repo, self.queue_repo, self.endpoint, dead_letter_repo=dead_letter_repo
+        )
+        use_case.process('job-id', payload)
+
+        self.channel_repo.update_status.assert_called_once_with('1', MessageStatus.UNDELIVERABLE)
+        dead_letter_repo.add.assert_called_once_with('messages', {'message_id': '1'}, reason=mock.ANY)
+        self.queue_repo.enqueue.assert_not_called()
+        self.queue_repo.delete.assert_called_once_with('job-id')
+
+    def test_process__when_circuit_open__should_defer_job_without_sending(self):
+        circuit_breaker = CircuitBreaker(failure_threshold=1)
+        circuit_breaker.record_failure('foreign_endpoint.com')
+        payload = {
+            'message_id': '1',
+            'retry': 2,
+            'message': {'id': '1', 'message': {'receiver': 'CN'}, 'status': 'received'},
+        }
+        use_case = ProcessMessageUseCase(
+            self.channel_repo, self.queue_repo, self.endpoint, circuit_breaker=circuit_breaker
+        )
+        use_case.process('job-id', payload)
+
+        assert len(self.mocked_responses.calls) == 0
+        args, kwargs = self.queue_repo.enqueue.call_args
+        assert args == ('1', 2)
+        assert kwargs['message'] == Message.from_dict(payload['message'])
+        assert kwargs['delay_seconds'] >= 30
+        self.queue_repo.delete.assert_called_once_with('job-id')
+
+
 class TestPublishNewMessageUseCase:
     def test_use_case__should_send_message_to_notification_queue(self):
         notifications_repo = mock.create_autospec(NotificationsRepo).return_value
@@ -72,3 +229,99 @@ class TestPublishNewMessageUseCase:
                 'id': 24
             }
         })
+
+
+class TestDeliverCallbackUseCase:
+    @pytest.fixture(autouse=True)
+    def setup(self, mocked_responses):
+        self.mocked_responses = mocked_responses
+        self.delivery_outbox_repo = mock.create_autospec(DeliveryOutboxRepo).return_value
+        self.circuit_breaker = CircuitBreaker(failure_threshold=2)
+        self.use_case = DeliverCallbackUseCase(
+            self.delivery_outbox_repo, 'http://hub.com', circuit_breaker=self.circuit_breaker
+        )
+
+    def test_process__when_callback_host_keeps_failing__should_defer_its_jobs(self):
+        self.mocked_responses.add(Response(method='POST', url='http://down.com/callback', status=503))
+        self.mocked_responses.add(Response(method='POST', url='http://up.com/callback'))
+        job = {'s': 'http://down.com/callback', 'payload': {'id': 1}}
+        self.use_case.process('1', job)
+        self.use_case.process('2', job)
+        self.use_case.process('3', job)
+        self.use_case.process('4', {'s': 'http://up.com/callback', 'payload': {'id': 1}})
+
+        assert [call.request.url for call in self.mocked_responses.calls] == [
+            'http://down.com/callback', 'http://down.com/callback', 'http://up.com/callback'
+        ]
+        deferred_job, kwargs = self.delivery_outbox_repo.post_job.call_args_list[-1]
+        assert deferred_job == ({'s': 'http://down.com/callback', 'payload': {'id': 1}, 'retry': 1},)
+        assert kwargs['delay_seconds'] >= 30
+
+
+class TestDeliverCallbackDeadLetters:
+    def test_process__when_last_attempt_failed__should_dead_letter_job(self, mocked_responses):
+        mocked_responses.add(Response(method='POST', url='http://subscriber.com/callback', status=500))
+        delivery_outbox_repo = mock.create_autospec(DeliveryOutboxRepo).return_value
+        dead_letter_repo = mock.create_autospec(DeadLetterRepo).return_value
+        use_case = DeliverCallbackUseCase(delivery_outbox_repo, 'http://hub.com', dead_letter_repo=dead_letter_repo)
+        use_case.process('1', {'s': 'http://subscriber.com/callback', 'payload': {'id': 1}, 'retry': 3})
+
+        dead_letter_repo.add.assert_called_once_with(
+            'callbacks', {'s': 'http://subscriber.com/callback', 'payload': {'id': 1}},
+            reason='Subscription url http://subscriber.com/callback seems to be invalid, returns 500'
+        )
+        delivery_outbox_repo.post_job.assert_not_called()
+        delivery_outbox_repo.delete.assert_called_once_with('1')
+
+
+class TestBatchExecute:
+    def test_execute_batch__should_process_each_received_job(self):
+        delivery_outbox_repo = mock.create_autospec(DeliveryOutboxRepo).return_value
+        delivery_outbox_repo.get_jobs.return_value = [
+            ('1', {'s': 'http://subscriber.com/callback', 'payload': {'id': 1}}),
+            ('2', {'s': 'http://subscriber.com/callback', 'payload': {'id': 2}}),
+        ]
+        use_case = DeliverCallbackUseCase(delivery_outbox_repo, 'http://hub.com')
+        with mock.patch.object(use_case, 'process', side_effect=[Exception('Failure'), None]) as process:
+            assert use_case.execute_batch(max_messages=10, wait_seconds=20) == 2
+
+        delivery_outbox_repo.get_jobs.assert_called_once_with(max_messages=10, wait_seconds=20)
+        assert process.call_count == 2
+
+    def test_execute_batch__when_job_timeout__should_hide_jobs_for_whole_batch_processing(self):
+        delivery_outbox_repo = mock.create_autospec(DeliveryOutboxRepo).return_value
+        delivery_outbox_repo.get_jobs.return_value = []
+        use_case = DeliverCallbackUseCase(delivery_outbox_repo, 'http://hub.com')
+
+        assert use_case.execute_batch(max_messages=10, wait_seconds=20, job_timeout=15) == 0
+
+        delivery_outbox_repo.get_jobs.assert_called_once_with(max_messages=10, wait_seconds=20, visibility_timeout=150)
+
+
+class TestVerifySubscriptionIntentUseCase:
+    callback = 'http://subscriber.com/callback'
+
+    @pytest.fixture(autouse=True)
+    def setup(self, mocked_responses):
+        self.mocked_responses = mocked_responses
+        self.subscriptions_repo = mock.create_autospec(SubscriptionsRepo).return_value
+        self.queue_repo = mock.create_autospec(SubscriptionVerificationQueueRepo).return_value
+        self.use_case = VerifySubscriptionIntentUseCase(self.subscriptions_repo, verification_queue_repo=self.queue_repo)
+        self.job = {'callback': self.callback, 'mode': 'subscribe', 'topic': 'jurisdiction.AU', 'lease_seconds': 3600}
+
+    def _echo_challenge(self, request):
+        return 200, {}, request.params['hub.challenge']
+
+    def test_process__when_intent_verified__should_subscribe(self):
+        self.mocked_responses.add_callback('GET', self.callback, callback=self._echo_challenge)
+        self.use_case.process('job-id', self.job)
+
+        assert self.subscriptions_repo.subscribe_by_pattern.call_count == 1
+        self.queue_repo.delete.assert_called_once_with('job-id')
+
+    def test_process__when_intent_not_verified__should_not_subscribe(self):
+        self.mocked_responses.add(Response(method='GET', url=self.callback, body='wrong'))
+        self.use_case.process('job-id', self.job)
+
+        self.subscriptions_repo.subscribe_by_pattern.assert_not_called()
+        self.queue_repo.delete.assert_called_once_with('job-id')
@@ -1,3 +1,6 @@
+import json
+from unittest import mock
+
 import pytest
 from flask import url_for
 
@@ -28,6 +31,29 @@ class TestPostMessage:
         assert payload['message_id'] == data['id']
 
 
+@pytest.mark.usefixtures("client_class", "clean_channel_repo", "clean_channel_queue_repo")
+class TestPostMessagesBatch:
+    message_data = {
+        "sender": "AU",
+        "receiver": "CN",
+        "subject": "AU.abn0000000000.XXXX-XXXXX-XXXXX-XXXXXX",
+        "obj": "QmQtYtUS7K1AdKjbuMsmPmPGDLaKL38M5HYwqxW9RKW49n",
+        "predicate": "UN.CEFACT.Trade.CertificateOfOrigin.created"
+    }
+
+    def test_post_messages_batch__should_save_and_enqueue_each_message(self):
+        response = self.client.post(url_for('views.post_messages_batch'), json=[self.message_data] * 12)
+        assert response.status_code == 200
+        results = response.json['results']
+        assert len(results) == 12
+        assert all(result['id'] and result['status'] == 'received' for result in results)
+        assert self.channel_repo.get_message(results[0]['id']).message == self.message_data
+
+    def test_post_messages_batch__when_not_list__should_return_error(self):
+        response = self.client.post(url_for('views.post_messages_batch'), json=self.message_data)
+        assert response.status_code == 400
+
+
 @pytest.mark.usefixtures("client_class", "clean_channel_repo")
 class TestGetMessage:
     def test_get_message__when_not_exist_should_return_empty_dict(self):
@@ -50,6 +76,58 @@ class TestGetMessage:
         assert response.json == {'status': 'received'}
 
 
+@pytest.mark.usefixtures("client_class", "clean_channel_repo")
+class TestFetchMessages:
+    def test_fetch_messages__should_return_messages_in_requested_order_as_ndjson(self):
+        first = self.channel_repo.save_message(Message(message={'obj': 'first'}))
+        second = self.channel_repo.save_message(Message(message={'obj': 'second'}))
+        response = self.client.post(url_for('views.fetch_messages'), json={'ids': [second.id, 'missing', first.id]})
+
+        assert response.status_code == 200
+        assert response.mimetype == 'application/x-ndjson'
+        assert [json.loads(line) for line in response.data.splitlines()] == [
+            second.to_dict(),
+            {'id': 'missing', 'error': 'Message not found'},
+            first.to_dict(),
+        ]
+
+    def test_fetch_messages__when_fields_given__should_return_just_them_with_id(self):
+        message = self.channel_repo.save_message(Message(message={'obj': 'test'}))
+        url = url_for('views.fetch_messages')
+        response = self.client.post(f'{url}?fields=status', json={'ids': [message.id]})
+        assert json.loads(response.data) == {'id': message.id, 'status': 'received'}
+
+    def test_fetch_messages__when_ids_not_list__should_return_error(self):
+        response = self.client.post(url_for('views.fetch_messages'), json={'ids': 'id'})
+        assert response.status_code == 400
+
+
+@pytest.mark.usefixtures("client_class", "clean_channel_repo", "clean_channel_queue_repo")
+class TestStreamedMessage:
+    @pytest.fixture(autouse=True)
+    def streaming(self, app):
+        with mock.patch.dict(app.config, {'MESSAGES_STREAMING_MIN_BYTES': 10}):
+            yield
+
+    def test_post_message__should_stream_body_to_repo_and_read_it_back(self):
+        message_data = {'obj': 'x' * 100, 'items': [{'n': 1}, {'n': 2}]}
+        response = self.client.post(url_for('views.post_message'), json=message_data)
+        assert response.status_code == 200
+        assert response.json['status'] == 'received'
+
+        message_id = response.json['id']
+        assert self.channel_repo.get_message(message_id).message == message_data
+        response = self.client.get(url_for('views.get_message', id=message_id))
+        assert response.json == {'id': message_id, 'message': message_data, 'status': 'received'}
+
+    def test_post_message__when_body_is_not_json_object__should_return_error(self):
+        response = self.client.post(
+            url_for('views.post_message'), data='{"obj": "test", "items": [1, 2}', content_type='application/json'
+        )
+        assert response.status_code == 400
+        assert 'error' in response.json
+
+
 @pytest.mark.usefixtures("client_class", "clean_channel_repo")
 class TestIncomingMessage:
     def test_incoming_message__should_be_saved_in_repo_and_notification_sent(self):
@@ -64,3 +142,37 @@ class TestIncomingMessage:
         assert response.status_code == 200
         assert 'id' in response.json
         assert self.channel_repo.get_message(response.json['id'])
+
+
+@pytest.mark.usefixtures("client_class")
+class TestSubscriptionByJurisdiction:
+    def test_subscribe__when_async_verification__should_enqueue_request(self, app):
+        with mock.patch.dict(app.config, {'WEBSUB_ASYNC_VERIFICATION': True}), \
+                mock.patch('api.use_cases.VerifySubscriptionIntentUseCase.enqueue') as enqueue:
+            response = self.client.post(url_for('views.subscriptions_by_jurisdiction'), data={
+                'hub.mode': 'subscribe',
+                'hub.callback': 'http://subscriber.com/callback',
+                'hub.topic': 'AU',
+            })
+
+        assert response.status_code == 202
+        enqueue.assert_called_once_with('http://subscriber.com/callback', 'subscribe', 'jurisdiction.AU', mock.ANY)
+
+
+@pytest.mark.usefixtures("client_class", "clean_channel_repo")
+class TestGetMetrics:
+    def test_get_metrics__should_return_view_durations(self):
+        self.client.get(url_for('views.get_message', id=100))
+        response = self.client.get(url_for('views.get_metrics'))
+        assert response.status_code == 200
+        assert response.content_type.startswith('text/plain')
+        assert 'api_channel_http_request_duration_seconds_count{view="views.get_message",method="GET",status="404"}' \
+            in response.get_data(as_text=True)
+
+
+@pytest.mark.usefixtures("client_class")
+class TestGetMessageTimeline:
+    def test_get_message_timeline__when_disabled__should_return_not_found(self):
+        response = self.client.get(url_for('views.get_message_timeline', id='1'))
+        assert response.status_code == 404
+        assert response.json == {'error': 'Message timeline is disabled'}
@@ -0,0 +1,57 @@
+import logging
+import time
+
+from api import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class MessageTimeline:
+    """
+    Stage events of messages passing the pipeline:
+        received, enqueued - message is received by the API and put to the channel queue
+        send_attempt, send_failed, delivered - sending message to the foreign endpoint
+        notified - notification about the incoming message is published for subscribers
+        callback_delivered, callback_failed - delivery of the notification to a subscriber
+
+    Events are stored by the repo (if given), failing to store them is logged only,
+    so it never breaks the pipeline. Time since the previous stage, when it's known
+    to the recording process, is observed by the message stage histogram,
+    so stage latencies can be aggregated over all messages even without the repo.
+    """
+
+    def __init__(self, repo=None):
+        self.repo = repo
+
+    def record(self, message_id, stage, at=None, since=None, **details):
+        """Record stage event, returns its time"""
+        at = at or time.time()
+        if since is not None:
+            metrics.MESSAGE_STAGE_DURATION.observe(max(at - since, 0), stage=stage)
+        if self.repo:
+            try:
+                self.repo.add_event(str(message_id), dict(details, stage=stage, at=at))
+            except Exception as e:
+                logger.exception(e)
+        return at
+
+    def get(self, message_id):
+        """Events of the message and time between consecutive events, None if there are no events"""
+        events = self.repo.get_events(message_id)
+        if not events:
+            return None
+        return {
+            'id': message_id,
+            'events': events,
+            'durations': [
+                {'from': previous['stage'], 'to': event['stage'], 'seconds': round(event['at'] - previous['at'], 6)}
+                for previous, event in zip(events, events[1:])
+            ],
+        }
+
+
+def create_message_timeline(config, repos):
+    """Timeline storing events if MESSAGE_TIMELINE_ENABLED, otherwise observing stage metrics only"""
+    if config['MESSAGE_TIMELINE_ENABLED']:
+        return MessageTimeline(repos.timeline)
+    return MessageTimeline()
@@ -1,38 +1,138 @@
 import logging
 import random
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from libtrustbridge.utils import get_retry_time
 from libtrustbridge.websub import repos
+from libtrustbridge.websub.constants import MODE_ATTR_SUBSCRIBE_VALUE
 from libtrustbridge.websub.domain import Pattern
 
+from api import metrics
+from api.circuit_breaker import CircuitBreaker
+from api.http_client import HttpClient
 from api.models import MessageStatus, Message
-from api.repos import ChannelRepo, ChannelQueueRepo
+from api.repos import ChannelRepo, ChannelQueueRepo, DeadLetterRepo, SubscriptionVerificationQueueRepo
+from api.timeline import MessageTimeline
 
 logger = logging.getLogger(__name__)
 
 
+class BatchExecuteMixin:
+    """
+    Process jobs of the use case's source queue in batches,
+    source queue should implement get_jobs(max_messages, wait_seconds, visibility_timeout)
+    """
+
+    def get_source_queue(self):
+        raise NotImplementedError
+
+    def execute_batch(self, max_messages=10, wait_seconds=0, job_timeout=None):
+        """
+        Returns number of received jobs.
+
+        Jobs are processed one by one, so with job_timeout (max seconds of a single job)
+        the received jobs are hidden from other workers for job_timeout * max_messages,
+        otherwise the last jobs of the batch could reappear in the queue while still waiting
+        and be processed twice
+        """
+        kwargs = {}
+        if job_timeout:
+            kwargs['visibility_timeout'] = job_timeout * max_messages
+        jobs = self.get_source_queue().get_jobs(max_messages=max_messages, wait_seconds=wait_seconds, **kwargs)
+        for job in jobs:
+            try:
+                self.process(*job)
+            except Exception as e:
+                logger.exception(e)
+        return len(jobs)
+
+
+class EnqueueMessageFailure(Exception):
+    pass
+
+
 class ReceiveMessageUseCase:
-    def __init__(self, channel_repo: ChannelRepo, channel_queue_repo: ChannelQueueRepo):
+    MAX_WORKERS = 10
+
+    def __init__(
+            self, channel_repo: ChannelRepo, channel_queue_repo: ChannelQueueRepo, timeline: MessageTimeline = None):
         self.channel_repo = channel_repo
         self.queue_repo = channel_queue_repo
+        self.timeline = timeline
 
     def receive(self, message: Message):
+        received_at = time.time()
         message = self.channel_repo.save_message(message)
+        self.queue_repo.enqueue(str(message.id), message=message)
+        self._record_received(message, received_at)
+        return message
+
+    def receive_stream(self, stream, part_size):
+        """Save message streamed from the request body (see ChannelRepo.save_message_stream) and enqueue it"""
+        received_at = time.time()
+        message = self.channel_repo.save_message_stream(stream, part_size)
         self.queue_repo.enqueue(str(message.id))
+        self._record_received(message, received_at)
         return message
 
+    def receive_many(self, messages):
+        """
+        Save messages concurrently and enqueue them in batches.
+
+        Returns list of (message, error) pairs in the same order as given messages,
+        error is None for messages which were saved and enqueued successfully.
+        """
+        if not messages:
+            return []
+
+        received_at = time.time()
+        with ThreadPoolExecutor(max_workers=min(self.MAX_WORKERS, len(messages))) as executor:
+            futures = [executor.submit(self.channel_repo.save_message, message) for message in messages]
+
+        results = []
+        for message, future in zip(messages, futures):
+            error = future.exception()
+            if error:
+                logger.error("Saving message failed: %r", error)
+            results.append((message, error))
+
+        saved_messages = [message for message, error in results if not error]
+        failed = self.queue_repo.enqueue_many([str(message.id) for message in saved_messages], messages=saved_messages)
+        for index, (message, error) in enumerate(results):
+            if not error and str(message.id) in failed:
+                results[index] = (message, EnqueueMessageFailure(failed[str(message.id)]))
+            elif not error:
+                self._record_received(message, received_at)
+        return results
+
+    def _record_received(self, message, received_at):
+        if self.timeline:
+            self.timeline.record(message.id, 'received', at=received_at)
+            self.timeline.record(message.id, 'enqueued', since=received_at)
+
 
 class SendMessageFailure(Exception):
     pass
 
 
 class SendMessageToForeignUseCase:
-    def __init__(self, foreign_endpoint):
+    def __init__(self, foreign_endpoint, http_client: HttpClient = None, circuit_breaker: CircuitBreaker = None):
         self.foreign_endpoint = foreign_endpoint
+        self.http_client = http_client or HttpClient()
+        self.circuit_breaker = circuit_breaker
 
     def send(self, message: Message):
-        response = requests.post(url=self.foreign_endpoint, json=message.message)
+        response = None
+        try:
+            response = self.http_client.post(url=self.foreign_endpoint, json=message.message)
+        except requests.RequestException as e:
+            raise SendMessageFailure("Foreign endpoint request failed: %r" % e) from e
+        finally:
+            if self.circuit_breaker:
+                self.circuit_breaker.record_response(CircuitBreaker.get_host(self.foreign_endpoint), response)
         if response.status_code == 200:
             message.status = MessageStatus.DELIVERED
             return
@@ -40,16 +140,35 @@ class SendMessageToForeignUseCase:
         raise SendMessageFailure("Foreign endpoint responded with non-OK response (%d): %r" % (response.status_code, response.text))
 
 
-class ProcessMessageUseCase:
+class ProcessMessageUseCase(BatchExecuteMixin):
     """
-    Given new job appears in the queue, get message from the repo and try to send it
+    Given new job appears in the queue, get message from the repo
+    (or from the job itself, if it was put there inline) and try to send it.
+    Inline message is as it was received, so only the status of the stored message is read
+    to skip jobs of already delivered messages (redelivered after visibility timeout or failed delete).
+    Job is deleted from the queue once it's processed, failed attempt is re-scheduled as a new job.
+
+    If circuit breaker is given and the circuit of the foreign endpoint is open,
+    the job is deferred (re-scheduled with the same attempt number) without sending.
+
+    After the last failed attempt the message is marked undeliverable
+    and the job is put to the dead letters, if the repo is given.
     """
     MAX_ATTEMPTS = 3
 
-    def __init__(self, channel_repo: ChannelRepo, channel_queue_repo: ChannelQueueRepo, foreign_endpoint):
+    def __init__(
+            self, channel_repo: ChannelRepo, channel_queue_repo: ChannelQueueRepo, foreign_endpoint,
+            http_client: HttpClient = None, timeline: MessageTimeline = None,
+            circuit_breaker: CircuitBreaker = None, dead_letter_repo: DeadLetterRepo = None):
         self.channel_repo = channel_repo
         self.queue_repo = channel_queue_repo
-        self.use_case = SendMessageToForeignUseCase(foreign_endpoint)
+        self.use_case = SendMessageToForeignUseCase(foreign_endpoint, http_client, circuit_breaker)
+        self.timeline = timeline
+        self.circuit_breaker = circuit_breaker
+        self.dead_letters = dead_letter_repo
+
+    def get_source_queue(self):
+        return self.queue_repo
 
     def execute(self):
         job = self.queue_repo.get_job()
@@ -57,23 +176,58 @@ class ProcessMessageUseCase:
             return
         return self.process(*job)
 
+    @metrics.observe_process
     def process(self, job_id, payload):
         message_id = payload['message_id']
         attempt = payload['retry']
 
-        message = self.channel_repo.get_message(message_id)
+        if self.circuit_breaker:
+            delay = self.circuit_breaker.get_deferral(CircuitBreaker.get_host(self.use_case.foreign_endpoint))
+            if delay is not None:
+                logger.info("[%s] foreign endpoint circuit is open, defer sending for %ds", job_id, delay)
+                message = Message.from_dict(payload['message']) if 'message' in payload else None
+                self.queue_repo.enqueue(message_id, attempt, message=message, delay_seconds=delay)
+                self.queue_repo.delete(job_id)
+                metrics.DEFERRALS.inc(use_case=self.__class__.__name__, reason='circuit_open')
+                return
+
+        if 'message' in payload:
+            message = Message.from_dict(payload['message'])
+            if self.channel_repo.get_message_status(message_id) == MessageStatus.DELIVERED:
+                message.status = MessageStatus.DELIVERED
+        else:
+            message = self.channel_repo.get_message(message_id)
         logger.info("Processing message with message_id [%s], attempt: %d,  %r", message_id, attempt, message)
         if message.status == MessageStatus.DELIVERED:
+            self.queue_repo.delete(job_id)
             return
 
+        started_at = None
+        if self.timeline:
+            started_at = self.timeline.record(
+                message_id, 'send_attempt', since=payload.get('enqueued_at'), attempt=attempt
+            )
         try:
             self.use_case.send(message)
-            self.channel_repo.save_message(message)
-        except SendMessageFailure:
+            self.channel_repo.update_status(message_id, message.status)
+            if self.timeline:
+                self.timeline.record(message_id, 'delivered', since=started_at, attempt=attempt)
+        except SendMessageFailure as e:
             logger.info("[%s] sending message failed", job_id)
+            if self.timeline:
+                self.timeline.record(message_id, 'send_failed', since=started_at, attempt=attempt)
             if attempt < self.MAX_ATTEMPTS:
                 logger.info("[%s] re-schedule sending message", job_id)
                 self.queue_repo.enqueue(message_id, attempt + 1)
+                metrics.RETRIES.inc(use_case=self.__class__.__name__)
+            else:
+                logger.warning("[%s] message %s is undeliverable after %d attempts", job_id, message_id, attempt)
+                self.channel_repo.update_status(message_id, MessageStatus.UNDELIVERABLE)
+                if self.dead_letters:
+                    self.dead_letters.add('messages', {'message_id': message_id}, reason=str(e))
+                metrics.DROPS.inc(use_case=self.__class__.__name__)
+
+        self.queue_repo.delete(job_id)
 
 
 class SubscriptionRegisterUseCase:
@@ -92,6 +246,7 @@ class SubscriptionRegisterUseCase:
         # and replaces them with new one. Techically it's create or update operation
 
         self.subscriptions_repo.subscribe_by_pattern(Pattern(topic), url, expiration)
+        self.subscriptions_repo.mark_changed()
 
 
 class SubscriptionNotFound(Exception):
@@ -115,6 +270,83 @@ class SubscriptionDeregisterUseCase:
         if not subscriptions_by_url:
             raise SubscriptionNotFound()
         self.subscriptions_repo.bulk_delete([pattern.to_key(url)])
+        self.subscriptions_repo.mark_changed()
+
+
+class IntentVerificationFailure(Exception):
+    pass
+
+
+class VerifySubscriptionIntentUseCase(BatchExecuteMixin):
+    """
+    Used by the subscription API and by the subscription verifier worker
+
+    Verifies intent of the subscriber
+    https://www.w3.org/TR/websub/#hub-verifies-intent
+    and then subscribes or unsubscribes it.
+
+    The API either verifies requests at once
+    or puts them to the verification queue (enqueue),
+    the worker reads queued requests (execute_batch)
+    and processes them, so slow callback hosts don't hold API workers.
+    """
+
+    def __init__(
+            self, subscriptions_repo: repos.SubscriptionsRepo, http_client: HttpClient = None,
+            verification_queue_repo: SubscriptionVerificationQueueRepo = None):
+        self.subscriptions_repo = subscriptions_repo
+        self.http_client = http_client or HttpClient()
+        self.verification_queue = verification_queue_repo
+
+    def get_source_queue(self):
+        return self.verification_queue
+
+    def enqueue(self, callback, mode, topic, lease_seconds):
+        self.verification_queue.post_job({
+            'callback': callback,
+            'mode': mode,
+            'topic': topic,
+            'lease_seconds': lease_seconds,
+        })
+
+    @metrics.observe_process
+    def process(self, job_id, payload):
+        callback = payload['callback']
+        mode = payload['mode']
+        topic = payload['topic']
+        try:
+            self.verify(callback, mode, topic, payload['lease_seconds'])
+            self.apply(callback, mode, topic, payload['lease_seconds'])
+        except IntentVerificationFailure:
+            logger.info("[%s] intent verification failed for the %s", job_id, callback)
+        except SubscriptionNotFound:
+            logger.info("[%s] subscription of %s to %s not found", job_id, callback, topic)
+        self.verification_queue.delete(job_id)
+
+    def verify(self, callback_url, mode, topic, lease_seconds):
+        challenge = str(uuid.uuid4())
+        params = {
+            'hub.mode': mode,
+            'hub.topic': topic,
+            'hub.challenge': challenge,
+            'hub.lease_seconds': lease_seconds
+        }
+        try:
+            response = self.http_client.get(callback_url, params)
+        except requests.RequestException as e:
+            raise IntentVerificationFailure() from e
+        if response.status_code == 200 and response.text == challenge:
+            return
+
+        raise IntentVerificationFailure()
+
+    def apply(self, callback, mode, topic, lease_seconds):
+        if mode == MODE_ATTR_SUBSCRIBE_VALUE:
+            logger.info("Subscribed %s to %s", callback, topic)
+            SubscriptionRegisterUseCase(self.subscriptions_repo).execute(callback, topic, lease_seconds)
+        else:
+            logger.info("Unsubscribed %s from %s", callback, topic)
+            SubscriptionDeregisterUseCase(self.subscriptions_repo).execute(callback, topic)
 
 
 class PublishNewMessageUseCase:
@@ -122,9 +354,10 @@ class PublishNewMessageUseCase:
     Given new message,
     message id should be posted for notification"""
 
-    def __init__(self, endpoint, notification_repo: repos.NotificationsRepo):
+    def __init__(self, endpoint, notification_repo: repos.NotificationsRepo, timeline: MessageTimeline = None):
         self.notifications_repo = notification_repo
         self.endpoint = endpoint
+        self.timeline = timeline
 
     def publish(self, message: Message):
         job_payload = {
@@ -133,9 +366,11 @@ class PublishNewMessageUseCase:
         }
         logger.debug('publish notification %r', job_payload)
         self.notifications_repo.post_job(job_payload)
+        if self.timeline:
+            self.timeline.record(message.id, 'notified')
 
 
-class DispatchMessageToSubscribersUseCase:
+class DispatchMessageToSubscribersUseCase(BatchExecuteMixin):
     """
     Used by the callbacks spreader worker.
 
@@ -152,15 +387,23 @@ class DispatchMessageToSubscribersUseCase:
     it is insulated from this process
     by the delivery outbox message queue.
 
+    If subscription index is given, subscribers are looked up
+    in the index instead of the subscriptions repo.
+
     """
 
     def __init__(
             self, notifications_repo: repos.NotificationsRepo,
             delivery_outbox_repo: repos.DeliveryOutboxRepo,
-            subscriptions_repo: repos.SubscriptionsRepo):
+            subscriptions_repo: repos.SubscriptionsRepo,
+            subscription_index=None):
         self.notifications = notifications_repo
         self.delivery_outbox = delivery_outbox_repo
         self.subscriptions = subscriptions_repo
+        self.subscription_index = subscription_index
+
+    def get_source_queue(self):
+        return self.notifications
 
     def execute(self):
         job = self.notifications.get_job()
@@ -168,6 +411,7 @@ class DispatchMessageToSubscribersUseCase:
             return
         return self.process(*job)
 
+    @metrics.observe_process
     def process(self, msg_id, payload):
         subscriptions = self._get_subscriptions(payload['topic'])
 
@@ -190,8 +434,10 @@ class DispatchMessageToSubscribersUseCase:
         self.notifications.delete(msg_id)
 
     def _get_subscriptions(self, topic):
-        pattern = repos.Pattern(topic)
-        subscribers = self.subscriptions.get_subscriptions_by_pattern(pattern)
+        if self.subscription_index:
+            subscribers = self.subscription_index.get_subscriptions(topic)
+        else:
+            subscribers = self.subscriptions.get_subscriptions_by_pattern(repos.Pattern(topic))
         if not subscribers:
             logger.info("Nobody to notify about the topic %s", topic)
         else:
@@ -203,7 +449,7 @@ class InvalidCallbackResponse(Exception):
     pass
 
 
-class DeliverCallbackUseCase:
+class DeliverCallbackUseCase(BatchExecuteMixin):
     """
     Is used by a callback deliverer worker
 
@@ -214,13 +460,27 @@ class DeliverCallbackUseCase:
     or, in case of any error, not to be re-scheduled again
     (up to MAX_ATTEMPTS times)
 
+    If circuit breaker is given and the circuit of the callback host is open,
+    the task is deferred (re-scheduled with the same attempt number) without delivery.
+
+    After the last failed attempt the task is put to the dead letters, if the repo is given.
     """
 
     MAX_ATTEMPTS = 3
 
-    def __init__(self, delivery_outbox_repo: repos.DeliveryOutboxRepo, hub_url):
+    def __init__(
+            self, delivery_outbox_repo: repos.DeliveryOutboxRepo, hub_url, http_client: HttpClient = None,
+            timeline: MessageTimeline = None, circuit_breaker: CircuitBreaker = None,
+            dead_letter_repo: DeadLetterRepo = None):
         self.delivery_outbox = delivery_outbox_repo
         self.hub_url = hub_url
+        self.http_client = http_client or HttpClient()
+        self.timeline = timeline
+        self.circuit_breaker = circuit_breaker
+        self.dead_letters = dead_letter_repo
+
+    def get_source_queue(self):
+        return self.delivery_outbox
 
     def execute(self):
         deliverable = self.delivery_outbox.get_job()
@@ -230,24 +490,54 @@ class DeliverCallbackUseCase:
         queue_msg_id, payload = deliverable
         return self.process(queue_msg_id, payload)
 
+    @metrics.observe_process
     def process(self, queue_msg_id, job):
         subscribe_url = job['s']
         payload = job['payload']
         attempt = int(job.get('retry', 1))
 
+        if self.circuit_breaker:
+            delay = self.circuit_breaker.get_deferral(CircuitBreaker.get_host(subscribe_url))
+            if delay is not None:
+                logger.info("[%s] circuit of %s is open, defer delivery for %ds", queue_msg_id, subscribe_url, delay)
+                self.defer(queue_msg_id, job, delay)
+                metrics.DEFERRALS.inc(use_case=self.__class__.__name__, reason='circuit_open')
+                return
+
+        started_at = time.time()
         try:
             logger.debug('[%s] deliver notification to %s with payload: %s (attempt %s)',
                          queue_msg_id, subscribe_url, payload, attempt)
             self._deliver_notification(subscribe_url, payload)
+            self._record(payload, 'callback_delivered', started_at, subscribe_url, attempt)
         except InvalidCallbackResponse as e:
             logger.info("[%s] delivery failed", queue_msg_id)
             logger.exception(e)
+            self._record(payload, 'callback_failed', started_at, subscribe_url, attempt)
             if attempt < self.MAX_ATTEMPTS:
                 logger.info("[%s] re-schedule delivery", queue_msg_id)
                 self._retry(subscribe_url, payload, attempt)
+                metrics.RETRIES.inc(use_case=self.__class__.__name__)
+            else:
+                if self.dead_letters:
+                    # the exception is created with logging style arguments
+                    reason = e.args[0] % e.args[1:] if len(e.args) > 1 else str(e)
+                    self.dead_letters.add('callbacks', {'s': subscribe_url, 'payload': payload}, reason=reason)
+                metrics.DROPS.inc(use_case=self.__class__.__name__)
 
         self.delivery_outbox.delete(queue_msg_id)
 
+    def defer(self, queue_msg_id, job, delay_seconds):
+        """Put the job back to the outbox to be delivered after delay, the attempt is not counted"""
+        self.delivery_outbox.post_job(
+            {'s': job['s'], 'payload': job['payload'], 'retry': int(job.get('retry', 1))}, delay_seconds=delay_seconds
+        )
+        self.delivery_outbox.delete(queue_msg_id)
+
+    def _record(self, payload, stage, started_at, callback, attempt):
+        if self.timeline and isinstance(payload, dict) and payload.get('id'):
+            self.timeline.record(payload['id'], stage, since=started_at, callback=callback, attempt=attempt)
+
     def _retry(self, subscribe_url, payload, attempt):
         logger.info("Delivery failed, re-schedule it")
         job = {'s': subscribe_url, 'payload': payload, 'retry': attempt + 1}
@@ -265,12 +555,16 @@ class DeliverCallbackUseCase:
         header = {
             'Link': f'<{self.hub_url}>; rel="hub"'
         }
+        resp = None
         try:
-            resp = requests.post(url, json=payload, headers=header)
+            resp = self.http_client.post(url, json=payload, headers=header)
             if str(resp.status_code).startswith('2'):
                 return
-        except ConnectionError:
+        except (ConnectionError, requests.RequestException):
             raise InvalidCallbackResponse("Connection error, url: %s", url)
+        finally:
+            if self.circuit_breaker:
+                self.circuit_breaker.record_response(CircuitBreaker.get_host(url), resp)
 
         raise InvalidCallbackResponse("Subscription url %s seems to be invalid, "
                                       "returns %s", url, resp.status_code)
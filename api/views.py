@@ -1,24 +1,28 @@
 import json
 import logging
-import uuid
 from http import HTTPStatus
 
 import marshmallow
-import requests
 from flask import Blueprint, Response, request
 from flask import current_app
 from flask.views import View
 from libtrustbridge.utils.routing import mimetype
 from libtrustbridge.websub.constants import MODE_ATTR_SUBSCRIBE_VALUE
 from libtrustbridge.websub.exceptions import SubscriptionNotFoundError
-from libtrustbridge.websub.repos import SubscriptionsRepo, NotificationsRepo
 from libtrustbridge.websub.schemas import SubscriptionForm
 from webargs import fields
 from webargs.flaskparser import use_kwargs
 
-from api import use_cases
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from api import metrics, use_cases
+from api.conf import HUB_PATH
 from api.models import Message
-from api.repos import ChannelQueueRepo, ChannelRepo
+from api.streaming import JSONStructureError
+from api.timeline import create_message_timeline
 from api.use_cases import ReceiveMessageUseCase
 
 blueprint = Blueprint('views', __name__)
@@ -26,14 +30,25 @@ logger = logging.getLogger(__name__)
 
 
 class JsonResponse(Response):
+    """JSON response, encoded by orjson if it's installed"""
     default_mimetype = 'application/json'
 
     def __init__(self, response=None, *args, **kwargs):
         if response:
-            response = json.dumps(response)
+            response = self.dumps(response)
 
         super().__init__(response, *args, **kwargs)
 
+    @staticmethod
+    def dumps(data):
+        if orjson is not None:
+            try:
+                return orjson.dumps(data)
+            except TypeError:
+                # e.g. integers out of 64 bit range, which stdlib json supports
+                pass
+        return json.dumps(data)
+
 
 @blueprint.route('/', methods=['GET'])
 def index():
@@ -45,22 +60,78 @@ def index():
     return JsonResponse(data)
 
 
+@blueprint.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
+
+def _is_streamed_request():
+    min_bytes = current_app.config['MESSAGES_STREAMING_MIN_BYTES']
+    return bool(min_bytes) and (request.content_length or 0) >= min_bytes
+
+
 @blueprint.route('/messages', methods=['POST'])
 def post_message():
+    use_case = ReceiveMessageUseCase(current_app.repos.channel, current_app.repos.channel_queue, _get_timeline())
+    if _is_streamed_request():
+        # the document is not loaded, so only id and status are returned
+        try:
+            message = use_case.receive_stream(request.stream, current_app.config['MESSAGES_STREAMING_PART_SIZE'])
+        except JSONStructureError as e:
+            return JsonResponse({'error': str(e)}, status=HTTPStatus.BAD_REQUEST)
+        return JsonResponse({'id': message.id, 'status': message.status}, status=200)
+
     message = Message(message=json.loads(request.data))
-    channel_repo = ChannelRepo(current_app.config['CHANNEL_REPO_CONF'])
-    channel_queue_repo = ChannelQueueRepo(current_app.config['CHANNEL_QUEUE_REPO_CONF'])
-    use_case = ReceiveMessageUseCase(channel_repo, channel_queue_repo)
     use_case.receive(message)
     message_data = message.to_dict()
     return JsonResponse(message_data, status=200)
 
 
+@blueprint.route('/messages/batch', methods=['POST'])
+@mimetype('application/json')
+def post_messages_batch():
+    data = json.loads(request.data)
+    if not isinstance(data, list):
+        return JsonResponse({'error': 'List of messages expected'}, status=HTTPStatus.BAD_REQUEST)
+    max_size = current_app.config['MESSAGES_BATCH_MAX_SIZE']
+    if len(data) > max_size:
+        return JsonResponse(
+            {'error': 'Too many messages in the batch, max size is %d' % max_size},
+            status=HTTPStatus.BAD_REQUEST
+        )
+
+    use_case = ReceiveMessageUseCase(current_app.repos.channel, current_app.repos.channel_queue, _get_timeline())
+    results = use_case.receive_many([Message(message=message_data) for message_data in data])
+
+    response_data = []
+    for message, error in results:
+        if error:
+            response_data.append({'error': str(error)})
+        else:
+            response_data.append({'id': message.id, 'status': message.status})
+    return JsonResponse({'results': response_data}, status=200)
+
+
+# projections which don't need the message document, see ChannelRepo.get_message_status
+STATUS_FIELDS = {'id', 'status'}
+
+
 @blueprint.route('/messages/<id>')
 @use_kwargs({'fields': fields.DelimitedList(fields.Str())}, location="querystring")
 def get_message(id, fields=None):
-    channel_repo = ChannelRepo(current_app.config['CHANNEL_REPO_CONF'])
-    message = channel_repo.get_message(id)
+    if fields and set(fields) <= STATUS_FIELDS:
+        status = current_app.repos.channel.get_message_status(id)
+        if not status:
+            return Response(response="{}", mimetype="application/json", status=404)
+        return JsonResponse({k: v for k, v in {'id': id, 'status': status}.items() if k in fields})
+
+    if current_app.config['MESSAGES_STREAMING_MIN_BYTES'] and not fields:
+        chunks = current_app.repos.channel.get_message_stream(id)
+        if chunks is None:
+            return Response(response="{}", mimetype="application/json", status=404)
+        return Response(chunks, mimetype="application/json")
+
+    message = current_app.repos.channel.get_message(id)
     if not message:
         return Response(response="{}", mimetype="application/json", status=404)
     message_data = message.to_dict()
@@ -69,8 +140,62 @@ def get_message(id, fields=None):
     return JsonResponse(message_data)
 
 
-class IntentVerificationFailure(Exception):
-    pass
+@blueprint.route('/messages/fetch', methods=['POST'])
+@mimetype('application/json')
+@use_kwargs({'fields': fields.DelimitedList(fields.Str())}, location="querystring")
+def fetch_messages(fields=None):
+    """
+    Read messages by ids {"ids": [...]} concurrently, responds with NDJSON stream:
+    a line per id in the requested order, the message (projected to `fields`, with id)
+    or {"id": ..., "error": ...} if it's not found or reading failed
+    """
+    data = json.loads(request.data)
+    ids = data.get('ids') if isinstance(data, dict) else None
+    if not isinstance(ids, list) or not all(isinstance(message_id, str) for message_id in ids):
+        return JsonResponse({'error': 'List of message ids expected in "ids"'}, status=HTTPStatus.BAD_REQUEST)
+    max_size = current_app.config['MESSAGES_BATCH_MAX_SIZE']
+    if len(ids) > max_size:
+        return JsonResponse(
+            {'error': 'Too many ids, max size is %d' % max_size},
+            status=HTTPStatus.BAD_REQUEST
+        )
+
+    status_only = bool(fields) and set(fields) <= STATUS_FIELDS
+    results = current_app.repos.channel.get_messages(
+        ids, current_app.config['MESSAGES_FETCH_CONCURRENCY'], status_only=status_only
+    )
+
+    def generate():
+        for message_id, message, error in results:
+            if error:
+                line = {'id': message_id, 'error': 'Failed to read message'}
+            elif not message:
+                line = {'id': message_id, 'error': 'Message not found'}
+            else:
+                line = message.to_dict()
+                if fields:
+                    line = {k: v for k, v in line.items() if k in fields or k == 'id'}
+            line = JsonResponse.dumps(line)
+            yield (line.encode('utf-8') if isinstance(line, str) else line) + b'\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+@blueprint.route('/messages/<id>/timeline')
+def get_message_timeline(id):
+    if not current_app.config['MESSAGE_TIMELINE_ENABLED']:
+        return JsonResponse({'error': 'Message timeline is disabled'}, status=HTTPStatus.NOT_FOUND)
+    timeline = _get_timeline().get(id)
+    if not timeline:
+        return Response(response="{}", mimetype="application/json", status=404)
+    return JsonResponse(timeline)
+
+
+def _get_timeline():
+    return create_message_timeline(current_app.config, current_app.repos)
+
+
+IntentVerificationFailure = use_cases.IntentVerificationFailure
 
 
 class BaseSubscriptionsView(View):
@@ -89,6 +214,10 @@ class BaseSubscriptionsView(View):
         callback = form_data['callback']
         mode = form_data['mode']
         lease_seconds = form_data['lease_seconds']
+        if current_app.config['WEBSUB_ASYNC_VERIFICATION']:
+            self._get_verification_use_case().enqueue(callback, mode, topic, lease_seconds)
+            return JsonResponse(status=HTTPStatus.ACCEPTED)
+
         try:
             self.verify(callback, mode, topic, lease_seconds)
         except IntentVerificationFailure:
@@ -127,21 +256,18 @@ class BaseSubscriptionsView(View):
             raise SubscriptionNotFoundError() from e
 
     def _get_repo(self):
-        return SubscriptionsRepo(current_app.config.get('SUBSCRIPTIONS_REPO_CONF'))
+        return current_app.repos.subscriptions
 
-    def verify(self, callback_url, mode, topic, lease_seconds):
-        challenge = str(uuid.uuid4())
-        params = {
-            'hub.mode': mode,
-            'hub.topic': topic,
-            'hub.challenge': challenge,
-            'hub.lease_seconds': lease_seconds
-        }
-        response = requests.get(callback_url, params)
-        if response.status_code == 200 and response.text == challenge:
-            return
+    def _get_verification_use_case(self):
+        return use_cases.VerifySubscriptionIntentUseCase(
+            self._get_repo(),
+            http_client=current_app.http_client,
+            verification_queue_repo=current_app.repos.subscription_verifications,
+        )
 
-        raise IntentVerificationFailure()
+    def verify(self, callback_url, mode, topic, lease_seconds):
+        use_case = use_cases.VerifySubscriptionIntentUseCase(self._get_repo(), http_client=current_app.http_client)
+        use_case.verify(callback_url, mode, topic, lease_seconds)
 
 
 class SubscriptionByJurisdiction(BaseSubscriptionsView):
@@ -156,7 +282,9 @@ class SubscriptionByJurisdiction(BaseSubscriptionsView):
                     schema: SubscriptionForm
         responses:
             202:
-                description: Client successfully subscribed/unsubscribed
+                description:
+                    Client successfully subscribed/unsubscribed,
+                    or request accepted for asynchronous intent verification
             400:
                 description: Wrong params or intent verification failure
     """
@@ -166,7 +294,7 @@ class SubscriptionByJurisdiction(BaseSubscriptionsView):
 
 
 blueprint.add_url_rule(
-    '/messages/subscriptions/by_jurisdiction',
+    HUB_PATH,
     view_func=SubscriptionByJurisdiction.as_view('subscriptions_by_jurisdiction')
 )
 
@@ -174,12 +302,21 @@ blueprint.add_url_rule(
 @blueprint.route('/messages/incoming', methods=['POST'])
 @mimetype('application/json')
 def incoming_message():
-    message = Message(message=json.loads(request.data))
-    logger.debug("Received message %r", message.message)
-    channel_repo = ChannelRepo(current_app.config['CHANNEL_REPO_CONF'])
-    channel_repo.save_message(message)
-    notifications_repo = NotificationsRepo(current_app.config['NOTIFICATIONS_REPO_CONF'])
-    use_case = use_cases.PublishNewMessageUseCase(current_app.config['JURISDICTION'], notifications_repo)
+    if _is_streamed_request():
+        try:
+            message = current_app.repos.channel.save_message_stream(
+                request.stream, current_app.config['MESSAGES_STREAMING_PART_SIZE']
+            )
+        except JSONStructureError as e:
+            return JsonResponse({'error': str(e)}, status=HTTPStatus.BAD_REQUEST)
+        logger.debug("Received streamed message %s", message.id)
+    else:
+        message = Message(message=json.loads(request.data))
+        logger.debug("Received message %r", message.message)
+        current_app.repos.channel.save_message(message)
+    use_case = use_cases.PublishNewMessageUseCase(
+        current_app.config['JURISDICTION'], current_app.repos.notifications, _get_timeline()
+    )
     use_case.publish(message)
     return JsonResponse({
         'status': 'delivered',
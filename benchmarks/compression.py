@@ -0,0 +1,99 @@
+"""
+Compression ratio and throughput of stored messages codecs.
+
+Payloads imitate trade documents sent through the channel: message envelope
+with a certificate of origin containing a list of consignment items.
+
+Usage:
+    python -m benchmarks.compression [--sizes 2000,20000,200000,2000000] [--repeat 20]
+
+Prints JSON results, one entry per codec/level/payload size.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+
+from api.compression import CODECS, get_codec
+
+
+def make_payload(size, seed=0):
+    rnd = random.Random(seed)
+    items = []
+    document = {
+        "sender": "AU",
+        "receiver": "SG",
+        "subject": "AU.abn0000000000.XXXX-XXXXX-XXXXX-XXXXXX",
+        "obj": "QmQtYtUS7K1AdKjbuMsmPmPGDLaKL38M5HYwqxW9RKW49n",
+        "predicate": "UN.CEFACT.Trade.CertificateOfOrigin.created",
+        "document": {
+            "certificateOfOrigin": {
+                "issueDateTime": "2020-06-30T10:15:00+10:00",
+                "exporter": {"name": "Example Exports Pty Ltd", "postalAddress": {"countryCode": "AU"}},
+                "importer": {"name": "Example Imports Pte Ltd", "postalAddress": {"countryCode": "SG"}},
+                "items": items,
+            }
+        }
+    }
+    document_size = len(json.dumps(document))
+    while document_size < size:
+        item = {
+            "sequenceNumber": len(items) + 1,
+            "description": rnd.choice(["Frozen beef", "Wine", "Wheat", "Barley", "Wool", "Milk powder"]),
+            "hsCode": "%06d" % rnd.randint(10000, 999999),
+            "grossWeight": {"value": round(rnd.uniform(1, 10000), 2), "unitCode": "KGM"},
+            "originCountry": {"code": "AU", "name": "Australia"},
+            "originCriterion": rnd.choice(["WO", "PE", "PSR"]),
+        }
+        items.append(item)
+        document_size += len(json.dumps(item)) + 2
+    return json.dumps(document).encode('utf-8')
+
+
+def measure(codec, payload, repeat):
+    started = time.perf_counter()
+    for i in range(repeat):
+        compressed = codec.compress(payload)
+    compress_seconds = (time.perf_counter() - started) / repeat
+
+    started = time.perf_counter()
+    for i in range(repeat):
+        codec.decompress(compressed)
+    decompress_seconds = (time.perf_counter() - started) / repeat
+
+    megabytes = len(payload) / 1024 / 1024
+    return {
+        'codec': codec.name,
+        'level': codec.level,
+        'size': len(payload),
+        'compressed_size': len(compressed),
+        'ratio': round(len(payload) / len(compressed), 2),
+        'compress_mb_s': round(megabytes / compress_seconds, 1),
+        'decompress_mb_s': round(megabytes / decompress_seconds, 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='2000,20000,200000,2000000')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+        payload = make_payload(size)
+        for name in CODECS:
+            for level in (1, None, 9):
+                try:
+                    codec = get_codec(name, level)
+                except ImportError as e:
+                    print(e, file=sys.stderr)
+                    break
+                results.append(measure(codec, payload, args.repeat))
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+"""
+End-to-end throughput and latency of the message pipeline:
+
+    ReceiveMessageUseCase -> ProcessMessageUseCase -> foreign /messages/incoming
+    -> DispatchMessageToSubscribersUseCase -> DeliverCallbackUseCase -> subscriber callbacks
+
+Runs everything in one process on the local repos backend (see api.backends).
+The foreign channel is this app itself served by an in-process HTTP server,
+subscribers are an in-process HTTP server answering 200 to every callback.
+Every stage runs in its own worker threads, the same way processors do.
+
+Stage latencies are durations of the single job processing (receive - of the receive call,
+incoming - of the foreign endpoint request), end_to_end is the time from the receive call
+until the callback reached the subscriber, so it includes queue delays (e.g. the delay
+of the channel queue jobs) and waiting for the processors.
+
+Usage:
+    python -m benchmarks.pipeline [--sizes 1000,10000,100000] [--subscribers 1,10] [--messages 200]
+
+Prints JSON results, one entry per payload size/subscribers count.
+"""
+import argparse
+import io
+import json
+import logging
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from werkzeug.serving import make_server
+
+from api.app import create_app
+from api.conf import Config
+from api.models import Message
+from api.use_cases import (
+    ReceiveMessageUseCase, ProcessMessageUseCase, DispatchMessageToSubscribersUseCase, DeliverCallbackUseCase,
+    SubscriptionRegisterUseCase,
+)
+from benchmarks.compression import make_payload
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return None
+    index = min(int(round(percent / 100 * len(sorted_values) + 0.5)) - 1, len(sorted_values) - 1)
+    return sorted_values[max(index, 0)]
+
+
+class Recorder:
+    """Thread-safe collector of per stage durations (seconds)"""
+
+    def __init__(self):
+        self.durations = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.durations.setdefault(stage, []).append(seconds)
+
+    def wrap(self, stage, func):
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - started)
+        return timed
+
+    def summary(self):
+        summary = {}
+        for stage, durations in self.durations.items():
+            durations = sorted(durations)
+            summary[stage] = {
+                'count': len(durations),
+                'p50_ms': round(percentile(durations, 50) * 1000, 2),
+                'p95_ms': round(percentile(durations, 95) * 1000, 2),
+                'p99_ms': round(percentile(durations, 99) * 1000, 2),
+            }
+        return summary
+
+
+class IncomingTracker:
+    """
+    WSGI middleware in front of the foreign endpoint, maps ids of the messages created
+    by /messages/incoming to the benchmark message subject, so callbacks can be matched
+    with the received messages
+    """
+
+    def __init__(self, wsgi_app, recorder):
+        self.wsgi_app = wsgi_app
+        self.recorder = recorder
+        self.subjects = {}
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') != '/messages/incoming':
+            return self.wsgi_app(environ, start_response)
+
+        started = time.perf_counter()
+        body = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+        environ['wsgi.input'] = io.BytesIO(body)
+        response = b''.join(self.wsgi_app(environ, start_response))
+        self.recorder.add('incoming', time.perf_counter() - started)
+        try:
+            self.subjects[json.loads(response)['id']] = json.loads(body)['subject']
+        except (ValueError, KeyError):
+            pass
+        return [response]
+
+
+class SubscriberServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SubscriberHandler)
+        self.received = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+
+class SubscriberHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        with self.server.lock:
+            self.server.received.append((time.perf_counter(), json.loads(body)['id']))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_workers(stop, use_case, threads):
+    def work():
+        while not stop.is_set():
+            use_case.execute_batch(max_messages=10, wait_seconds=1)
+
+    workers = [threading.Thread(target=work, daemon=True) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+def run_scenario(size, subscribers, messages, threads, clients, timeout):
+    recorder = Recorder()
+    subscriber_server = SubscriberServer()
+    foreign_server = None
+    stop = threading.Event()
+    workers = []
+
+    with tempfile.TemporaryDirectory() as local_dir:
+        config = type('BenchmarkConfig', (Config,), {
+            'DEBUG': False,
+            'REPOS_BACKEND': 'local',
+            'LOCAL_BACKEND_DIR': local_dir,
+            'HTTP_POOL_MAXSIZE': max(threads, clients),
+        })
+        app = create_app(config)
+        logging.disable(logging.INFO)
+        tracker = IncomingTracker(app.wsgi_app, recorder)
+        try:
+            foreign_server = make_server('127.0.0.1', 0, tracker, threaded=True)
+            threading.Thread(target=foreign_server.serve_forever, daemon=True).start()
+            foreign_endpoint = 'http://127.0.0.1:%d/messages/incoming' % foreign_server.server_port
+            threading.Thread(target=subscriber_server.serve_forever, daemon=True).start()
+
+            repos = app.repos
+            for queue in (repos.channel_queue, repos.notifications, repos.delivery_outbox):
+                queue._unsafe_method__clear()
+            topic = 'jurisdiction.%s' % app.config['JURISDICTION']
+            for index in range(subscribers):
+                SubscriptionRegisterUseCase(repos.subscriptions).execute(
+                    '%s/callbacks/%d' % (subscriber_server.url, index), topic, 3600
+                )
+
+            stages = [
+                ('process', ProcessMessageUseCase(
+                    repos.channel, repos.channel_queue, foreign_endpoint, http_client=app.http_client
+                )),
+                ('dispatch', DispatchMessageToSubscribersUseCase(
+                    repos.notifications, repos.delivery_outbox, repos.subscriptions
+                )),
+                ('deliver', DeliverCallbackUseCase(
+                    repos.delivery_outbox, app.config['HUB_URL'], http_client=app.http_client
+                )),
+            ]
+            for stage, use_case in stages:
+                use_case.process = recorder.wrap(stage, use_case.process)
+                workers.extend(run_workers(stop, use_case, threads))
+
+            payload = json.loads(make_payload(size).decode('utf-8'))
+            receive_use_case = ReceiveMessageUseCase(repos.channel, repos.channel_queue)
+            receive = recorder.wrap('receive', receive_use_case.receive)
+            received_at = {}
+
+            def send(index):
+                subject = 'benchmark.%d' % index
+                received_at[subject] = time.perf_counter()
+                receive(Message(message=dict(payload, subject=subject)))
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=clients) as executor:
+                list(executor.map(send, range(messages)))
+            received_seconds = time.perf_counter() - started
+
+            expected = messages * subscribers
+            deadline = time.monotonic() + timeout
+            while len(subscriber_server.received) < expected and time.monotonic() < deadline:
+                time.sleep(0.01)
+            elapsed = time.perf_counter() - started
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join()
+            if foreign_server:
+                foreign_server.shutdown()
+            subscriber_server.shutdown()
+            subscriber_server.server_close()
+            app.http_client.close()
+            logging.disable(logging.NOTSET)
+
+    finished = {}
+    for delivered_at, message_id in subscriber_server.received:
+        subject = tracker.subjects.get(message_id)
+        if subject in received_at:
+            recorder.add('end_to_end', delivered_at - received_at[subject])
+            finished[subject] = max(finished.get(subject, 0), delivered_at)
+
+    return {
+        'payload_size': size,
+        'subscribers': subscribers,
+        'messages': messages,
+        'threads': threads,
+        'clients': clients,
+        'delivered': len(subscriber_server.received),
+        'expected_deliveries': expected,
+        'elapsed_seconds': round(elapsed, 3),
+        'receive_messages_per_second': round(messages / received_seconds, 1),
+        'messages_per_second': round(len(finished) / elapsed, 1),
+        'deliveries_per_second': round(len(subscriber_server.received) / elapsed, 1),
+        'stages': recorder.summary(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1000,10000,100000')
+    parser.add_argument('--subscribers', default='1,10')
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=4, help='worker threads per stage')
+    parser.add_argument('--clients', type=int, default=4, help='threads receiving messages')
+    parser.add_argument('--timeout', type=int, default=120, help='max seconds to wait for deliveries')
+    args = parser.parse_args(argv)
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+        for subscribers in [int(count) for count in args.subscribers.split(',')]:
+            result = run_scenario(size, subscribers, args.messages, args.threads, args.clients, args.timeout)
+            if result['delivered'] < result['expected_deliveries']:
+                print(
+                    'Only %(delivered)d of %(expected_deliveries)d callbacks delivered '
+                    'for payload size %(payload_size)d, %(subscribers)d subscribers' % result,
+                    file=sys.stderr
+                )
+            results.append(result)
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
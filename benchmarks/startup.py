@@ -0,0 +1,104 @@
+"""
+Startup time of the entry points, each started in a fresh interpreter:
+
+    interpreter - bare interpreter, the floor of all the others
+    web_app - create_app() with the views, as the API server
+    command - create_app(with_views=False) and the commands, as manage.py processors
+    lambda_import - import of the Lambda handlers module (cold start before the first invocation)
+    lambda_first_use - Lambda handlers config, repos and use case creation (the first invocation)
+
+Apps use the local repos backend (see api.backends), so nothing is connected to.
+Startup time is the wall time of the whole interpreter process, modules - number of modules loaded.
+Which modules take the time is reported by `manage.py import_time_report`.
+
+Usage:
+    python -m benchmarks.startup [--repeat 10] [--save results.json] [--baseline results.json] [--tolerance 0.25]
+
+Prints JSON results, one entry per entry point. With --baseline the medians are compared
+to the saved results of the same machine, and the exit code is 1 if any of them
+is slower than the baseline by more than the tolerance.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SCENARIOS = (
+    ('interpreter', 'pass'),
+    ('web_app', 'from api.app import create_app; create_app()'),
+    ('command', 'from api.app import create_app; from api import commands; create_app(with_views=False)'),
+    ('lambda_import', 'import api.lambda_handlers'),
+    ('lambda_first_use', 'from api.lambda_handlers import processors; processors.get_use_case("deliver_callbacks")'),
+)
+
+
+def measure(name, code, repeat, env):
+    durations = []
+    modules = None
+    for i in range(repeat):
+        started = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, '-c', code + '; import sys; print(len(sys.modules))'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, env=env,
+        )
+        durations.append(time.perf_counter() - started)
+        if result.returncode:
+            raise RuntimeError('%s failed:\n%s' % (name, result.stderr))
+        modules = int(result.stdout.split()[-1])
+    return {
+        'name': name,
+        'repeat': repeat,
+        'min_ms': round(min(durations) * 1000, 1),
+        'median_ms': round(statistics.median(durations) * 1000, 1),
+        'max_ms': round(max(durations) * 1000, 1),
+        'modules': modules,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Returns descriptions of the results slower than the baseline by more than the tolerance"""
+    baseline = {result['name']: result for result in baseline}
+    regressions = []
+    for result in results:
+        previous = baseline.get(result['name'])
+        if previous and result['median_ms'] > previous['median_ms'] * (1 + tolerance):
+            regressions.append('%s: median %.1f ms, baseline %.1f ms' % (
+                result['name'], result['median_ms'], previous['median_ms']
+            ))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--save', help='write results to the file, to be used as baseline')
+    parser.add_argument('--baseline', help='results saved by a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown of the median, 0.25 - 25%%')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as local_dir:
+        env = dict(os.environ, REPOS_BACKEND='local', LOCAL_BACKEND_DIR=local_dir)
+        # warm up the file system cache and bytecode, so the first scenario isn't penalized
+        subprocess.run([sys.executable, '-c', SCENARIOS[1][1]], env=env, stdout=subprocess.DEVNULL, check=True)
+        results = [measure(name, code, args.repeat, env) for name, code in SCENARIOS]
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('Startup regression, %s' % regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,26 @@
 #!/usr/bin/env python
+import sys
+
 from flask_script import Server, Manager
 
 from api.app import create_app
 from api import commands
 from api.conf import Config
 
-app = create_app(config_object=Config())
+# only commands serving requests need the views, the rest start without them and their dependencies
+WEB_COMMANDS = ('runserver', 'shell')
+
+app = create_app(config_object=Config(), with_views=len(sys.argv) < 2 or sys.argv[1] in WEB_COMMANDS)
 manager = Manager(app)
 
 manager.add_command("runserver", Server())
 manager.add_command('run_send_message_processor', commands.RunSendMessageProcessorCommand)
 manager.add_command('run_callback_spreader', commands.RunCallbackSpreaderProcessorCommand)
 manager.add_command('run_callback_delivery', commands.RunCallbackDeliveryProcessorCommand)
+manager.add_command('run_subscription_verifier', commands.RunSubscriptionVerifierProcessorCommand)
+manager.add_command('migrate_message_layout', commands.MigrateMessageLayoutCommand)
+manager.add_command('redrive_dead_letters', commands.RedriveDeadLettersCommand)
+manager.add_command('import_time_report', commands.ImportTimeReportCommand)
 
 if __name__ == "__main__":
     manager.run()